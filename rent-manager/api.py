@@ -1,11 +1,46 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, g, send_file
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
-from models import db, User, MeterReading, Payment, ElectricityRate, WaterBill, MaintenanceRequest, OwnerElectricityRate
+from models import (db, User, MeterReading, Payment, ElectricityRate, WaterBill, MaintenanceRequest, OwnerElectricityRate,
+                    Invoice, BalanceEntry, ReplicationHeartbeat, MaintenanceTransition, Notification,
+                    NotificationRecipient)
+from db_config import configure_database
+from write_queue import ReadingWriteQueue
+from events import EventBroker, format_sse
+from conditional import (compute_etag, not_modified, with_etag, owner_tenant_ids, tenants_state,
+                         readings_state, payments_state, maintenance_state, rate_state, invoices_state)
+from compression import init_compression
+from idempotency import idempotent, stripe_idempotency_options
+from background import PeriodicJob
+from reconciler import record_event, process_inbox, sweep_open_intents
+from billing import billing_period, run_billing, run_due_billing
+from receivables import owner_receivables, VersionedCache
+from archive import (archive_tenant, archive_cold_history, archived_readings_query, archived_payments_query,
+                     merge_newest_first)
+from columnar import export_closed_periods, monthly_consumption
+from scoping import init_scoping, set_owner_scope, unscoped
+from routing import init_routing, on_primary, check_replica_lag, REPLICA_BIND
+from sharding import route_to_user, assign_user_id, across_shards, create_schema
+from ratelimit import RateLimiter, json_field, token_user
+from otp import issue_code, find_code, check_code, mark_verified, purge_expired
+from search import search_maintenance
+from maintenance_stats import record_transition, owner_stats, verify_counters
+from mailer import make_transport
+from statements import generate_statements
+from sync import sync_changes, purge_tombstones
+from notifications import (MAX_BATCH_SIZE, unknown_variables, create_notification, send_pending,
+                           notification_progress)
+from tokens import revocations, issue_tokens, use_refresh_token, revoke_session, revoke_user, sync_revocations
+from ledger import record_status_change, post_entries, payment_entries, verify_balances
+from serializers import (dumps, json_response, owner_reading_serializer, owner_payment_serializer,
+                         recent_payment_serializer, tenant_payment_serializer, tenant_serializer, owner_maintenance_serializer,
+                         tenant_maintenance_serializer, owner_invoice_serializer)
 from datetime import datetime, timedelta
 import os
+import re
 from dotenv import load_dotenv
 import stripe
 from werkzeug.utils import secure_filename
+from werkzeug.middleware.proxy_fix import ProxyFix
 from PIL import Image
 import jwt
 from functools import wraps
@@ -13,7 +48,6 @@ from flask_cors import CORS
 import random
 import string
 from flask_mail import Message
-from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail, Email, To, Content
 
 # Load environment variables
@@ -24,22 +58,205 @@ app = Flask(__name__)
 CORS(app, resources={r"/api/*": {"origins": "*", "methods": ["GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS"]}})
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'default-secret-key')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///rentmanager.db')
+configure_database(app)
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False  # Suppress the warning
+# Group-commit meter reading inserts during submission bursts
+app.config['READING_WRITE_BATCHING'] = os.getenv('READING_WRITE_BATCHING', 'false').lower() == 'true'
+app.config['READING_BATCH_MAX_ROWS'] = int(os.getenv('READING_BATCH_MAX_ROWS', 200))
+app.config['READING_BATCH_MAX_WAIT_MS'] = int(os.getenv('READING_BATCH_MAX_WAIT_MS', 5))
+# Server-Sent Events replay buffer per channel and keep-alive interval
+app.config['EVENT_BUFFER_SIZE'] = int(os.getenv('EVENT_BUFFER_SIZE', 200))
+app.config['EVENT_HEARTBEAT_SECONDS'] = int(os.getenv('EVENT_HEARTBEAT_SECONDS', 15))
 stripe.api_key = os.getenv('STRIPE_API_KEY')
+# Point at a local stand-in such as stripe-mock during development
+stripe.api_base = os.getenv('STRIPE_API_BASE', stripe.api_base)
+# Stored responses for repeated Idempotency-Key headers
+app.config['IDEMPOTENCY_KEY_TTL_HOURS'] = int(os.getenv('IDEMPOTENCY_KEY_TTL_HOURS', 24))
+# Upper bound on ids accepted by the bulk payment status endpoint
+app.config['BULK_PAYMENT_MAX_IDS'] = int(os.getenv('BULK_PAYMENT_MAX_IDS', 500))
+# Stripe webhooks land in an inbox that a background job applies in batches
+app.config['STRIPE_WEBHOOK_SECRET'] = os.getenv('STRIPE_WEBHOOK_SECRET')
+app.config['STRIPE_RECONCILE_INTERVAL_SECONDS'] = int(os.getenv('STRIPE_RECONCILE_INTERVAL_SECONDS', 5))
+app.config['STRIPE_RECONCILE_BATCH_SIZE'] = int(os.getenv('STRIPE_RECONCILE_BATCH_SIZE', 500))
+app.config['STRIPE_SWEEP_INTERVAL_SECONDS'] = int(os.getenv('STRIPE_SWEEP_INTERVAL_SECONDS', 900))
+app.config['STRIPE_SWEEP_MIN_AGE_MINUTES'] = int(os.getenv('STRIPE_SWEEP_MIN_AGE_MINUTES', 15))
+# Monthly invoice generation, checked periodically against each owner's billing day
+app.config['BILLING_RUN_INTERVAL_SECONDS'] = int(os.getenv('BILLING_RUN_INTERVAL_SECONDS', 3600))
+app.config['BILLING_RUN_BATCH_SIZE'] = int(os.getenv('BILLING_RUN_BATCH_SIZE', 200))
+# Number of owners whose receivables rollup is kept in memory
+app.config['RECEIVABLES_CACHE_SIZE'] = int(os.getenv('RECEIVABLES_CACHE_SIZE', 1000))
+# Tenant balances are recomputed from scratch periodically to catch drift
+app.config['BALANCE_VERIFY_INTERVAL_SECONDS'] = int(os.getenv('BALANCE_VERIFY_INTERVAL_SECONDS', 86400))
+app.config['BALANCE_VERIFY_REPAIR'] = os.getenv('BALANCE_VERIFY_REPAIR', 'false').lower() == 'true'
+# Readings and settled payments older than the retention window move to the archive tables
+app.config['ARCHIVE_RETENTION_DAYS'] = int(os.getenv('ARCHIVE_RETENTION_DAYS', 730))
+app.config['ARCHIVE_BATCH_SIZE'] = int(os.getenv('ARCHIVE_BATCH_SIZE', 1000))
+app.config['ARCHIVE_INTERVAL_SECONDS'] = int(os.getenv('ARCHIVE_INTERVAL_SECONDS', 86400))
+# Closed months of readings are exported to Arrow files for analytics (needs pyarrow)
+app.config['COLUMNAR_DATA_DIR'] = os.getenv('COLUMNAR_DATA_DIR', 'data/columnar')
+app.config['COLUMNAR_EXPORT_INTERVAL_SECONDS'] = int(os.getenv('COLUMNAR_EXPORT_INTERVAL_SECONDS', 86400))
+# Read replica (SQLALCHEMY_REPLICA_URI): GET requests read from it while its lag stays small,
+# an owner account that just wrote keeps reading from the primary for a while
+app.config['READ_YOUR_WRITES_SECONDS'] = float(os.getenv('READ_YOUR_WRITES_SECONDS', 5))
+app.config['REPLICA_MAX_LAG_SECONDS'] = float(os.getenv('REPLICA_MAX_LAG_SECONDS', 2))
+app.config['REPLICA_LAG_CHECK_SECONDS'] = float(os.getenv('REPLICA_LAG_CHECK_SECONDS', 1))
+# Token bucket limits as "requests/seconds" for login, password reset emails and reading uploads.
+# The sqlite backend shares the buckets between all workers on the host.
+app.config['RATE_LIMIT_ENABLED'] = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+app.config['RATE_LIMIT_BACKEND'] = os.getenv('RATE_LIMIT_BACKEND', 'memory')
+app.config['RATE_LIMIT_SQLITE_PATH'] = os.getenv('RATE_LIMIT_SQLITE_PATH', 'ratelimit.db')
+app.config['RATE_LIMITS'] = {
+    'login': {
+        'ip': os.getenv('RATE_LIMIT_LOGIN_IP', '30/60'),
+        'account': os.getenv('RATE_LIMIT_LOGIN_ACCOUNT', '5/60'),
+        # Each login hashes a password (~0.1s of CPU), 20/s is about what one host sustains;
+        # the burst of 60 lets a rush of sign-ins through instead of turning it away
+        'global': os.getenv('RATE_LIMIT_LOGIN_GLOBAL', '60/3'),
+    },
+    'otp': {
+        'ip': os.getenv('RATE_LIMIT_OTP_IP', '10/600'),
+        'account': os.getenv('RATE_LIMIT_OTP_ACCOUNT', '3/600'),
+        'global': os.getenv('RATE_LIMIT_OTP_GLOBAL', '5/1'),
+    },
+    'upload': {
+        'ip': os.getenv('RATE_LIMIT_UPLOAD_IP', '60/60'),
+        'account': os.getenv('RATE_LIMIT_UPLOAD_ACCOUNT', '10/60'),
+        'global': os.getenv('RATE_LIMIT_UPLOAD_GLOBAL', '50/1'),
+    },
+}
+# Number of reverse proxies in front of the API, their X-Forwarded-For gives the client IP
+app.config['TRUSTED_PROXIES'] = int(os.getenv('TRUSTED_PROXIES', 0))
+# Password reset codes: lifetime, wrong guesses allowed, and how long a verified code stays usable
+app.config['OTP_TTL_MINUTES'] = int(os.getenv('OTP_TTL_MINUTES', 5))
+app.config['OTP_MAX_ATTEMPTS'] = int(os.getenv('OTP_MAX_ATTEMPTS', 5))
+app.config['OTP_VERIFIED_WINDOW_MINUTES'] = int(os.getenv('OTP_VERIFIED_WINDOW_MINUTES', 10))
+app.config['OTP_PURGE_INTERVAL_SECONDS'] = int(os.getenv('OTP_PURGE_INTERVAL_SECONDS', 60))
+# Short-lived access tokens are renewed with rotating refresh tokens. Revocations reach
+# every worker within one poll interval.
+app.config['ACCESS_TOKEN_MINUTES'] = int(os.getenv('ACCESS_TOKEN_MINUTES', 15))
+app.config['REFRESH_TOKEN_DAYS'] = int(os.getenv('REFRESH_TOKEN_DAYS', 30))
+app.config['TOKEN_REVOCATION_POLL_SECONDS'] = float(os.getenv('TOKEN_REVOCATION_POLL_SECONDS', 1))
+# Statements are rendered in a process pool and cached by period and data version
+app.config['STATEMENT_FOLDER'] = os.getenv('STATEMENT_FOLDER', os.path.join(app.config['UPLOAD_FOLDER'], 'statements'))
+app.config['STATEMENT_WORKERS'] = int(os.getenv('STATEMENT_WORKERS', os.cpu_count() or 1))
+# Delta sync: look-back for late commits and how long deletions are remembered
+app.config['SYNC_OVERLAP_SECONDS'] = float(os.getenv('SYNC_OVERLAP_SECONDS', 5))
+app.config['SYNC_TOMBSTONE_DAYS'] = int(os.getenv('SYNC_TOMBSTONE_DAYS', 30))
+app.config['SYNC_TOMBSTONE_PURGE_INTERVAL_SECONDS'] = int(os.getenv('SYNC_TOMBSTONE_PURGE_INTERVAL_SECONDS', 86400))
+# Maintenance counters are recomputed from the status log periodically, which also backfills them
+app.config['MAINTENANCE_STATS_VERIFY_INTERVAL_SECONDS'] = int(os.getenv('MAINTENANCE_STATS_VERIFY_INTERVAL_SECONDS', 86400))
 
 # SendGrid configuration
 SENDGRID_API_KEY = os.getenv('SENDGRID_API_KEY')
 SENDGRID_FROM_EMAIL = os.getenv('SENDGRID_FROM_EMAIL', 'noreply@yourdomain.com')
+# 'local' keeps outgoing mail in memory (and in EMAIL_OUTBOX_DIR if set) instead of calling SendGrid
+app.config['EMAIL_TRANSPORT'] = os.getenv('EMAIL_TRANSPORT', 'sendgrid')
+app.config['EMAIL_OUTBOX_DIR'] = os.getenv('EMAIL_OUTBOX_DIR')
+# Owner notifications to all tenants are sent by a background worker, up to 1000 recipients per call
+app.config['NOTIFICATION_POLL_SECONDS'] = int(os.getenv('NOTIFICATION_POLL_SECONDS', 5))
+app.config['NOTIFICATION_BATCH_SIZE'] = int(os.getenv('NOTIFICATION_BATCH_SIZE', MAX_BATCH_SIZE))
+app.config['NOTIFICATION_MAX_ATTEMPTS'] = int(os.getenv('NOTIFICATION_MAX_ATTEMPTS', 5))
+app.config['NOTIFICATION_RETRY_SECONDS'] = int(os.getenv('NOTIFICATION_RETRY_SECONDS', 30))
+app.config['NOTIFICATION_LEASE_SECONDS'] = int(os.getenv('NOTIFICATION_LEASE_SECONDS', 300))
 
 # Initialize extensions
 db.init_app(app)
+# Token authenticated requests only see the caller's owner account
+init_scoping(db.session)
+init_routing(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
+init_compression(app)
+if app.config['TRUSTED_PROXIES']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'])
+rate_limiter = RateLimiter(app)
 
 # Ensure upload directory exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+reading_queue = ReadingWriteQueue(
+    app,
+    max_rows=app.config['READING_BATCH_MAX_ROWS'],
+    max_wait_ms=app.config['READING_BATCH_MAX_WAIT_MS']
+)
+event_broker = EventBroker(buffer_size=app.config['EVENT_BUFFER_SIZE'])
+receivables_cache = VersionedCache(max_entries=app.config['RECEIVABLES_CACHE_SIZE'])
+mail_transport = make_transport(app.config['EMAIL_TRANSPORT'], SENDGRID_API_KEY, app.config['EMAIL_OUTBOX_DIR'])
+
+def publish_payment_changes(changed):
+    for payment_id, user_id, owner_id, status in changed:
+        channels = [f"tenant:{user_id}"] + ([f"owner:{owner_id}"] if owner_id else [])
+        event_broker.publish(channels, 'payment', {'id': payment_id, 'status': status})
+
+def reconcile_stripe_events():
+    changed = process_inbox(app.config['STRIPE_RECONCILE_BATCH_SIZE'])
+    publish_payment_changes(changed)
+    return changed
+
+def flattened(results):
+    return [item for result in results for item in result]
+
+def sweep_stripe_intents():
+    changed = flattened(across_shards(lambda: sweep_open_intents(app.config['STRIPE_SWEEP_MIN_AGE_MINUTES'])))
+    publish_payment_changes(changed)
+    return changed
+
+def verify_tenant_balances():
+    drift = flattened(across_shards(lambda: verify_balances(repair=app.config['BALANCE_VERIFY_REPAIR'])))
+    for user_id, stored, expected in drift:
+        app.logger.warning(f"Balance drift for user {user_id}: stored {stored}, expected {expected}")
+    return drift
+
+def verify_maintenance_counters():
+    drift = flattened(across_shards(verify_counters))
+    for owner_id in sorted({owner_id for owner_id, _, _, _ in drift}):
+        names = ', '.join(f"{name} {stored:g} -> {expected:g}" for o, name, stored, expected in drift if o == owner_id)
+        app.logger.warning(f"Maintenance counter drift for owner {owner_id}: {names}")
+    return drift
+
+def publish_notification_progress(notification):
+    event_broker.publish([f"owner:{notification.owner_id}"], 'notification', notification_progress(notification))
+
+def send_notifications():
+    return flattened(across_shards(lambda: send_pending(
+        mail_transport, SENDGRID_FROM_EMAIL,
+        batch_size=app.config['NOTIFICATION_BATCH_SIZE'],
+        lease_seconds=app.config['NOTIFICATION_LEASE_SECONDS'],
+        max_attempts=app.config['NOTIFICATION_MAX_ATTEMPTS'],
+        retry_seconds=app.config['NOTIFICATION_RETRY_SECONDS'],
+        on_progress=publish_notification_progress)))
+
+background_jobs = {
+    'stripe-reconciler': PeriodicJob(app, 'stripe-reconciler', app.config['STRIPE_RECONCILE_INTERVAL_SECONDS'], reconcile_stripe_events),
+    'stripe-sweep': PeriodicJob(app, 'stripe-sweep', app.config['STRIPE_SWEEP_INTERVAL_SECONDS'], sweep_stripe_intents),
+    'billing-run': PeriodicJob(app, 'billing-run', app.config['BILLING_RUN_INTERVAL_SECONDS'],
+                               lambda: across_shards(lambda: run_due_billing(batch_size=app.config['BILLING_RUN_BATCH_SIZE']))),
+    'balance-verify': PeriodicJob(app, 'balance-verify', app.config['BALANCE_VERIFY_INTERVAL_SECONDS'], verify_tenant_balances),
+    'archive': PeriodicJob(app, 'archive', app.config['ARCHIVE_INTERVAL_SECONDS'],
+                           lambda: across_shards(lambda: archive_cold_history(app.config['ARCHIVE_RETENTION_DAYS'],
+                                                                              app.config['ARCHIVE_BATCH_SIZE']))),
+    'columnar-export': PeriodicJob(app, 'columnar-export', app.config['COLUMNAR_EXPORT_INTERVAL_SECONDS'],
+                                   lambda: flattened(across_shards(lambda: export_closed_periods(app.config['COLUMNAR_DATA_DIR'])))),
+    'otp-purge': PeriodicJob(app, 'otp-purge', app.config['OTP_PURGE_INTERVAL_SECONDS'], purge_expired),
+    'token-revocations': PeriodicJob(app, 'token-revocations', app.config['TOKEN_REVOCATION_POLL_SECONDS'], sync_revocations),
+    'maintenance-stats': PeriodicJob(app, 'maintenance-stats', app.config['MAINTENANCE_STATS_VERIFY_INTERVAL_SECONDS'],
+                                     verify_maintenance_counters),
+    'notifications': PeriodicJob(app, 'notifications', app.config['NOTIFICATION_POLL_SECONDS'], send_notifications),
+    'sync-tombstones': PeriodicJob(app, 'sync-tombstones', app.config['SYNC_TOMBSTONE_PURGE_INTERVAL_SECONDS'],
+                                   lambda: across_shards(lambda: purge_tombstones(app.config['SYNC_TOMBSTONE_DAYS']))),
+}
+
+if REPLICA_BIND in (app.config.get('SQLALCHEMY_BINDS') or {}):
+    background_jobs['replica-lag'] = PeriodicJob(
+        app, 'replica-lag', app.config['REPLICA_LAG_CHECK_SECONDS'],
+        lambda: check_replica_lag(db, ReplicationHeartbeat.__table__, app.config['REPLICA_MAX_LAG_SECONDS'])
+    )
+
+def start_background_jobs():
+    for job in background_jobs.values():
+        job.start()
+
 # Token verification decorator
 def token_required(f):
     @wraps(f)
@@ -56,47 +273,72 @@ def token_required(f):
         
         try:
             data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
+            # In memory, revoked tokens are turned away without touching the database
+            if revocations.is_revoked(data):
+                return jsonify({'error': 'Token has been revoked'}), 401
+            g.token_claims = data
+            state = route_to_user(user_id=data['user_id'])
+            if state is None:
+                return jsonify({'error': 'Invalid token'}), 401
+            if state == 'moving' and request.method not in ('GET', 'HEAD'):
+                # The owner account is being copied to another shard, writes would be lost
+                response = jsonify({'error': 'Account is being migrated, please retry shortly'})
+                response.headers['Retry-After'] = '5'
+                return response, 503
             current_user = User.query.get(data['user_id'])
+            if not current_user:
+                # A user created moments ago may not have reached the replica yet
+                with on_primary():
+                    current_user = User.query.get(data['user_id'])
             if not current_user:
                 return jsonify({'error': 'Invalid token'}), 401
         except:
             return jsonify({'error': 'Invalid token'}), 401
         
+        set_owner_scope(current_user)
         return f(current_user, *args, **kwargs)
     
     return decorated
 
+def publish_event(tenant, event, data):
+    """Push a change to the tenant's and their owner's event streams"""
+    channels = [f"tenant:{tenant.id}"]
+    if tenant.owner_id:
+        channels.append(f"owner:{tenant.owner_id}")
+    event_broker.publish(channels, event, data)
+
 @app.route('/api/owner/dashboard', methods=['GET'])
 @token_required
 def owner_dashboard(current_user):
     if not current_user.is_owner:
         return jsonify({'error': 'Unauthorized'}), 403
 
-    tenants = User.query.filter_by(owner_id=current_user.id).all()
-    total_tenants = len(tenants)
-    total_rent = sum(t.rent_amount for t in tenants)
-    total_payments = Payment.query.filter(Payment.status == 'completed').count()
-    recent_payments = Payment.query.order_by(Payment.payment_date.desc()).limit(10).all()
-
-    payments_data = []
-    for p in recent_payments:
-        tenant = User.query.get(p.user_id)
-        if tenant and tenant.owner_id == current_user.id:  # Only include payments from owner's tenants
-            payments_data.append({
-                'id': p.id,
-                'tenant': tenant.name if tenant else "Unknown",
-                'amount': p.amount,
-                'date': p.payment_date.isoformat(),
-                'status': p.status,
-                'method': p.payment_method,
-            })
-
-    return jsonify({
+    etag = compute_etag(tenants_state(current_user.id), payments_state(owner_tenant_ids(current_user.id)))
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
+    total_tenants, total_rent = (db.session.query(db.func.count(User.id), db.func.coalesce(db.func.sum(User.rent_amount), 0.0))
+                                 .filter(User.owner_id == current_user.id)
+                                 .one())
+    total_payments = (Payment.query
+                      .filter(Payment.user_id.in_(owner_tenant_ids(current_user.id)), Payment.status == 'completed')
+                      .count())
+
+    # Only include payments from owner's tenants
+    recent_payments = (recent_payment_serializer.query()
+                       .join(User, Payment.user_id == User.id)
+                       .filter(User.owner_id == current_user.id)
+                       .order_by(Payment.payment_date.desc())
+                       .limit(10))
+    payments_data = recent_payment_serializer.all(recent_payments)
+
+    return with_etag(json_response({
         'total_tenants': total_tenants,
         'total_rent': total_rent,
         'total_payments': total_payments,
         'recent_payments': payments_data,
-    })
+    }), etag)
     
 @app.route('/api/owner/electricity_rate', methods=['POST'])
 @token_required
@@ -135,6 +377,228 @@ def get_electricity_rate(current_user):
         'effective_from': rate.effective_from.isoformat()
     })
 
+@app.route('/api/owner/billing_day', methods=['POST'])
+@token_required
+def set_billing_day(current_user):
+    if not current_user.is_owner:
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    data = request.get_json()
+    billing_day = data.get('billing_day')
+    if not isinstance(billing_day, int) or not 1 <= billing_day <= 31:
+        return jsonify({'error': 'billing_day must be between 1 and 31'}), 400
+
+    current_user.billing_day = billing_day
+    db.session.commit()
+    return jsonify({'message': 'Billing day updated successfully', 'billing_day': billing_day}), 200
+
+@app.route('/api/owner/billing/run', methods=['POST'])
+@token_required
+def run_owner_billing(current_user):
+    if not current_user.is_owner:
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    # Only tenants without an invoice for the period are billed, so this is safe to repeat
+    period = billing_period(datetime.now())
+    invoices = run_billing([current_user.id], period)
+    return jsonify({'period': period, 'invoices_created': len(invoices)}), 200
+
+@app.route('/api/owner/invoices', methods=['GET'])
+@token_required
+def get_owner_invoices(current_user):
+    if not current_user.is_owner:
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    period = request.args.get('period')
+    if not period:
+        period = (db.session.query(db.func.max(Invoice.period))
+                  .filter(Invoice.owner_id == current_user.id)
+                  .scalar())
+        if not period:
+            return json_response([])
+
+    invoices = (owner_invoice_serializer.query()
+                .join(User, Invoice.user_id == User.id)
+                .filter(Invoice.owner_id == current_user.id, Invoice.period == period)
+                .order_by(User.name))
+    return json_response(owner_invoice_serializer.all(invoices))
+
+@app.route('/api/owner/notifications', methods=['POST'])
+@token_required
+@idempotent
+def create_owner_notification(current_user):
+    if not current_user.is_owner:
+        return jsonify({'error': 'Unauthorized'}), 403
+    data = request.get_json(silent=True) or {}
+    subject = (data.get('subject') or '').strip()
+    message = (data.get('message') or '').strip()
+    tenant_ids = data.get('tenant_ids')
+    if not subject or not message:
+        return jsonify({'error': 'Missing subject or message'}), 400
+    if len(subject) > 255:
+        return jsonify({'error': 'Subject is too long'}), 400
+    if tenant_ids is not None and (not isinstance(tenant_ids, list)
+                                   or not all(isinstance(i, int) for i in tenant_ids)):
+        return jsonify({'error': 'tenant_ids must be a list of ids'}), 400
+    unknown = unknown_variables(subject, message)
+    if unknown:
+        return jsonify({'error': f"Unknown variables: {', '.join(unknown)}"}), 400
+
+    notification, skipped = create_notification(current_user.id, subject, message, tenant_ids)
+    background_jobs['notifications'].wake()
+    return jsonify({**notification_progress(notification), 'skipped_tenant_ids': skipped}), 202
+
+@app.route('/api/owner/notifications', methods=['GET'])
+@token_required
+def get_owner_notifications(current_user):
+    if not current_user.is_owner:
+        return jsonify({'error': 'Unauthorized'}), 403
+    notifications = (Notification.query
+                     .filter(Notification.owner_id == current_user.id)
+                     .order_by(Notification.id.desc())
+                     .limit(min(request.args.get('limit', 50, type=int), 200)))
+    return jsonify([notification_progress(n) for n in notifications])
+
+@app.route('/api/owner/notifications/<int:notification_id>', methods=['GET'])
+@token_required
+def get_owner_notification(current_user, notification_id):
+    if not current_user.is_owner:
+        return jsonify({'error': 'Unauthorized'}), 403
+    notification = Notification.query.filter_by(id=notification_id, owner_id=current_user.id).first()
+    if not notification:
+        return jsonify({'error': 'Notification not found'}), 404
+    failed = (db.session.query(NotificationRecipient.user_id, NotificationRecipient.email)
+              .filter(NotificationRecipient.notification_id == notification.id,
+                      NotificationRecipient.status == 'failed'))
+    return jsonify({**notification_progress(notification),
+                    'failed_recipients': [{'id': user_id, 'email': email} for user_id, email in failed]})
+
+def statement_folder():
+    return os.path.join(app.root_path, app.config['STATEMENT_FOLDER'])
+
+@app.route('/api/owner/statements', methods=['POST'])
+@token_required
+def create_owner_statements(current_user):
+    if not current_user.is_owner:
+        return jsonify({'error': 'Unauthorized'}), 403
+    data = request.get_json(silent=True) or {}
+    period = data.get('period')
+    if not period:
+        period = (db.session.query(db.func.max(Invoice.period))
+                  .filter(Invoice.owner_id == current_user.id)
+                  .scalar())
+        if not period:
+            return jsonify({'error': 'No invoices yet'}), 404
+    if not re.fullmatch(r'\d{4}-(0[1-9]|1[0-2])', period):
+        return jsonify({'error': 'period must be YYYY-MM'}), 400
+
+    results = generate_statements(current_user.id, period, statement_folder(), app.config['SECRET_KEY'],
+                                  workers=app.config['STATEMENT_WORKERS'])
+    return jsonify({
+        'period': period,
+        'generated': sum(1 for r in results if not r['cached']),
+        'cached': sum(1 for r in results if r['cached']),
+        'statements': [{
+            'id': r['id'],
+            'name': r['name'],
+            'tenant_id': r['tenant_id'],
+            'version': r['version'],
+            'pdf_url': f"/api/statements/{period}/{r['id']}/pdf",
+            'csv_url': f"/api/statements/{period}/{r['id']}/csv",
+        } for r in results]
+    })
+
+@app.route('/api/statements/<period>/<int:user_id>/<fmt>', methods=['GET'])
+@token_required
+def get_statement(current_user, period, user_id, fmt):
+    if fmt not in ('pdf', 'csv') or not re.fullmatch(r'\d{4}-(0[1-9]|1[0-2])', period):
+        return jsonify({'error': 'Statement not found'}), 404
+    if not current_user.is_owner and user_id != current_user.id:
+        return jsonify({'error': 'Unauthorized'}), 403
+    tenant = User.query.get(user_id)
+    if not tenant or tenant.is_owner:
+        return jsonify({'error': 'Tenant not found'}), 404
+    # Renders this tenant's statement only if its data changed since the cached one
+    results = generate_statements(tenant.owner_id, period, statement_folder(), app.config['SECRET_KEY'],
+                                  workers=1, user_ids=[user_id])
+    if not results:
+        return jsonify({'error': 'No invoice for this period'}), 404
+    return send_file(results[0][fmt], mimetype='application/pdf' if fmt == 'pdf' else 'text/csv',
+                     as_attachment=True, download_name=f"statement-{tenant.tenant_id}-{period}.{fmt}")
+
+@app.route('/api/owner/balances', methods=['GET'])
+@token_required
+def get_owner_balances(current_user):
+    if not current_user.is_owner:
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    tenants = (db.session.query(User.id, User.tenant_id, User.name, User.balance)
+               .filter(User.owner_id == current_user.id, User.is_owner == False)
+               .order_by(User.balance.desc()))
+    return jsonify([{'id': user_id, 'tenant_id': code, 'name': name, 'balance': balance}
+                    for user_id, code, name, balance in tenants])
+
+@app.route('/api/tenant/balance', methods=['GET'])
+@token_required
+def get_tenant_balance(current_user):
+    if current_user.is_owner:
+        return jsonify({'error': 'Owner account has no balance'}), 403
+
+    limit = min(request.args.get('limit', 50, type=int), 500)
+    entries = (BalanceEntry.query
+               .filter_by(user_id=current_user.id)
+               .order_by(BalanceEntry.id.desc())
+               .limit(limit))
+    return jsonify({
+        'balance': current_user.balance,
+        'entries': [{
+            'amount': entry.amount,
+            'reason': entry.reason,
+            'invoice_id': entry.invoice_id,
+            'payment_id': entry.payment_id,
+            'created_at': entry.created_at.isoformat()
+        } for entry in entries]
+    })
+
+@app.route('/api/owner/analytics/consumption', methods=['GET'])
+@token_required
+def get_consumption_analytics(current_user):
+    if not current_user.is_owner:
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    today = datetime.now()
+    last = request.args.get('to', today.strftime('%Y-%m'))
+    first = request.args.get('from', f"{today.year - 1:04d}-{today.month:02d}")
+    try:
+        datetime.strptime(first, '%Y-%m')
+        datetime.strptime(last, '%Y-%m')
+    except ValueError:
+        return jsonify({'error': 'from and to must be YYYY-MM'}), 400
+    if first > last:
+        return jsonify({'error': 'from must not be after to'}), 400
+
+    return json_response(monthly_consumption(current_user.id, first, last, app.config['COLUMNAR_DATA_DIR'], today))
+
+@app.route('/api/owner/receivables', methods=['GET'])
+@token_required
+def get_owner_receivables(current_user):
+    if not current_user.is_owner:
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    # Any payment, invoice or tenant change moves the version, which invalidates the cached rollup
+    version = compute_etag(tenants_state(current_user.id),
+                           payments_state(owner_tenant_ids(current_user.id)),
+                           invoices_state(current_user.id))
+    cached = not_modified(version)
+    if cached:
+        return cached
+
+    body = receivables_cache.get(current_user.id, version)
+    if body is None:
+        body = dumps(owner_receivables(current_user.id))
+        receivables_cache.put(current_user.id, version, body)
+    return with_etag(app.response_class(body, mimetype='application/json'), version)
+
 @app.route('/api/update_rate', methods=['POST'])
 @token_required  # Ensure only owners can access
 def update_rate(current_user):
@@ -171,12 +635,13 @@ def get_water_bill(current_user):
     if not current_user.is_owner:
         return jsonify({'error': 'Unauthorized'}), 403
 
-    # Get all tenants belonging to this owner
-    owner_tenants = User.query.filter_by(owner_id=current_user.id).all()
-    total_tenants = len(owner_tenants)
+    total_tenants = User.query.filter_by(owner_id=current_user.id).count()
 
-    # Get the latest water bill
-    bill = WaterBill.query.order_by(WaterBill.billing_date.desc()).first()
+    # Get the owner's latest water bill
+    bill = (WaterBill.query
+            .filter(WaterBill.owner_id == current_user.id)
+            .order_by(WaterBill.billing_date.desc())
+            .first())
     if not bill:
         return jsonify({'error': 'No water bill set yet'}), 404
 
@@ -195,26 +660,26 @@ def get_owner_meter_readings(current_user):
     if not current_user.is_owner:
         return jsonify({'error': 'Unauthorized'}), 403
 
-    # Get all tenants belonging to this owner
-    owner_tenants = User.query.filter_by(owner_id=current_user.id).all()
-    tenant_ids = [tenant.id for tenant in owner_tenants]
+    include_archived = request.args.get('include_archived', 'false').lower() == 'true'
+    # Rows only reach the archive by leaving the live tables, so the live state covers both
+    etag = compute_etag(tenants_state(current_user.id), readings_state(owner_tenant_ids(current_user.id)),
+                        extra=(include_archived,))
+    cached = not_modified(etag)
+    if cached:
+        return cached
 
     # Get readings only for owner's tenants
-    readings = MeterReading.query.filter(MeterReading.user_id.in_(tenant_ids)).order_by(MeterReading.reading_date.desc()).all()
-    readings_data = []
-    for r in readings:
-        tenant = User.query.get(r.user_id)
-        readings_data.append({
-            'id': r.id,
-            'tenant_id': tenant.tenant_id if tenant else None,
-            'tenant_name': tenant.name if tenant else "Unknown",
-            'meter_type': r.meter_type,
-            'reading_value': r.reading_value,
-            'reading_date': r.reading_date.isoformat() if r.reading_date else None,
-            'image_path': r.image_path,
-        })
+    readings = (owner_reading_serializer.query()
+                .join(User, MeterReading.user_id == User.id)
+                .filter(User.owner_id == current_user.id)
+                .order_by(MeterReading.reading_date.desc()))
+    if include_archived:
+        data = merge_newest_first(owner_reading_serializer, 'reading_date',
+                                  readings, archived_readings_query(current_user.id))
+    else:
+        data = owner_reading_serializer.all(readings)
 
-    return jsonify(readings_data)
+    return with_etag(json_response(data), etag)
 
 @app.route('/api/owner/payments', methods=['GET'])
 @token_required
@@ -222,27 +687,36 @@ def get_owner_payments(current_user):
     if not current_user.is_owner:
         return jsonify({'error': 'Unauthorized'}), 403
 
-    # Get all tenants belonging to this owner
-    owner_tenants = User.query.filter_by(owner_id=current_user.id).all()
-    tenant_ids = [tenant.id for tenant in owner_tenants]
+    include_archived = request.args.get('include_archived', 'false').lower() == 'true'
+    etag = compute_etag(tenants_state(current_user.id), payments_state(owner_tenant_ids(current_user.id)),
+                        extra=(include_archived,))
+    cached = not_modified(etag)
+    if cached:
+        return cached
 
     # Get payments only for owner's tenants
-    payments = Payment.query.filter(Payment.user_id.in_(tenant_ids)).order_by(Payment.payment_date.desc()).all()
-    payments_data = []
-    for p in payments:
-        tenant = User.query.get(p.user_id)
-        payments_data.append({
-            'id': p.id,
-            'tenant_id': tenant.tenant_id if tenant else None,
-            'tenant_name': tenant.name if tenant else "Unknown",
-            'amount': p.amount,
-            'date': p.payment_date.isoformat() if p.payment_date else None,
-            'status': p.status,
-            'method': p.payment_method,
-            'reference': p.stripe_payment_id if p.payment_method == 'card' else p.transaction_reference
-        })
+    payments = (owner_payment_serializer.query()
+                .join(User, Payment.user_id == User.id)
+                .filter(User.owner_id == current_user.id)
+                .order_by(Payment.payment_date.desc()))
+    if include_archived:
+        data = merge_newest_first(owner_payment_serializer, 'date', payments, archived_payments_query(current_user.id))
+    else:
+        data = owner_payment_serializer.all(payments)
 
-    return jsonify(payments_data)
+    return with_etag(json_response(data), etag)
+
+@app.route('/api/sync', methods=['GET'])
+@token_required
+def sync(current_user):
+    since = request.args.get('since')
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            return jsonify({'error': 'since must be a watermark from an earlier sync'}), 400
+    return json_response(sync_changes(current_user, since, app.config['SYNC_OVERLAP_SECONDS'],
+                                      app.config['SYNC_TOMBSTONE_DAYS']))
 
 @app.route('/api/owner/tenants', methods=['GET'])
 @token_required
@@ -250,22 +724,17 @@ def get_owner_tenants(current_user):
     if not current_user.is_owner:
         return jsonify({'error': 'Unauthorized'}), 403
 
-    tenants = User.query.filter_by(owner_id=current_user.id).all()
-    tenants_data = []
-    for t in tenants:
-        tenants_data.append({
-            'id': t.id,
-            'name': t.name,
-            'tenant_id': t.tenant_id,
-            'email': t.email,
-            'rent_amount': t.rent_amount,
-            'deposit': t.deposit,
-            'created_at': t.created_at.isoformat() if t.created_at else None,
-        })
+    etag = compute_etag(tenants_state(current_user.id))
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
+    tenants = tenant_serializer.query().filter(User.owner_id == current_user.id)
 
-    return jsonify(tenants_data)
+    return with_etag(json_response(tenant_serializer.all(tenants)), etag)
 
 @app.route('/api/login', methods=['POST'])
+@rate_limiter.limit('login', account=json_field('tenant_id'))
 def login():
     if not request.is_json:
         return jsonify({'error': 'Missing JSON in request'}), 400
@@ -278,21 +747,22 @@ def login():
         return jsonify({'error': 'Missing tenant_id or password'}), 400
     
     # Try to find user by tenant_id first (for tenants)
-    user = User.query.filter_by(tenant_id=tenant_id).first()
-    if not user:
+    user = None
+    if route_to_user(tenant_id=tenant_id):
+        user = User.query.filter_by(tenant_id=tenant_id).first()
+    if not user and route_to_user(email=tenant_id):
         # If not found, try email (for owner)
         user = User.query.filter_by(email=tenant_id).first()
     
     if user and user.check_password(password):
-        # Generate token
-        token = jwt.encode({
-            'user_id': user.id,
-            'is_owner': user.is_owner,
-               'exp': datetime.utcnow() + timedelta(days=1)
-        }, app.config['SECRET_KEY'], algorithm='HS256')
+        # Generate an access token and a refresh token for a new session
+        tokens = issue_tokens(user)
+        db.session.commit()
         
         return jsonify({
-            'token': token,
+            'token': tokens['token'],
+            'refresh_token': tokens['refresh_token'],
+            'expires_in': tokens['expires_in'],
             'user': {
                 'id': user.id,
                 'name': user.name,
@@ -304,7 +774,37 @@ def login():
     
     return jsonify({'error': 'Invalid credentials'})
 
+@app.route('/api/auth/refresh', methods=['POST'])
+def refresh_token():
+    data = request.get_json(silent=True) or {}
+    if not data.get('refresh_token'):
+        return jsonify({'error': 'Missing refresh_token'}), 400
+
+    used = use_refresh_token(data['refresh_token'])
+    if used is None:
+        return jsonify({'error': 'Invalid refresh token'}), 401
+    user_id, session_id = used
+    user = User.query.get(user_id) if route_to_user(user_id=user_id) else None
+    if not user:
+        db.session.rollback()
+        return jsonify({'error': 'Invalid refresh token'}), 401
+
+    # The next refresh token continues the same session
+    tokens = issue_tokens(user, session_id)
+    db.session.commit()
+    return jsonify(tokens)
+
+@app.route('/api/auth/logout', methods=['POST'])
+@token_required
+def logout(current_user):
+    session_id = g.token_claims.get('sid')
+    if session_id:
+        revoke_session(current_user.id, session_id)
+        db.session.commit()
+    return jsonify({'message': 'Logged out'})
+
 @app.route('/api/submit_reading', methods=['POST'])
+@rate_limiter.limit('upload', account=token_user)
 @token_required
 def submit_reading(current_user):
     if 'meter_type' not in request.form or 'reading_value' not in request.form:
@@ -327,16 +827,36 @@ def submit_reading(current_user):
         image_path = os.path.join(tenant_folder_name, filename)
 
     # Save reading to DB
-    reading = MeterReading(
-        user_id=current_user.id,
-        reading_value=reading_value,
-        reading_date=datetime.utcnow(),
-        image_path=image_path,
-        meter_type=meter_type,
-        is_processed=False
-    )
-    db.session.add(reading)
-    db.session.commit()
+    # The batching thread has no request to pick a shard from
+    if app.config['READING_WRITE_BATCHING'] and not app.config['SHARDS']:
+        try:
+            reading_queue.submit({
+                'user_id': current_user.id,
+                'reading_value': reading_value,
+                'reading_date': datetime.utcnow(),
+                'image_path': image_path,
+                'meter_type': meter_type,
+                'is_processed': False
+            })
+        except TimeoutError:
+            # The reading was withdrawn from the queue unsaved, retrying cannot duplicate it
+            response = jsonify({'error': 'Reading could not be saved in time, please retry'})
+            response.headers['Retry-After'] = '1'
+            return response, 503
+        except Exception as e:
+            app.logger.error(f"Error in submit_reading: {str(e)}")
+            return jsonify({'error': 'Failed to save reading'}), 500
+    else:
+        reading = MeterReading(
+            user_id=current_user.id,
+            reading_value=reading_value,
+            reading_date=datetime.utcnow(),
+            image_path=image_path,
+            meter_type=meter_type,
+            is_processed=False
+        )
+        db.session.add(reading)
+        db.session.commit()
 
     return jsonify({'message': 'Reading submitted successfully'}), 200
 
@@ -345,6 +865,19 @@ def submit_reading(current_user):
 def tenant_dashboard(current_user):
     if current_user.is_owner:
         return jsonify({'error': 'Owner account cannot access tenant dashboard'}), 403
+
+    # Profile fields are already loaded with the user, only the related rows need checking
+    etag = compute_etag(
+        readings_state([current_user.id]),
+        payments_state([current_user.id]),
+        rate_state(current_user.owner_id),
+        tenants_state(current_user.owner_id),
+        extra=(current_user.name, current_user.tenant_id, current_user.rent_amount, current_user.deposit,
+               current_user.balance)
+    )
+    cached = not_modified(etag)
+    if cached:
+        return cached
     
     # Get the owner's current electricity rate
     owner = User.query.get(current_user.owner_id)
@@ -393,7 +926,8 @@ def tenant_dashboard(current_user):
             'name': current_user.name,
             'tenant_id': current_user.tenant_id,
             'rent_amount': current_user.rent_amount,
-            'deposit': current_user.deposit
+            'deposit': current_user.deposit,
+            'balance': current_user.balance
         },
         'billing': {
             'rent': current_user.rent_amount,
@@ -423,7 +957,11 @@ def tenant_dashboard(current_user):
     }
     
     # Get payment history
-    payments = Payment.query.filter_by(user_id=current_user.id).order_by(Payment.payment_date.desc()).limit(10).all()
+    payments = (tenant_payment_serializer.query()
+                .filter(Payment.user_id == current_user.id)
+                .order_by(Payment.payment_date.desc())
+                .limit(10))
+    dashboard_data['payment_history'] = tenant_payment_serializer.all(payments)
 
     # Check for existing payment for current billing period
     latest_reading = None
@@ -451,23 +989,13 @@ def tenant_dashboard(current_user):
             'reference': existing_payment.transaction_reference or existing_payment.stripe_payment_id
         }
     
-    # Format payment history
-    for payment in payments:
-        dashboard_data['payment_history'].append({
-            'id': payment.id,
-            'date': payment.payment_date.isoformat(),
-            'amount': payment.amount,
-            'method': payment.payment_method,
-            'status': payment.status,
-            'reference': payment.transaction_reference or payment.stripe_payment_id
-        })
-    
-    return jsonify(dashboard_data)
+    return with_etag(json_response(dashboard_data), etag)
 
 # Add more API endpoints for other functionality...
 
 @app.route('/api/create_payment', methods=['POST'])
 @token_required
+@idempotent
 def create_payment(current_user):
     if not request.is_json:
         return jsonify({'error': 'Missing JSON in request'}), 400
@@ -541,11 +1069,13 @@ def create_payment(current_user):
             payment_intent = stripe.PaymentIntent.create(
                 amount=int(total_amount * 100),  # Convert to cents
                 currency='inr',
-                metadata={'user_id': current_user.id}
+                metadata={'user_id': current_user.id},
+                **stripe_idempotency_options()
             )
             payment.stripe_payment_id = payment_intent.id
             db.session.add(payment)
             db.session.commit()
+            publish_event(current_user, 'payment', {'id': payment.id, 'status': payment.status})
 
             return jsonify({
                 'clientSecret': payment_intent.client_secret,
@@ -559,6 +1089,7 @@ def create_payment(current_user):
         payment.transaction_reference = reference
         db.session.add(payment)
         db.session.commit()
+        publish_event(current_user, 'payment', {'id': payment.id, 'status': payment.status})
 
         return jsonify({
             'reference': reference,
@@ -566,6 +1097,24 @@ def create_payment(current_user):
             'message': f'Please use reference {reference} when making the payment'
         })
 
+@app.route('/api/stripe/webhook', methods=['POST'])
+def stripe_webhook():
+    payload = request.get_data()
+    signature = request.headers.get('Stripe-Signature')
+    if not app.config['STRIPE_WEBHOOK_SECRET']:
+        return jsonify({'error': 'Webhook secret is not configured'}), 500
+    try:
+        event = stripe.Webhook.construct_event(payload, signature, app.config['STRIPE_WEBHOOK_SECRET'])
+    except ValueError:
+        return jsonify({'error': 'Invalid payload'}), 400
+    except stripe.error.SignatureVerificationError:
+        return jsonify({'error': 'Invalid signature'}), 400
+
+    # Acknowledge right away, statuses are applied by the reconciler job
+    if record_event(event, payload.decode('utf-8')):
+        background_jobs['stripe-reconciler'].wake()
+    return jsonify({'received': True}), 200
+
 def generate_tenant_password(length=8):
     """Generate a random password for tenant"""
     characters = string.ascii_letters + string.digits + string.punctuation
@@ -587,12 +1136,18 @@ def register_tenant(current_user):
     initial_electricity_reading = float(data.get('initial_electricity_reading'))
     initial_water_reading = float(data.get('initial_water_reading'))
     deposit = float(data.get('deposit', 0.0))  # Default to 0.0 if not provided
+    email = (data.get('email') or '').strip() or None  # Optional, for notifications and password resets
     
     if not all([name, rent_amount, initial_electricity_reading, initial_water_reading]):
         return jsonify({'error': 'Missing required fields'}), 400
+    if email:
+        with unscoped():
+            if route_to_user(email=email) and User.query.filter_by(email=email).first():
+                return jsonify({'error': 'Email already registered'}), 400
     
-    # Generate unique tenant ID
-    tenant_id = User.generate_unique_tenant_id()
+    # Generate unique tenant ID, checked against every owner's tenants
+    with unscoped():
+        tenant_id = User.generate_unique_tenant_id()
     
     # Generate random password
     password = generate_tenant_password()
@@ -600,12 +1155,14 @@ def register_tenant(current_user):
     tenant = User(
         tenant_id=tenant_id,
         name=name,
+        email=email,
         rent_amount=rent_amount,
         deposit=deposit,
         is_owner=False,
         owner_id=current_user.id  # Set the owner_id to the current owner's ID
     )
     tenant.set_password(password)
+    assign_user_id(tenant)
     
     # Add tenant to database first to get the user_id
     db.session.add(tenant)
@@ -641,6 +1198,7 @@ def register_tenant(current_user):
             'id': tenant.id,
             'name': tenant.name,
             'tenant_id': tenant.tenant_id,
+            'email': tenant.email,
             'password': password,  # Send the generated password
             'deposit': tenant.deposit
         }
@@ -668,9 +1226,10 @@ def change_password(current_user):
         if len(new_password) < 8:
             return jsonify({'error': 'New password must be at least 8 characters long'}), 400
         
-        # Update password
+        # Update password, other logins of this user are signed out
         current_user.set_password(new_password)
         current_user.must_change_password = False
+        revoke_user(current_user.id, keep_session=g.token_claims.get('sid', ''))
         db.session.commit()
         
         return jsonify({
@@ -701,7 +1260,7 @@ def register_owner():
         return jsonify({'error': 'Missing name, email, or password'}), 400
 
     # Check if email already exists
-    if User.query.filter_by(email=email).first():
+    if route_to_user(email=email) and User.query.filter_by(email=email).first():
         return jsonify({'error': 'Email already registered'}), 400
 
     # Create new owner user
@@ -712,6 +1271,8 @@ def register_owner():
         rent_amount=0.0  # Owners don't pay rent
     )
     user.set_password(password)
+    # With sharding this also places the new account on a shard
+    assign_user_id(user)
     db.session.add(user)
     db.session.commit()
 
@@ -725,8 +1286,11 @@ def accept_payment(current_user, payment_id):
     payment = Payment.query.get(payment_id)
     if not payment:
         return jsonify({'error': 'Payment not found'}), 404
+    old_status = payment.status
     payment.status = 'completed'
+    record_status_change(payment, old_status)
     db.session.commit()
+    publish_event(payment.user, 'payment', {'id': payment.id, 'status': payment.status})
     return jsonify({'message': 'Payment accepted', 'status': payment.status})
 
 @app.route('/api/owner/payments/<int:payment_id>/reject', methods=['POST'])
@@ -737,10 +1301,59 @@ def reject_payment(current_user, payment_id):
     payment = Payment.query.get(payment_id)
     if not payment:
         return jsonify({'error': 'Payment not found'}), 404
+    old_status = payment.status
     payment.status = 'rejected'
+    record_status_change(payment, old_status)
     db.session.commit()
+    publish_event(payment.user, 'payment', {'id': payment.id, 'status': payment.status})
     return jsonify({'message': 'Payment rejected', 'status': payment.status})
 
+@app.route('/api/owner/payments/bulk', methods=['POST'])
+@token_required
+def bulk_update_payments(current_user):
+    if not current_user.is_owner:
+        return jsonify({'error': 'Unauthorized'}), 403
+    if not request.is_json:
+        return jsonify({'error': 'Missing JSON in request'}), 400
+
+    data = request.get_json()
+    status = data.get('status')
+    payment_ids = data.get('payment_ids')
+    if status not in ('completed', 'rejected'):
+        return jsonify({'error': 'Invalid status'}), 400
+    if not isinstance(payment_ids, list) or not payment_ids or not all(isinstance(i, int) for i in payment_ids):
+        return jsonify({'error': 'payment_ids must be a non-empty list of ids'}), 400
+    if len(payment_ids) > app.config['BULK_PAYMENT_MAX_IDS']:
+        return jsonify({'error': f"At most {app.config['BULK_PAYMENT_MAX_IDS']} payments per request"}), 400
+
+    # One query checks ownership of every id, payments of other owners look like missing ones
+    owned = {
+        payment_id: (user_id, amount, current_status)
+        for payment_id, user_id, amount, current_status
+        in db.session.query(Payment.id, Payment.user_id, Payment.amount, Payment.status)
+        .join(User, Payment.user_id == User.id)
+        .filter(Payment.id.in_(payment_ids), User.owner_id == current_user.id)
+    }
+    to_update = [pid for pid, (_, _, current_status) in owned.items() if current_status != status]
+    if to_update:
+        Payment.query.filter(Payment.id.in_(to_update)).update(
+            {Payment.status: status, Payment.updated_at: datetime.utcnow()},
+            synchronize_session=False
+        )
+        post_entries(payment_entries([(pid,) + owned[pid] for pid in to_update], status))
+        db.session.commit()
+        publish_payment_changes([(pid, owned[pid][0], current_user.id, status) for pid in to_update])
+
+    updated = set(to_update)
+    results = []
+    for payment_id in dict.fromkeys(payment_ids):
+        if payment_id not in owned:
+            results.append({'id': payment_id, 'outcome': 'not_found'})
+        else:
+            results.append({'id': payment_id, 'outcome': 'updated' if payment_id in updated else 'unchanged', 'status': status})
+
+    return jsonify({'updated': len(updated), 'results': results})
+
 @app.route('/api/owner/tenants/<int:tenant_id>', methods=['DELETE'])
 @token_required
 def delete_tenant(current_user, tenant_id):
@@ -749,11 +1362,10 @@ def delete_tenant(current_user, tenant_id):
     tenant = User.query.get(tenant_id)
     if not tenant or tenant.is_owner:
         return jsonify({'error': 'Tenant not found'}), 404
-    # Delete related meter readings and payments
-    MeterReading.query.filter_by(user_id=tenant.id).delete()
-    Payment.query.filter_by(user_id=tenant.id).delete()
-    db.session.delete(tenant)
+    revoke_user(tenant.id)
     db.session.commit()
+    # Move the tenant and their history into the archive tables
+    archive_tenant(tenant.id, app.config['ARCHIVE_BATCH_SIZE'])
     return jsonify({'message': 'Tenant deleted successfully'})
 
 @app.route('/api/maintenance-requests', methods=['POST'])
@@ -774,8 +1386,11 @@ def create_maintenance_request(current_user):
         status='pending'
     )
     db.session.add(new_request)
+    db.session.flush()
+    record_transition(new_request, None, g.owner_scope, current_user.id)
     db.session.commit()
     print("New MaintenanceRequest created with ID:", new_request.id, "created_at:", new_request.created_at)
+    publish_event(current_user, 'maintenance_request', {'id': new_request.id, 'status': new_request.status})
     return jsonify({
         'id': new_request.id,
         'tenantId': new_request.tenant_id,
@@ -792,39 +1407,59 @@ def get_all_maintenance_requests(current_user):
     if not current_user.is_owner:
         return jsonify({'error': 'Unauthorized'}), 403
 
-    # Get all tenants belonging to this owner
-    owner_tenants = User.query.filter_by(owner_id=current_user.id).all()
-    tenant_ids = [tenant.id for tenant in owner_tenants]
+    etag = compute_etag(tenants_state(current_user.id), maintenance_state(owner_tenant_ids(current_user.id)))
+    cached = not_modified(etag)
+    if cached:
+        return cached
 
     # Get maintenance requests only for owner's tenants
-    requests = MaintenanceRequest.query.filter(MaintenanceRequest.tenant_id.in_(tenant_ids)).order_by(MaintenanceRequest.created_at.desc()).all()
-    
-    return jsonify([{
-        'id': r.id,
-        'tenantId': r.tenant_id,
-        'tenantName': r.tenant.name if r.tenant else None,
-        'tenantUniqueId': r.tenant.tenant_id if r.tenant else None,
-        'title': r.title,
-        'description': r.description,
-        'priority': r.priority,
-        'status': r.status,
-        'ownerNotes': r.owner_notes,
-        'created_at': r.created_at.isoformat()
-    } for r in requests]), 200
+    requests = (owner_maintenance_serializer.query()
+                .join(User, MaintenanceRequest.tenant_id == User.id)
+                .filter(User.owner_id == current_user.id)
+                .order_by(MaintenanceRequest.created_at.desc()))
+
+    return with_etag(json_response(owner_maintenance_serializer.all(requests)), etag)
+
+@app.route('/api/maintenance-requests/owner/search', methods=['GET'])
+@token_required
+def search_maintenance_requests(current_user):
+    if not current_user.is_owner:
+        return jsonify({'error': 'Unauthorized'}), 403
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'Missing q'}), 400
+    limit = min(request.args.get('limit', 50, type=int), 200)
+    offset = request.args.get('offset', 0, type=int)
+
+    requests = (owner_maintenance_serializer.query()
+                .join(User, MaintenanceRequest.tenant_id == User.id)
+                .filter(User.owner_id == current_user.id))
+    for name, column in (('status', MaintenanceRequest.status), ('priority', MaintenanceRequest.priority),
+                         ('tenant_id', MaintenanceRequest.tenant_id)):
+        if request.args.get(name):
+            requests = requests.filter(column == request.args[name])
+    requests = search_maintenance(requests, current_user.id, query).limit(limit).offset(offset)
+    return json_response(owner_maintenance_serializer.all(requests))
+
+@app.route('/api/maintenance-requests/owner/stats', methods=['GET'])
+@token_required
+def get_maintenance_stats(current_user):
+    if not current_user.is_owner:
+        return jsonify({'error': 'Unauthorized'}), 403
+    return jsonify(owner_stats(current_user.id))
 
 @app.route('/api/maintenance-requests/tenant', methods=['GET'])
 @token_required
 def get_tenant_maintenance_requests(current_user):
-    requests = MaintenanceRequest.query.filter_by(tenant_id=current_user.id).order_by(MaintenanceRequest.created_at.desc()).all()
-    return jsonify([{
-        'id': r.id,
-        'tenantId': r.tenant_id,
-        'title': r.title,
-        'description': r.description,
-        'priority': r.priority,
-        'status': r.status,
-        'created_at': r.created_at.isoformat()
-    } for r in requests]), 200
+    etag = compute_etag(maintenance_state([current_user.id]))
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
+    requests = (tenant_maintenance_serializer.query()
+                .filter(MaintenanceRequest.tenant_id == current_user.id)
+                .order_by(MaintenanceRequest.created_at.desc()))
+    return with_etag(json_response(tenant_maintenance_serializer.all(requests)), etag)
 
 @app.route('/api/maintenance-requests/<int:request_id>', methods=['GET'])
 @token_required
@@ -858,12 +1493,15 @@ def update_maintenance_request(current_user, request_id):
     status = data.get('status')
     owner_notes = data.get('ownerNotes')
 
+    old_status = req.status
     if status:
         req.status = status
     if owner_notes is not None:
         req.owner_notes = owner_notes
 
+    record_transition(req, old_status, current_user.id, current_user.id)
     db.session.commit()
+    publish_event(req.tenant, 'maintenance_request', {'id': req.id, 'status': req.status, 'ownerNotes': req.owner_notes})
     return jsonify({
         'id': req.id,
         'tenantId': req.tenant_id,
@@ -875,6 +1513,24 @@ def update_maintenance_request(current_user, request_id):
         'created_at': req.created_at.isoformat()
     }), 200
 
+@app.route('/api/maintenance-requests/<int:request_id>/history', methods=['GET'])
+@token_required
+def get_maintenance_request_history(current_user, request_id):
+    r = MaintenanceRequest.query.get(request_id)
+    if not r:
+        return jsonify({'error': 'Request not found'}), 404
+    if not current_user.is_owner and r.tenant_id != current_user.id:
+        return jsonify({'error': 'Unauthorized'}), 403
+    transitions = (MaintenanceTransition.query
+                   .filter(MaintenanceTransition.request_id == request_id)
+                   .order_by(MaintenanceTransition.id))
+    return jsonify([{
+        'from': t.from_status,
+        'to': t.to_status,
+        'changedBy': t.changed_by,
+        'created_at': t.created_at.isoformat()
+    } for t in transitions])
+
 @app.route('/api/maintenance-requests/<int:request_id>/reject', methods=['POST'])
 @token_required
 def reject_maintenance_request(current_user, request_id):
@@ -886,7 +1542,9 @@ def reject_maintenance_request(current_user, request_id):
     if req.status != 'completed':
         return jsonify({'error': 'Can only reject completed requests'}), 400
     req.status = 'in_progress'
+    record_transition(req, 'completed', current_user.owner_id, current_user.id)
     db.session.commit()
+    publish_event(current_user, 'maintenance_request', {'id': req.id, 'status': req.status})
     return jsonify({'message': 'Maintenance completion rejected', 'status': req.status}), 200
 
 @app.route('/api/maintenance-requests/<int:request_id>/approve', methods=['PATCH', 'POST'])
@@ -900,11 +1558,35 @@ def approve_maintenance_request(current_user, request_id):
     if req.status != 'completed':
         return jsonify({'error': 'Can only approve completed requests'}), 400
     req.status = 'closed'
+    record_transition(req, 'completed', current_user.owner_id, current_user.id)
     db.session.commit()
+    publish_event(current_user, 'maintenance_request', {'id': req.id, 'status': req.status})
     return jsonify({'message': 'Maintenance completion approved', 'status': req.status}), 200
 
+@app.route('/api/events', methods=['GET'])
+@token_required
+def event_stream(current_user):
+    channel = f"owner:{current_user.id}" if current_user.is_owner else f"tenant:{current_user.id}"
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+    heartbeat = app.config['EVENT_HEARTBEAT_SECONDS']
+
+    def generate():
+        yield f"retry: {heartbeat * 1000}\n\n"
+        for batch in event_broker.listen(channel, last_event_id, heartbeat):
+            yield format_sse(batch)
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # Stop nginx from buffering the stream
+    })
+
 # Password Reset Routes
 @app.route('/api/auth/forgot-password', methods=['POST'])
+@rate_limiter.limit('otp', account=json_field('email'))
 def forgot_password():
     try:
         data = request.get_json()
@@ -913,20 +1595,14 @@ def forgot_password():
         if not email:
             return jsonify({'message': 'Email is required'}), 400
             
-        user = User.query.filter_by(email=email).first()
+        user = User.query.filter_by(email=email).first() if route_to_user(email=email) else None
         if not user:
             return jsonify({'message': 'User with that email does not exist'}), 404
             
-        # Generate 6-digit OTP
-        otp = ''.join([str(random.randint(0, 9)) for _ in range(6)])
-        
-        # Store OTP and expiry in user record
-        user.reset_password_otp = otp
-        user.reset_password_expires = datetime.utcnow() + timedelta(minutes=5)
-        db.session.commit()
+        # Generate a 6-digit OTP, only its hash is stored
+        otp = issue_code(user, app.config['OTP_TTL_MINUTES'])
         
         # Send email with OTP using SendGrid
-        sg = SendGridAPIClient(SENDGRID_API_KEY)
         from_email = Email(SENDGRID_FROM_EMAIL)
         to_email = To(email)
         subject = "Password Reset OTP"
@@ -938,7 +1614,7 @@ def forgot_password():
                 <h2>Password Reset Request</h2>
                 <p>You are receiving this because you (or someone else) have requested to reset the password for your account.</p>
                 <p>Your OTP is: <strong>{otp}</strong></p>
-                <p>This OTP will expire in 5 minutes.</p>
+                <p>This OTP will expire in {app.config['OTP_TTL_MINUTES']} minutes.</p>
                 <p>If you did not request this, please ignore this email and your password will remain unchanged.</p>
                 <br>
                 <p>Best regards,<br>Your App Team</p>
@@ -952,7 +1628,7 @@ def forgot_password():
         
         Your OTP is: {otp}
         
-        This OTP will expire in 5 minutes.
+        This OTP will expire in {app.config['OTP_TTL_MINUTES']} minutes.
         
         If you did not request this, please ignore this email and your password will remain unchanged.
         """
@@ -967,16 +1643,13 @@ def forgot_password():
         )
         
         # Send the email
-        response = sg.send(message)
+        status_code = mail_transport.send(message.get())
         
-        if response.status_code == 202:
-            # Return both message and OTP in the response
-            return jsonify({
-                'message': 'OTP sent to your email',
-                'otp': otp  # Include OTP in response
-            }), 200
+        if status_code == 202:
+            # The code only travels by email, the app sends it back to verify-otp
+            return jsonify({'message': 'OTP sent to your email'}), 200
         else:
-            app.logger.error(f"SendGrid error: {response.status_code}")
+            app.logger.error(f"SendGrid error: {status_code}")
             return jsonify({'message': 'Failed to send OTP email'}), 500
         
     except Exception as e:
@@ -992,16 +1665,14 @@ def verify_otp():
         
         if not email or not otp:
             return jsonify({'message': 'Email and OTP are required'}), 400
+        if not route_to_user(email=email):
+            return jsonify({'message': 'Invalid or expired OTP'}), 400
             
-        user = User.query.filter_by(
-            email=email,
-            reset_password_otp=otp,
-            reset_password_expires=datetime.utcnow()
-        ).first()
-        
-        if not user:
+        record = find_code(email)
+        if not record or not check_code(record, otp, app.config['OTP_MAX_ATTEMPTS']):
             return jsonify({'message': 'Invalid or expired OTP'}), 400
             
+        mark_verified(record, app.config['OTP_VERIFIED_WINDOW_MINUTES'])
         return jsonify({'verified': True}), 200
         
     except Exception as e:
@@ -1015,17 +1686,24 @@ def reset_password():
         email = data.get('email')
         new_password = data.get('newPassword')
         
-        if not email or not new_password:
-            return jsonify({'message': 'Email and new password are required'}), 400
+        otp = data.get('otp')
+        
+        if not email or not otp or not new_password:
+            return jsonify({'message': 'Email, OTP and new password are required'}), 400
             
-        user = User.query.filter_by(email=email).first()
+        user = User.query.filter_by(email=email).first() if route_to_user(email=email) else None
         if not user:
             return jsonify({'message': 'User not found'}), 404
+
+        # The code is checked again even after verify-otp accepted it, knowing the email is not enough
+        record = find_code(email)
+        if not record or not check_code(record, otp, app.config['OTP_MAX_ATTEMPTS']):
+            return jsonify({'message': 'Invalid or expired OTP'}), 400
             
-        # Update password
+        # Update password, the code cannot be used again and every login is signed out
         user.set_password(new_password)
-        user.reset_password_otp = None
-        user.reset_password_expires = None
+        db.session.delete(record)
+        revoke_user(user.id)
         db.session.commit()
         
         return jsonify({'message': 'Password has been reset successfully'}), 200
@@ -1036,5 +1714,6 @@ def reset_password():
 
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
+        create_schema()
+    start_background_jobs()
     app.run(host='0.0.0.0', port=5000) 
\ No newline at end of file
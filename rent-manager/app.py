@@ -2,6 +2,10 @@ from flask import Flask, render_template, request, redirect, url_for, flash, jso
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from werkzeug.utils import secure_filename
 from models import db, User, MeterReading, Payment, ElectricityRate, WaterBill
+from db_config import configure_database
+from idempotency import idempotent, stripe_idempotency_options
+from ledger import record_status_change
+from archive import archive_tenant
 from datetime import datetime
 import os
 from dotenv import load_dotenv
@@ -14,8 +18,13 @@ load_dotenv()
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'default-secret-key')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///rentmanager.db')
+configure_database(app)
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
 stripe.api_key = os.getenv('STRIPE_API_KEY')
+# Point at a local stand-in such as stripe-mock during development
+stripe.api_base = os.getenv('STRIPE_API_BASE', stripe.api_base)
+# Stored responses for repeated Idempotency-Key headers
+app.config['IDEMPOTENCY_KEY_TTL_HOURS'] = int(os.getenv('IDEMPOTENCY_KEY_TTL_HOURS', 24))
 
 # Initialize extensions
 db.init_app(app)
@@ -440,6 +449,7 @@ def upload_reading():
                 amount_per_tenant = total_usage / (total_tenants + 1)
             
             water_bill = WaterBill(
+                owner_id=current_user.owner_id,
                 total_amount=total_usage,
                 billing_date=datetime.now(),
                 total_tenants=total_tenants,
@@ -453,6 +463,7 @@ def upload_reading():
 
 @app.route('/create_payment', methods=['POST'])
 @login_required
+@idempotent
 def create_payment():
     payment_method = request.json.get('payment_method', 'card')
     if payment_method not in ['card', 'cash', 'bank_transfer']:
@@ -502,7 +513,8 @@ def create_payment():
             payment_intent = stripe.PaymentIntent.create(
                 amount=int(total_amount * 100),  # Convert to cents
                 currency='inr',
-                metadata={'user_id': current_user.id}
+                metadata={'user_id': current_user.id},
+                **stripe_idempotency_options()
             )
             payment.stripe_payment_id = payment_intent.id
             db.session.add(payment)
@@ -534,7 +546,9 @@ def confirm_payment(payment_id):
         return jsonify({'error': 'Unauthorized'}), 403
     
     payment = Payment.query.get_or_404(payment_id)
+    old_status = payment.status
     payment.status = 'confirmed'
+    record_status_change(payment, old_status)
     db.session.commit()
     
     # After successful confirmation, redirect back to owner dashboard
@@ -547,7 +561,9 @@ def reject_payment(payment_id):
         return jsonify({'error': 'Unauthorized'}), 403
     
     payment = Payment.query.get_or_404(payment_id)
+    old_status = payment.status
     payment.status = 'rejected'
+    record_status_change(payment, old_status)
     db.session.commit()
     
     # After successful rejection, redirect back to owner dashboard
@@ -560,7 +576,9 @@ def payment_success():
     if payment_intent_id:
         payment = Payment.query.filter_by(stripe_payment_id=payment_intent_id).first()
         if payment:
+            old_status = payment.status
             payment.status = 'completed'
+            record_status_change(payment, old_status)
             db.session.commit()
             flash('Payment successful!')
     return redirect(url_for('tenant_dashboard'))
@@ -580,17 +598,11 @@ def delete_tenant(tenant_id):
         flash('Cannot delete owner account')
         return redirect(url_for('owner_dashboard'))
     
-    # Delete associated meter readings
-    MeterReading.query.filter_by(user_id=tenant.id).delete()
+    # Move the tenant and their history into the archive tables
+    name = tenant.name
+    archive_tenant(tenant.id)
     
-    # Delete associated payments
-    Payment.query.filter_by(user_id=tenant.id).delete()
-    
-    # Delete tenant
-    db.session.delete(tenant)
-    db.session.commit()
-    
-    flash(f'Tenant {tenant.name} has been deleted')
+    flash(f'Tenant {name} has been deleted')
     return redirect(url_for('owner_dashboard'))
 
 @app.route('/change_password', methods=['GET', 'POST'])
@@ -0,0 +1,125 @@
+import heapq
+from datetime import datetime, timedelta
+from sqlalchemy import DateTime, and_, case, func, literal, select, union_all
+from models import (db, User, MeterReading, Payment, MaintenanceRequest, Invoice, BalanceEntry, IdempotencyKey,
+                    RefreshToken, archived_user, archived_meter_reading, archived_payment,
+                    archived_maintenance_request, archived_invoice, archived_balance_entry)
+from maintenance_stats import release_open_requests
+from notifications import remove_recipient
+from sync import record_deletions
+
+def move_rows(hot, archived, condition, batch_size=1000):
+    """Move matching rows into the archive table, one committed INSERT ... SELECT and DELETE per batch.
+
+    Each batch is atomic, so an interrupted move can simply be run again.
+    """
+    moved = 0
+    while True:
+        ids = [row_id for row_id, in db.session.execute(
+            select(hot.c.id).where(condition).order_by(hot.c.id).limit(batch_size))]
+        if not ids:
+            return moved
+        archived_at = literal(datetime.utcnow(), DateTime)
+        db.session.execute(archived.insert().from_select(
+            [c.name for c in hot.columns] + ['archived_at'],
+            select(*hot.columns, archived_at).where(hot.c.id.in_(ids))
+        ))
+        # Synced clients learn about the rows leaving the hot tables from their tombstones
+        record_deletions(hot, ids)
+        db.session.execute(hot.delete().where(hot.c.id.in_(ids)))
+        db.session.commit()
+        moved += len(ids)
+
+def archive_tenant(tenant_id, batch_size=1000):
+    """Move a tenant and all of their history into the archive tables.
+
+    Every row referencing the tenant moves before the tenant row, which goes last,
+    so a tenant that is still listed can be archived again to finish an interrupted run.
+    Login tokens, stored idempotent responses and notification recipients are not
+    history and are deleted with the tenant row.
+    """
+    readings, payments, requests, invoices, entries, users = (
+        MeterReading.__table__, Payment.__table__, MaintenanceRequest.__table__, Invoice.__table__,
+        BalanceEntry.__table__, User.__table__)
+    move_rows(readings, archived_meter_reading, readings.c.user_id == tenant_id, batch_size)
+    move_rows(payments, archived_payment, payments.c.user_id == tenant_id, batch_size)
+    # Committed with the first batch of requests, their closing history stays counted
+    release_open_requests(tenant_id)
+    move_rows(requests, archived_maintenance_request, requests.c.tenant_id == tenant_id, batch_size)
+    move_rows(invoices, archived_invoice, invoices.c.user_id == tenant_id, batch_size)
+    move_rows(entries, archived_balance_entry, entries.c.user_id == tenant_id, batch_size)
+    RefreshToken.query.filter(RefreshToken.user_id == tenant_id).delete(synchronize_session=False)
+    IdempotencyKey.query.filter(IdempotencyKey.user_id == tenant_id).delete(synchronize_session=False)
+    remove_recipient(tenant_id)
+    db.session.commit()
+    move_rows(users, archived_user, users.c.id == tenant_id, batch_size)
+
+def archive_cold_history(retention_days, batch_size=1000):
+    """Move readings and settled payments older than the retention window"""
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+
+    readings = MeterReading.__table__
+    meter = (readings.c.user_id, readings.c.meter_type)
+    # Dashboards and billing compare the two latest reading dates, those are always kept hot.
+    # keep_from is the second latest date of each meter, everything before it may move.
+    latest = select(*meter, func.max(readings.c.reading_date).label('latest')).group_by(*meter).subquery()
+    keep = (select(*meter, func.max(readings.c.reading_date).label('keep_from'))
+            .join(latest, and_(latest.c.user_id == readings.c.user_id,
+                               latest.c.meter_type == readings.c.meter_type,
+                               readings.c.reading_date < latest.c.latest))
+            .group_by(*meter)
+            .subquery())
+    movable = db.session.execute(
+        select(keep.c.user_id, keep.c.meter_type, keep.c.keep_from)
+        .join(readings, and_(readings.c.user_id == keep.c.user_id, readings.c.meter_type == keep.c.meter_type))
+        .where(readings.c.reading_date < keep.c.keep_from, readings.c.reading_date < cutoff)
+        .group_by(keep.c.user_id, keep.c.meter_type, keep.c.keep_from)
+    ).all()
+    # Boundaries are found once per run, each meter then moves through its user_id index
+    moved_readings = 0
+    for user_id, meter_type, keep_from in movable:
+        moved_readings += move_rows(readings, archived_meter_reading,
+                                    and_(readings.c.user_id == user_id, readings.c.meter_type == meter_type,
+                                         readings.c.reading_date < min(keep_from, cutoff)), batch_size)
+
+    # Pending payments can still be accepted, rejected or reconciled
+    payments = Payment.__table__
+    moved_payments = move_rows(payments, archived_payment,
+                               and_(payments.c.payment_date < cutoff, payments.c.status != 'pending'), batch_size)
+    return moved_readings, moved_payments
+
+def all_users():
+    """Live and archived users, for joining archived rows to their tenant"""
+    columns = ('id', 'tenant_id', 'name', 'owner_id')
+    users = User.__table__
+    return union_all(
+        select(*(users.c[name] for name in columns)),
+        select(*(archived_user.c[name] for name in columns))
+    ).subquery('all_users')
+
+def archived_readings_query(owner_id):
+    """Archived readings in the shape of owner_reading_serializer"""
+    users = all_users()
+    readings = archived_meter_reading
+    return (db.session.query(readings.c.id, users.c.tenant_id, users.c.name, readings.c.meter_type,
+                             readings.c.reading_value, readings.c.reading_date, readings.c.image_path)
+            .join(users, readings.c.user_id == users.c.id)
+            .filter(users.c.owner_id == owner_id)
+            .order_by(readings.c.reading_date.desc()))
+
+def archived_payments_query(owner_id):
+    """Archived payments in the shape of owner_payment_serializer"""
+    users = all_users()
+    payments = archived_payment
+    reference = case((payments.c.payment_method == 'card', payments.c.stripe_payment_id),
+                     else_=payments.c.transaction_reference)
+    return (db.session.query(payments.c.id, users.c.tenant_id, users.c.name, payments.c.amount,
+                             payments.c.payment_date, payments.c.status, payments.c.payment_method, reference)
+            .join(users, payments.c.user_id == users.c.id)
+            .filter(users.c.owner_id == owner_id)
+            .order_by(payments.c.payment_date.desc()))
+
+def merge_newest_first(serializer, date_key, *queries):
+    """Merge listings that are each sorted newest first"""
+    return list(heapq.merge(*(serializer.all(query) for query in queries),
+                            key=lambda row: row[date_key], reverse=True))
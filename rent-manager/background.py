@@ -0,0 +1,44 @@
+import threading
+from models import db
+
+class PeriodicJob:
+    """Runs func inside an app context every interval seconds on a daemon thread"""
+
+    def __init__(self, app, name, interval, func):
+        self.app = app
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+
+    def wake(self):
+        """Run the job now instead of waiting for the next interval"""
+        self.wakeup.set()
+
+    def run_once(self):
+        with self.app.app_context():
+            try:
+                return self.func()
+            except Exception as e:
+                db.session.rollback()
+                self.app.logger.error(f"Error in background job {self.name}: {str(e)}")
+            finally:
+                db.session.remove()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.run_once()
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
@@ -0,0 +1,60 @@
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# A scratch database, api.py reads DATABASE_URL when it is imported
+WORK_DIR = tempfile.mkdtemp(prefix='rent-manager-benchmark-')
+os.environ.update({'DATABASE_URL': 'sqlite:///' + os.path.join(WORK_DIR, 'benchmark.db'), 'SHARD_URIS': ''})
+
+from api import app
+from models import db, User, MeterReading, OwnerElectricityRate, Invoice
+from billing import run_billing
+
+def populate(owners, tenants_per_owner, readings_per_meter):
+    """Owners with their rates, tenants and monthly readings of both meters, inserted in bulk"""
+    now = datetime.utcnow()
+    db.session.execute(User.__table__.insert(), [
+        {'id': owner_id, 'email': f"owner{owner_id}@example.com", 'password_hash': '-', 'name': f"Owner {owner_id}",
+         'is_owner': True, 'billing_day': 1, 'balance': 0.0, 'created_at': now, 'updated_at': now}
+        for owner_id in range(1, owners + 1)
+    ])
+    db.session.execute(OwnerElectricityRate.__table__.insert(), [
+        {'owner_id': owner_id, 'rate_per_unit': 8.0, 'effective_from': now - timedelta(days=365), 'created_at': now}
+        for owner_id in range(1, owners + 1)
+    ])
+    tenant_ids = range(owners + 1, owners + owners * tenants_per_owner + 1)
+    db.session.execute(User.__table__.insert(), [
+        {'id': user_id, 'tenant_id': f"{user_id:06d}", 'password_hash': '-', 'name': f"Tenant {user_id}",
+         'is_owner': False, 'rent_amount': 1000.0, 'owner_id': 1 + (user_id - owners - 1) // tenants_per_owner,
+         'billing_day': 1, 'balance': 0.0, 'created_at': now, 'updated_at': now}
+        for user_id in tenant_ids
+    ])
+    for meter_type, step in (('electricity', 100.0), ('water', 10.0)):
+        db.session.execute(MeterReading.__table__.insert(), [
+            {'user_id': user_id, 'reading_value': step * (month + 1), 'meter_type': meter_type,
+             'reading_date': now - timedelta(days=30 * (readings_per_meter - month)), 'image_path': '-',
+             'is_processed': True, 'created_at': now, 'updated_at': now}
+            for user_id in tenant_ids for month in range(readings_per_meter)
+        ])
+    db.session.commit()
+    return list(range(1, owners + 1))
+
+def benchmark(owners=100, tenants_per_owner=100, readings_per_meter=4):
+    with app.app_context():
+        db.create_all()
+        owner_ids = populate(owners, tenants_per_owner, readings_per_meter)
+        readings = MeterReading.query.count()
+        started = time.perf_counter()
+        invoices = run_billing(owner_ids, datetime.utcnow().strftime('%Y-%m'))
+        elapsed = time.perf_counter() - started
+        assert len(invoices) == Invoice.query.count() == owners * tenants_per_owner
+        print(f"{owners * tenants_per_owner} tenants across {owners} owners, {readings} readings: "
+              f"{len(invoices)} invoices in {elapsed:.2f} s ({len(invoices) / elapsed:,.0f} invoices/s)")
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (1, 4):
+        print("Usage: python benchmark_billing.py [<owners> <tenants_per_owner> <readings_per_meter>]")
+        sys.exit(1)
+    benchmark(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,160 @@
+import calendar
+from datetime import datetime
+from sqlalchemy import bindparam, func
+from models import db, User, MeterReading, OwnerElectricityRate, Invoice, BillingRun
+from ledger import post_entries, invoice_entries
+
+def billing_period(day):
+    return day.strftime('%Y-%m')
+
+def due_owner_ids(today):
+    """Owners whose billing day has arrived this month and who have not been billed yet"""
+    period = billing_period(today)
+    billed = db.session.query(BillingRun.owner_id).filter(
+        BillingRun.period == period, BillingRun.completed_at.isnot(None)
+    )
+    query = db.session.query(User.id).filter(User.is_owner == True, ~User.id.in_(billed))
+    # Billing days past the end of a short month fall on its last day
+    if today.day < calendar.monthrange(today.year, today.month)[1]:
+        query = query.filter(User.billing_day <= today.day)
+    return [owner_id for owner_id, in query]
+
+def latest_readings(owner_ids):
+    """Map (user_id, meter_type) to [latest, previous] values for every tenant of the owners.
+
+    dense_rank over the reading date gives the same "previous" as the
+    dashboards, the newest reading strictly older than the latest one.
+    """
+    rank = func.dense_rank().over(
+        partition_by=(MeterReading.user_id, MeterReading.meter_type),
+        order_by=MeterReading.reading_date.desc()
+    ).label('rank')
+    ranked = (db.session.query(MeterReading.user_id, MeterReading.meter_type, MeterReading.reading_value, rank)
+              .join(User, MeterReading.user_id == User.id)
+              .filter(User.owner_id.in_(owner_ids))
+              .subquery())
+    readings = {}
+    for user_id, meter_type, value, position in db.session.query(ranked).filter(ranked.c.rank <= 2):
+        pair = readings.setdefault((user_id, meter_type), [None, None])
+        if pair[position - 1] is None:
+            pair[position - 1] = value
+    return readings
+
+def current_rates(owner_ids):
+    rank = func.row_number().over(
+        partition_by=OwnerElectricityRate.owner_id,
+        order_by=(OwnerElectricityRate.effective_from.desc(), OwnerElectricityRate.id.desc())
+    ).label('rank')
+    ranked = (db.session.query(OwnerElectricityRate.owner_id, OwnerElectricityRate.rate_per_unit, rank)
+              .filter(OwnerElectricityRate.owner_id.in_(owner_ids))
+              .subquery())
+    return {owner_id: rate for owner_id, rate in
+            db.session.query(ranked.c.owner_id, ranked.c.rate_per_unit).filter(ranked.c.rank == 1)}
+
+def billed_readings(owner_ids, period):
+    """Map (user_id, meter_type) to the meter value each tenant's latest earlier invoice was billed up to"""
+    rank = func.row_number().over(partition_by=Invoice.user_id, order_by=Invoice.period.desc()).label('rank')
+    ranked = (db.session.query(Invoice.user_id, Invoice.electricity_reading, Invoice.water_reading, rank)
+              .filter(Invoice.owner_id.in_(owner_ids), Invoice.period < period)
+              .subquery())
+    billed = {}
+    for user_id, electricity, water, _ in db.session.query(ranked).filter(ranked.c.rank == 1):
+        billed[(user_id, 'electricity')] = electricity
+        billed[(user_id, 'water')] = water
+    return billed
+
+def consumption(pair, billed_up_to=None):
+    """Units since the value the last invoice was billed up to, or between the two latest readings.
+
+    Without a new reading the latest value is the billed one and nothing is charged.
+    """
+    if not pair or pair[0] is None:
+        return None
+    start = billed_up_to if billed_up_to is not None else pair[1]
+    return None if start is None else pair[0] - start
+
+def closing_value(pair):
+    return pair[0] if pair else None
+
+def build_invoices(period, tenants, readings, rates, tenant_counts, billed=None):
+    """Compute every tenant's dues in one pass, using the same formulas as tenant_dashboard"""
+    billed = billed or {}
+    rows = []
+    for user_id, owner_id, rent in tenants:
+        rate = rates.get(owner_id)
+        electricity_pair, water_pair = readings.get((user_id, 'electricity')), readings.get((user_id, 'water'))
+        electricity_units = consumption(electricity_pair, billed.get((user_id, 'electricity')))
+        water_units = consumption(water_pair, billed.get((user_id, 'water')))
+        electricity = round(electricity_units * rate, 2) if electricity_units is not None and rate else 0
+        water = round((water_units / (tenant_counts[owner_id] + 1)) * rate, 2) if water_units is not None and rate else 0
+        rows.append({
+            'owner_id': owner_id,
+            'user_id': user_id,
+            'period': period,
+            'rent_amount': rent,
+            'electricity_units': electricity_units,
+            'electricity_amount': electricity,
+            'water_units': water_units,
+            'water_amount': water,
+            'rate_per_unit': rate,
+            'total_amount': rent + electricity + water,
+            'electricity_reading': closing_value(electricity_pair),
+            'water_reading': closing_value(water_pair),
+            'created_at': datetime.utcnow(),
+        })
+    return rows
+
+def bill_owners(owner_ids, period):
+    """Create missing invoices for one batch of owners in a single transaction"""
+    started = {owner_id for owner_id, in db.session.query(BillingRun.owner_id).filter(
+        BillingRun.owner_id.in_(owner_ids), BillingRun.period == period)}
+    new_runs = [{'owner_id': owner_id, 'period': period, 'started_at': datetime.utcnow()}
+                for owner_id in owner_ids if owner_id not in started]
+    if new_runs:
+        db.session.execute(BillingRun.__table__.insert(), new_runs)
+
+    # Tenants invoiced by an interrupted earlier run are skipped, which makes the run resumable
+    invoiced = db.session.query(Invoice.user_id).filter(Invoice.owner_id.in_(owner_ids), Invoice.period == period)
+    tenants = (db.session.query(User.id, User.owner_id, User.rent_amount)
+               .filter(User.owner_id.in_(owner_ids), User.is_owner == False)
+               .all())
+    tenant_counts = {owner_id: 0 for owner_id in owner_ids}
+    for _, owner_id, _ in tenants:
+        tenant_counts[owner_id] += 1
+    already_invoiced = {user_id for user_id, in invoiced}
+    pending = [t for t in tenants if t[0] not in already_invoiced]
+
+    rows = build_invoices(period, pending, latest_readings(owner_ids), current_rates(owner_ids), tenant_counts,
+                          billed_readings(owner_ids, period))
+    if rows:
+        db.session.execute(Invoice.__table__.insert(), rows)
+        # Charge the new invoices to the tenants' balances in the same transaction
+        created_invoices = (db.session.query(Invoice.id, Invoice.user_id, Invoice.total_amount)
+                            .filter(Invoice.owner_id.in_(owner_ids), Invoice.period == period,
+                                    Invoice.user_id.in_([row['user_id'] for row in rows]))
+                            .all())
+        post_entries(invoice_entries(created_invoices))
+
+    created = {owner_id: 0 for owner_id in owner_ids}
+    for row in rows:
+        created[row['owner_id']] += 1
+    runs = BillingRun.__table__
+    db.session.execute(
+        runs.update()
+        .where(runs.c.owner_id == bindparam('run_owner_id'), runs.c.period == period)
+        .values(completed_at=datetime.utcnow(), invoices_created=runs.c.invoices_created + bindparam('created')),
+        [{'run_owner_id': owner_id, 'created': count} for owner_id, count in created.items()]
+    )
+    db.session.commit()
+    return rows
+
+def run_billing(owner_ids, period, batch_size=200):
+    """Bill the owners in batches, each batch commits on its own"""
+    invoices = []
+    for start in range(0, len(owner_ids), batch_size):
+        invoices.extend(bill_owners(owner_ids[start:start + batch_size], period))
+    return invoices
+
+def run_due_billing(today=None, batch_size=200):
+    today = today or datetime.now().date()
+    return run_billing(due_owner_ids(today), billing_period(today), batch_size)
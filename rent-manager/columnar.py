@@ -0,0 +1,163 @@
+import os
+from datetime import datetime
+from itertools import groupby
+from sqlalchemy import func, select, union_all
+from models import db, MeterReading, archived_meter_reading
+from archive import all_users
+from receivables import month_of
+
+# pyarrow is optional, without it analytics read the database for every month
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+def all_readings():
+    """Live and archived readings with their owner"""
+    users = all_users()
+    live, archived = MeterReading.__table__, archived_meter_reading
+
+    def columns(table):
+        return users.c.owner_id, table.c.user_id, table.c.meter_type, table.c.reading_value, table.c.reading_date
+
+    return union_all(
+        select(*columns(live)).join(users, live.c.user_id == users.c.id),
+        select(*columns(archived)).join(users, archived.c.user_id == users.c.id)
+    ).subquery('readings')
+
+def partition_path(data_dir, owner_id, month):
+    return os.path.join(data_dir, 'meter_readings', f"owner_id={owner_id}", f"month={month}", 'part.arrow')
+
+def partition_rows(path):
+    """Row count recorded when the partition was written, None if it does not exist"""
+    if not os.path.exists(path):
+        return None
+    with pyarrow.memory_map(path) as source:
+        return int(pyarrow.ipc.open_file(source).schema.metadata[b'rows'])
+
+def write_partition(path, rows):
+    schema = pyarrow.schema([
+        ('user_id', pyarrow.int64()),
+        ('meter_type', pyarrow.string()),
+        ('reading_value', pyarrow.float64()),
+        ('reading_date', pyarrow.timestamp('us')),
+    ], metadata={'rows': str(len(rows))})
+    table = pyarrow.Table.from_arrays([pyarrow.array(column, type=field.type)
+                                       for column, field in zip(zip(*rows), schema)], schema=schema)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    # Uncompressed IPC files can be memory-mapped and scanned without copying
+    with pyarrow.OSFile(tmp_path, 'wb') as sink:
+        with pyarrow.ipc.new_file(sink, schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+def export_closed_periods(data_dir, today=None):
+    """Write every closed month whose partition is missing or out of date, returns the partitions written.
+
+    Months before the current one are closed. A late reading for a closed month
+    changes its row count and the partition is rewritten on the next run.
+    """
+    if pyarrow is None:
+        return []
+    current = (today or datetime.now()).strftime('%Y-%m')
+    readings = all_readings()
+    month = month_of(readings.c.reading_date)
+    # Counted exactly as they are written below, readings without a value are left out of both
+    counts = (db.session.query(readings.c.owner_id, month, func.count())
+              .filter(readings.c.owner_id.isnot(None), month < current, readings.c.reading_value.isnot(None))
+              .group_by(readings.c.owner_id, month))
+
+    stale = {}
+    for owner_id, period, count in counts:
+        if partition_rows(partition_path(data_dir, owner_id, period)) != count:
+            stale.setdefault(owner_id, []).append(period)
+
+    written = []
+    for owner_id, periods in stale.items():
+        # One ordered query per owner, split into partitions as the rows stream in
+        rows = (db.session.query(month, readings.c.user_id, readings.c.meter_type, readings.c.reading_value,
+                                 readings.c.reading_date)
+                .filter(readings.c.owner_id == owner_id, month.in_(periods), readings.c.reading_value.isnot(None))
+                .order_by(month, readings.c.user_id, readings.c.meter_type, readings.c.reading_date))
+        for period, partition in groupby(rows, key=lambda row: row[0]):
+            write_partition(partition_path(data_dir, owner_id, period), [row[1:] for row in partition])
+            written.append((owner_id, period))
+    return written
+
+def month_range(first, last):
+    year, month = map(int, first.split('-'))
+    months = []
+    while f"{year:04d}-{month:02d}" <= last:
+        months.append(f"{year:04d}-{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+def previous_month(period):
+    year, month = map(int, period.split('-'))
+    return f"{year - 1:04d}-12" if month == 1 else f"{year:04d}-{month - 1:02d}"
+
+def scan_partition(path):
+    """Closing value per (user_id, meter_type) from one memory-mapped partition"""
+    with pyarrow.memory_map(path) as source:
+        table = pyarrow.ipc.open_file(source).read_all()
+        closing = table.group_by(['user_id', 'meter_type']).aggregate([('reading_value', 'max')])
+        return {(user_id, meter_type): value for user_id, meter_type, value in zip(
+            closing['user_id'].to_pylist(), closing['meter_type'].to_pylist(), closing['reading_value_max'].to_pylist())}
+
+def query_closing_values(owner_id, months):
+    """Closing value per (month, user_id, meter_type) from the database"""
+    readings = all_readings()
+    month = month_of(readings.c.reading_date)
+    rows = (db.session.query(month, readings.c.user_id, readings.c.meter_type, func.max(readings.c.reading_value))
+            .filter(readings.c.owner_id == owner_id, month.in_(months))
+            .group_by(month, readings.c.user_id, readings.c.meter_type))
+    closing = {period: {} for period in months}
+    for period, user_id, meter_type, value in rows:
+        if value is not None:
+            closing[period][(user_id, meter_type)] = value
+    return closing
+
+def monthly_consumption(owner_id, first, last, data_dir, today=None):
+    """Consumption per month and meter type between two YYYY-MM months.
+
+    Meters are cumulative, so a month's closing value is its highest reading
+    and consumption is the difference to the previous month's closing value.
+    Exported months are scanned from their partitions, the rest from the database.
+    """
+    current = (today or datetime.now()).strftime('%Y-%m')
+    months = month_range(previous_month(first), last)
+
+    closing, from_files, from_database = {}, [], []
+    for period in months:
+        path = partition_path(data_dir, owner_id, period)
+        if pyarrow is not None and period < current and os.path.exists(path):
+            closing[period] = scan_partition(path)
+            from_files.append(period)
+        else:
+            from_database.append(period)
+    if from_database:
+        closing.update(query_closing_values(owner_id, from_database))
+
+    result = []
+    last_seen = {}
+    for period in months:
+        totals = {'month': period, 'electricity': 0.0, 'water': 0.0, 'tenants': 0}
+        tenants = set()
+        for (user_id, meter_type), value in closing[period].items():
+            previous = last_seen.get((user_id, meter_type))
+            if previous is not None and meter_type in ('electricity', 'water'):
+                totals[meter_type] += value - previous
+                tenants.add(user_id)
+            last_seen[(user_id, meter_type)] = value
+        totals['tenants'] = len(tenants)
+        totals['electricity'] = round(totals['electricity'], 2)
+        totals['water'] = round(totals['water'], 2)
+        result.append(totals)
+
+    # The month before the range only provides the starting values
+    return {
+        'months': result[1:],
+        'sources': {'files': [m for m in from_files if m >= first], 'database': [m for m in from_database if m >= first]},
+    }
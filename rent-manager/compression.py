@@ -0,0 +1,125 @@
+import os
+import zlib
+from flask import request
+
+# brotli and zstandard are optional, encodings without a codec are never offered
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIBLE_TYPES = {'application/json', 'text/csv'}
+
+class GzipStream:
+    def __init__(self, level):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 31 writes a gzip header
+
+    def compress(self, chunk):
+        return self.compressor.compress(chunk)
+
+    def flush(self):
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush(zlib.Z_FINISH)
+
+class BrotliStream:
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, chunk):
+        return self.compressor.process(chunk)
+
+    def flush(self):
+        return self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+class ZstdStream:
+    def __init__(self, level):
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, chunk):
+        return self.compressor.compress(chunk)
+
+    def flush(self):
+        return self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self.compressor.flush()
+
+def available_encodings(app):
+    codecs = {'zstd': (ZstdStream, zstandard), 'br': (BrotliStream, brotli), 'gzip': (GzipStream, zlib)}
+    encodings = {}
+    for name in app.config['COMPRESSION_ENCODINGS']:
+        stream_class, module = codecs.get(name, (None, None))
+        if module is not None:
+            encodings[name] = (stream_class, app.config[f"COMPRESSION_{name.upper()}_LEVEL"])
+    return encodings
+
+def compress_body(data, stream):
+    return stream.compress(data) + stream.finish()
+
+def compress_chunks(chunks, stream, flush_bytes):
+    # Flush every flush_bytes of input so streamed exports keep moving without
+    # paying a flush per row
+    pending = 0
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        data = stream.compress(chunk)
+        pending += len(chunk)
+        if pending >= flush_bytes:
+            data += stream.flush()
+            pending = 0
+        if data:
+            yield data
+    yield stream.finish()
+
+def init_compression(app):
+    """Compress JSON and CSV responses with the best encoding the client accepts"""
+    # Encodings are listed in order of preference
+    app.config['COMPRESSION_ENCODINGS'] = os.getenv('COMPRESSION_ENCODINGS', 'zstd,br,gzip').split(',')
+    app.config['COMPRESSION_MIN_SIZE'] = int(os.getenv('COMPRESSION_MIN_SIZE', 1024))
+    app.config['COMPRESSION_STREAM_FLUSH_BYTES'] = int(os.getenv('COMPRESSION_STREAM_FLUSH_BYTES', 64 * 1024))
+    app.config['COMPRESSION_GZIP_LEVEL'] = int(os.getenv('COMPRESSION_GZIP_LEVEL', 6))
+    app.config['COMPRESSION_BR_LEVEL'] = int(os.getenv('COMPRESSION_BR_LEVEL', 4))
+    app.config['COMPRESSION_ZSTD_LEVEL'] = int(os.getenv('COMPRESSION_ZSTD_LEVEL', 3))
+    encodings = available_encodings(app)
+
+    @app.after_request
+    def compress_response(response):
+        if (response.mimetype not in COMPRESSIBLE_TYPES
+                or response.status_code < 200 or response.status_code in (204, 304)
+                or response.direct_passthrough
+                or 'Content-Encoding' in response.headers):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = request.accept_encodings.best_match(list(encodings))
+        if not encoding:
+            return response
+        stream_class, level = encodings[encoding]
+
+        if response.is_streamed:
+            response.response = compress_chunks(response.response, stream_class(level),
+                                                 app.config['COMPRESSION_STREAM_FLUSH_BYTES'])
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < app.config['COMPRESSION_MIN_SIZE']:
+                return response
+            response.set_data(compress_body(data, stream_class(level)))
+
+        response.headers['Content-Encoding'] = encoding
+        # The encoded bytes differ from the identity body, so the validator becomes weak
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
@@ -0,0 +1,61 @@
+import hashlib
+from flask import request, make_response
+from sqlalchemy import func, true
+from models import db, User, MeterReading, Payment, MaintenanceRequest, OwnerElectricityRate, Invoice
+
+# Each *_state helper returns a one-row aggregate query describing a scope.
+# Any insert, update or delete in the scope changes at least one of the values.
+
+def owner_tenant_ids(owner_id):
+    return db.session.query(User.id).filter(User.owner_id == owner_id)
+
+def tenants_state(owner_id):
+    # updated_at catches edits to a tenant's name, phone, rent or balance
+    return db.session.query(
+        func.max(User.id), func.max(User.updated_at), func.count(User.id)
+    ).filter(User.owner_id == owner_id)
+
+def readings_state(user_ids):
+    return db.session.query(func.max(MeterReading.id), func.count(MeterReading.id)).filter(MeterReading.user_id.in_(user_ids))
+
+def payments_state(user_ids):
+    return db.session.query(
+        func.max(Payment.id), func.max(Payment.updated_at), func.count(Payment.id)
+    ).filter(Payment.user_id.in_(user_ids))
+
+def maintenance_state(user_ids):
+    return db.session.query(
+        func.max(MaintenanceRequest.id), func.max(MaintenanceRequest.updated_at), func.count(MaintenanceRequest.id)
+    ).filter(MaintenanceRequest.tenant_id.in_(user_ids))
+
+def invoices_state(owner_id):
+    return db.session.query(func.max(Invoice.id), func.count(Invoice.id)).filter(Invoice.owner_id == owner_id)
+
+def rate_state(owner_id):
+    return db.session.query(func.max(OwnerElectricityRate.id)).filter(OwnerElectricityRate.owner_id == owner_id)
+
+def compute_etag(*states, extra=()):
+    """Fetch all scope aggregates in a single statement and hash them"""
+    subqueries = [state.subquery() for state in states]
+    query = db.session.query(*subqueries).select_from(subqueries[0])
+    for subquery in subqueries[1:]:
+        # Every aggregate yields exactly one row, so the cross join stays one row
+        query = query.join(subquery, true())
+    row = query.one()
+    version = '|'.join(str(value) for value in tuple(row) + tuple(extra))
+    return hashlib.sha1(version.encode()).hexdigest()
+
+def not_modified(etag):
+    """Return a 304 response when the client already holds this version"""
+    if request.if_none_match.contains_weak(etag):
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
+    return None
+
+def with_etag(response, etag):
+    response = make_response(response)
+    response.set_etag(etag)
+    # Clients may store the body but must revalidate before using it
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
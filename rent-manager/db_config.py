@@ -0,0 +1,98 @@
+import os
+import sqlite3
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Pragmas applied to every new SQLite connection, filled in by configure_database
+sqlite_pragmas = {}
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in sqlite_pragmas.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+def load_database_settings(app):
+    """Read engine tuning settings from the environment into app.config"""
+    defaults = {
+        'SQLITE_JOURNAL_MODE': 'WAL',
+        'SQLITE_SYNCHRONOUS': 'NORMAL',
+        'SQLITE_BUSY_TIMEOUT_MS': 5000,
+        'SQLITE_MMAP_SIZE': 256 * 1024 * 1024,
+        'SQLITE_CACHE_SIZE_KB': 64 * 1024,
+        'DB_POOL_SIZE': 10,
+        'DB_MAX_OVERFLOW': 20,
+        'DB_POOL_TIMEOUT': 30,
+        'DB_POOL_RECYCLE': 1800,
+        'DB_POOL_PRE_PING': True,
+        'DB_STATEMENT_TIMEOUT_MS': 15000,
+        'DB_LOCK_TIMEOUT_MS': 5000,
+    }
+    for key, default in defaults.items():
+        value = os.getenv(key)
+        if value is None:
+            app.config.setdefault(key, default)
+        elif isinstance(default, bool):
+            app.config[key] = value.lower() in ('1', 'true', 'yes')
+        elif isinstance(default, int):
+            app.config[key] = int(value)
+        else:
+            app.config[key] = value
+
+def engine_options(config):
+    """Build SQLALCHEMY_ENGINE_OPTIONS for the configured database"""
+    uri = config['SQLALCHEMY_DATABASE_URI']
+    if uri.startswith('sqlite'):
+        # Let the driver wait on a locked database instead of failing immediately
+        return {'connect_args': {'timeout': config['SQLITE_BUSY_TIMEOUT_MS'] / 1000.0}}
+
+    options = {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+    }
+    if uri.startswith('postgresql'):
+        options['connect_args'] = {
+            'options': f"-c statement_timeout={config['DB_STATEMENT_TIMEOUT_MS']} -c lock_timeout={config['DB_LOCK_TIMEOUT_MS']}",
+        }
+    return options
+
+def normalize_uri(uri):
+    if uri.startswith('postgres://'):
+        return uri.replace('postgres://', 'postgresql://', 1)
+    return uri
+
+def configure_database(app):
+    """Apply engine settings to the app config, must run before db.init_app"""
+    load_database_settings(app)
+
+    # Heroku style URLs are rejected by SQLAlchemy 1.4+
+    app.config['SQLALCHEMY_DATABASE_URI'] = normalize_uri(app.config['SQLALCHEMY_DATABASE_URI'])
+    # Optional read replica, read-only requests are routed to it (see routing.py)
+    replica_uri = os.getenv('SQLALCHEMY_REPLICA_URI')
+    if replica_uri:
+        app.config.setdefault('SQLALCHEMY_BINDS', {})['replica'] = normalize_uri(replica_uri)
+    # Optional per-owner sharding, SHARD_URIS is a comma separated list of name=uri.
+    # The main database then only holds the shard directory (see sharding.py).
+    app.config['SHARDS'] = []
+    for entry in filter(None, os.getenv('SHARD_URIS', '').split(',')):
+        name, shard_uri = entry.strip().split('=', 1)
+        app.config['SHARDS'].append(name)
+        app.config.setdefault('SQLALCHEMY_BINDS', {})[f"shard:{name}"] = normalize_uri(shard_uri)
+    # Longest a background job may hold a shard, moving an owner waits at most this long for jobs
+    app.config['SHARD_JOB_LEASE_SECONDS'] = int(os.getenv('SHARD_JOB_LEASE_SECONDS', 600))
+
+    sqlite_pragmas.update({
+        'journal_mode': app.config['SQLITE_JOURNAL_MODE'],
+        'synchronous': app.config['SQLITE_SYNCHRONOUS'],
+        'busy_timeout': app.config['SQLITE_BUSY_TIMEOUT_MS'],
+        'mmap_size': app.config['SQLITE_MMAP_SIZE'],
+        'cache_size': -app.config['SQLITE_CACHE_SIZE_KB'],  # Negative value is a size in KiB
+        'temp_store': 'MEMORY',
+    })
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
@@ -0,0 +1,88 @@
+import json
+import threading
+from collections import deque
+
+class EventBroker:
+    """In-process pub/sub for Server-Sent Events.
+
+    Every channel keeps a bounded replay buffer so clients reconnecting with
+    Last-Event-ID receive what they missed. Subscribers block on a condition
+    owned by their channel, so a publish only wakes the listeners of the
+    channels it targets.
+
+    Limits: each open stream holds one server thread for as long as it is
+    connected, so the number of clients is bounded by the threads the server
+    will run, not by memory. Events only reach streams connected to the
+    process that published them; this fits the single `python api.py`
+    process pm2 runs, several worker processes would need a shared broker.
+    """
+
+    def __init__(self, buffer_size=200):
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()
+        self.last_id = 0
+        self.buffers = {}
+        self.conditions = {}
+        # Highest event id dropped from each channel's buffer
+        self.evicted = {}
+
+    def condition(self, channel):
+        cond = self.conditions.get(channel)
+        if cond is None:
+            cond = self.conditions[channel] = threading.Condition(self.lock)
+        return cond
+
+    def publish(self, channels, event, data):
+        payload = json.dumps(data)
+        with self.lock:
+            self.last_id += 1
+            for channel in channels:
+                buffer = self.buffers.setdefault(channel, deque())
+                if len(buffer) >= self.buffer_size:
+                    self.evicted[channel] = buffer.popleft()[0]
+                buffer.append((self.last_id, event, payload))
+                if channel in self.conditions:
+                    self.conditions[channel].notify_all()
+        return self.last_id
+
+    def events_after(self, channel, last_id):
+        """Buffered events newer than last_id, or None when the client missed events we no longer hold"""
+        if last_id > self.last_id or last_id < self.evicted.get(channel, 0):
+            return None
+        return [e for e in self.buffers.get(channel, ()) if e[0] > last_id]
+
+    def listen(self, channel, last_id=None, heartbeat=15):
+        """Yield batches of (id, event, data); an empty batch means a heartbeat is due"""
+        with self.lock:
+            if last_id is None:
+                last_id = self.last_id
+            pending = self.events_after(channel, last_id)
+            newest = self.last_id
+        if pending is None:
+            # Tell the client to refetch everything instead of resuming
+            yield [(newest, 'reset', '{}')]
+            last_id = newest
+        elif pending:
+            yield pending
+            last_id = pending[-1][0]
+
+        while True:
+            with self.lock:
+                pending = self.events_after(channel, last_id)
+                if pending == []:
+                    self.condition(channel).wait(heartbeat)
+                    pending = self.events_after(channel, last_id)
+                # Read with pending, an event published after the reset is not skipped
+                newest = self.last_id
+            if pending is None:
+                yield [(newest, 'reset', '{}')]
+                last_id = newest
+                continue
+            if pending:
+                last_id = pending[-1][0]
+            yield pending
+
+def format_sse(batch):
+    if not batch:
+        return ': keep-alive\n\n'
+    return ''.join(f"id: {event_id}\nevent: {event}\ndata: {data}\n\n" for event_id, event, data in batch)
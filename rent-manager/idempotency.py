@@ -0,0 +1,122 @@
+import hashlib
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import current_app, g, jsonify, make_response, request
+from flask_login import current_user as session_user
+from sqlalchemy.exc import IntegrityError
+from models import db, User, IdempotencyKey
+
+# How long a claimed key blocks duplicates before the claim is considered abandoned
+CLAIM_TIMEOUT = timedelta(seconds=60)
+
+_locks = {}
+_locks_guard = threading.Lock()
+
+@contextmanager
+def key_lock(name):
+    """Serialize requests with the same key inside this process"""
+    with _locks_guard:
+        entry = _locks.setdefault(name, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _locks_guard:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _locks[name]
+
+def request_fingerprint():
+    body = request.get_data() or b''
+    return hashlib.sha256(request.method.encode() + request.path.encode() + b'\n' + body).hexdigest()
+
+def find_key(user_id, key):
+    return IdempotencyKey.query.filter(
+        IdempotencyKey.user_id == user_id,
+        IdempotencyKey.key == key,
+        IdempotencyKey.expires_at > datetime.utcnow()
+    ).first()
+
+def claim_key(user_id, key, fingerprint):
+    """Insert an in-progress record, returns None if another worker holds the key"""
+    now = datetime.utcnow()
+    # Expired records (including abandoned claims) would block the unique constraint
+    IdempotencyKey.query.filter(IdempotencyKey.expires_at <= now).delete(synchronize_session=False)
+    record = IdempotencyKey(user_id=user_id, key=key, request_hash=fingerprint, expires_at=now + CLAIM_TIMEOUT)
+    db.session.add(record)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return None
+    return record
+
+def replay(record):
+    response = current_app.response_class(record.response_body, status=record.status_code, mimetype=record.content_type)
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+def stripe_idempotency_options():
+    """Extra arguments for Stripe calls so retries never create a second object"""
+    key = g.get('idempotency_key')
+    return {'idempotency_key': key} if key else {}
+
+def idempotent(f):
+    """Replay the stored response when a request repeats its Idempotency-Key header.
+
+    Goes below token_required (the user is the first argument) or after
+    login_required (the user comes from the session).
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return f(*args, **kwargs)
+        if len(key) > 255:
+            return jsonify({'error': 'Idempotency-Key is too long'}), 400
+
+        user = args[0] if args and isinstance(args[0], User) else session_user
+        fingerprint = request_fingerprint()
+
+        with key_lock((user.id, key)):
+            record = find_key(user.id, key)
+            if record is None:
+                record = claim_key(user.id, key, fingerprint)
+                if record is None:
+                    record = find_key(user.id, key)
+                    if record is None:
+                        return jsonify({'error': 'Could not reserve Idempotency-Key, please retry'}), 409
+                else:
+                    return run_and_store(f, args, kwargs, record, f"{user.id}:{key}")
+
+            if record.request_hash != fingerprint:
+                return jsonify({'error': 'Idempotency-Key was already used for a different request'}), 422
+            if record.status_code is None:
+                return jsonify({'error': 'A request with this Idempotency-Key is still in progress'}), 409
+            return replay(record)
+
+    return decorated
+
+def run_and_store(f, args, kwargs, record, stripe_key):
+    g.idempotency_key = stripe_key
+    try:
+        response = make_response(f(*args, **kwargs))
+    except Exception:
+        db.session.rollback()
+        db.session.delete(record)
+        db.session.commit()
+        raise
+
+    if 200 <= response.status_code < 300:
+        record.status_code = response.status_code
+        record.content_type = response.mimetype
+        record.response_body = response.get_data(as_text=True)
+        record.expires_at = datetime.utcnow() + timedelta(hours=current_app.config['IDEMPOTENCY_KEY_TTL_HOURS'])
+    else:
+        # Failures are not stored so the client can retry with the same key
+        db.session.delete(record)
+    db.session.commit()
+    return response
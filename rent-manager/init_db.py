@@ -1,11 +1,13 @@
 from app import app, db
 from models import User, ElectricityRate
+from search import ensure_search_index
 from datetime import datetime
 
 def init_database():
     with app.app_context():
         # Create all tables
         db.create_all()
+        ensure_search_index(db.engine)
         
         # Set initial electricity rate only
         rate = ElectricityRate.query.first()
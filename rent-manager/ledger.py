@@ -0,0 +1,88 @@
+from datetime import datetime
+from sqlalchemy import bindparam, func, select, union_all
+from models import db, User, Payment, Invoice, BalanceEntry, archived_payment
+from receivables import COLLECTED_STATUSES
+
+# Differences below half a cent are float noise, not drift
+DRIFT_TOLERANCE = 0.005
+
+def post_entries(entries):
+    """Append journal entries and apply them to the balance snapshots.
+
+    Does not commit, callers post in the same transaction as the change
+    that caused the entries.
+    """
+    if not entries:
+        return
+    now = datetime.utcnow()
+    db.session.execute(BalanceEntry.__table__.insert(), [
+        {'user_id': e['user_id'], 'amount': e['amount'], 'reason': e['reason'],
+         'invoice_id': e.get('invoice_id'), 'payment_id': e.get('payment_id'), 'created_at': now}
+        for e in entries
+    ])
+
+    deltas = {}
+    for e in entries:
+        deltas[e['user_id']] = deltas.get(e['user_id'], 0.0) + e['amount']
+    users = User.__table__
+    # Relative updates keep concurrent postings for the same tenant from overwriting each other
+    db.session.execute(
+        users.update()
+        .where(users.c.id == bindparam('balance_user_id'))
+        .values(balance=users.c.balance + bindparam('delta')),
+        [{'balance_user_id': user_id, 'delta': delta} for user_id, delta in deltas.items()]
+    )
+
+def invoice_entries(invoices):
+    """Entries for (invoice_id, user_id, total_amount) rows"""
+    return [{'user_id': user_id, 'amount': total, 'reason': 'invoice', 'invoice_id': invoice_id}
+            for invoice_id, user_id, total in invoices]
+
+def payment_entries(payments, new_status):
+    """Entries for (payment_id, user_id, amount, old_status) rows moving to new_status"""
+    entries = []
+    paid = new_status in COLLECTED_STATUSES
+    for payment_id, user_id, amount, old_status in payments:
+        was_paid = old_status in COLLECTED_STATUSES
+        if paid and not was_paid:
+            entries.append({'user_id': user_id, 'amount': -amount, 'reason': 'payment', 'payment_id': payment_id})
+        elif was_paid and not paid:
+            entries.append({'user_id': user_id, 'amount': amount, 'reason': 'reversal', 'payment_id': payment_id})
+    return entries
+
+def record_status_change(payment, old_status):
+    """Post the balance effect of a single payment whose status was just changed in the session"""
+    post_entries(payment_entries([(payment.id, payment.user_id, payment.amount, old_status)], payment.status))
+
+def expected_balances():
+    """Recompute every tenant's balance from invoices and paid payments with two GROUP BYs"""
+    invoiced = (db.session.query(Invoice.user_id, func.sum(Invoice.total_amount).label('total'))
+                .group_by(Invoice.user_id).subquery())
+    payments = Payment.__table__
+    # Archived payments of active tenants still count towards their balance
+    all_payments = union_all(
+        select(payments.c.user_id, payments.c.amount, payments.c.status),
+        select(archived_payment.c.user_id, archived_payment.c.amount, archived_payment.c.status)
+    ).subquery()
+    paid = (db.session.query(all_payments.c.user_id, func.sum(all_payments.c.amount).label('total'))
+            .filter(all_payments.c.status.in_(COLLECTED_STATUSES))
+            .group_by(all_payments.c.user_id).subquery())
+    return (db.session.query(User.id, User.balance,
+                             func.coalesce(invoiced.c.total, 0) - func.coalesce(paid.c.total, 0))
+            .outerjoin(invoiced, invoiced.c.user_id == User.id)
+            .outerjoin(paid, paid.c.user_id == User.id)
+            .filter(User.is_owner == False))
+
+def verify_balances(repair=False):
+    """Compare the snapshots with a full recomputation, returns (user_id, stored, expected) for drifted tenants.
+
+    With repair, an adjustment entry brings each drifted tenant back in line,
+    which is also how balances are backfilled for existing tenants.
+    """
+    drift = [(user_id, stored, round(expected, 2)) for user_id, stored, expected in expected_balances()
+             if abs((stored or 0.0) - expected) > DRIFT_TOLERANCE]
+    if repair and drift:
+        post_entries([{'user_id': user_id, 'amount': expected - (stored or 0.0), 'reason': 'adjustment'}
+                      for user_id, stored, expected in drift])
+        db.session.commit()
+    return drift
@@ -0,0 +1,41 @@
+import json
+import os
+import threading
+import uuid
+from sendgrid import SendGridAPIClient
+
+class SendGridTransport:
+    """Posts v3 mail/send bodies to SendGrid, returns the HTTP status code"""
+
+    def __init__(self, api_key):
+        self.client = SendGridAPIClient(api_key)
+
+    def send(self, payload):
+        return self.client.send(payload).status_code
+
+class LocalTransport:
+    """Keeps sent bodies in memory, and as JSON files when outbox_dir is set, instead of emailing.
+
+    For development and tests: the last bodies are in outbox and every call is accepted.
+    """
+
+    def __init__(self, outbox_dir=None, keep=1000):
+        self.outbox_dir = outbox_dir
+        self.keep = keep
+        self.outbox = []
+        self.lock = threading.Lock()
+        if outbox_dir:
+            os.makedirs(outbox_dir, exist_ok=True)
+
+    def send(self, payload):
+        with self.lock:
+            self.outbox = self.outbox[-(self.keep - 1):] + [payload]
+        if self.outbox_dir:
+            with open(os.path.join(self.outbox_dir, f"{uuid.uuid4().hex}.json"), 'w') as f:
+                json.dump(payload, f, indent=2)
+        return 202
+
+def make_transport(kind, api_key=None, outbox_dir=None):
+    if kind == 'local':
+        return LocalTransport(outbox_dir)
+    return SendGridTransport(api_key)
@@ -0,0 +1,169 @@
+from bisect import bisect_left
+from datetime import datetime
+from sqlalchemy import func, select, union_all
+from sqlalchemy.dialects import postgresql, sqlite
+from models import db, User, MaintenanceRequest, MaintenanceTransition, MaintenanceCounter, archived_maintenance_request
+
+OPEN_STATUSES = ('pending', 'in_progress')
+DONE_STATUSES = ('completed', 'closed')
+# Upper bounds in hours of the time-to-close histogram, the p90 is read from it
+CLOSE_HOUR_BUCKETS = (1, 2, 4, 8, 12, 24, 36, 48, 72, 96, 120, 168, 240, 336, 504, 720)
+# Counter names: open:<priority>, closed, close_seconds, reopened, and close_le:<hours> per bucket
+
+def bucket_name(hours):
+    index = bisect_left(CLOSE_HOUR_BUCKETS, hours)
+    return f"close_le:{CLOSE_HOUR_BUCKETS[index] if index < len(CLOSE_HOUR_BUCKETS) else 'inf'}"
+
+def transition_deltas(priority, old_status, new_status, created_at, changed_at):
+    """Counter changes for one request moving from old_status (None when created) to new_status"""
+    deltas = {}
+    was_open, is_open = old_status in OPEN_STATUSES, new_status in OPEN_STATUSES
+    if was_open != is_open:
+        deltas[f"open:{priority}"] = 1 if is_open else -1
+    if was_open and new_status in DONE_STATUSES:
+        seconds = max((changed_at - created_at).total_seconds(), 0.0)
+        deltas['closed'] = 1
+        deltas['close_seconds'] = seconds
+        deltas[bucket_name(seconds / 3600)] = 1
+    elif old_status in DONE_STATUSES and is_open:
+        deltas['reopened'] = 1
+    return deltas
+
+def apply_deltas(owner_id, deltas):
+    """Add deltas to an owner's counters with relative upserts, the caller commits"""
+    rows = [{'owner_id': owner_id, 'name': name, 'value': delta} for name, delta in deltas.items() if delta]
+    if not rows:
+        return
+    counters = MaintenanceCounter.__table__
+    dialect = db.session.get_bind(MaintenanceCounter.__mapper__).dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        insert = (sqlite if dialect == 'sqlite' else postgresql).insert(counters)
+        # Relative updates keep concurrent transitions of the same owner from overwriting each other
+        db.session.execute(insert.on_conflict_do_update(
+            index_elements=[counters.c.owner_id, counters.c.name],
+            set_={'value': counters.c.value + insert.excluded.value}
+        ), rows)
+        return
+    for row in rows:
+        updated = db.session.execute(
+            counters.update()
+            .where(counters.c.owner_id == owner_id, counters.c.name == row['name'])
+            .values(value=counters.c.value + row['value'])
+        ).rowcount
+        if not updated:
+            db.session.execute(counters.insert(), row)
+
+def record_transition(req, old_status, owner_id, changed_by):
+    """Log a status change of a request already flushed to the session and update the counters.
+
+    Requests of a tenant without an owner belong to no owner's stats and are not logged.
+    Does not commit, callers record in the same transaction as the change.
+    """
+    if old_status == req.status or owner_id is None:
+        return
+    now = datetime.utcnow()
+    db.session.add(MaintenanceTransition(request_id=req.id, owner_id=owner_id, from_status=old_status,
+                                         to_status=req.status, changed_by=changed_by, created_at=now))
+    apply_deltas(owner_id, transition_deltas(req.priority, old_status, req.status, req.created_at, now))
+
+def release_open_requests(tenant_id):
+    """Take a tenant's open requests out of the counters before they are archived, the caller commits"""
+    owner_id = db.session.query(User.owner_id).filter(User.id == tenant_id).scalar()
+    if owner_id is None:
+        return
+    deltas = {}
+    for priority, count in (db.session.query(MaintenanceRequest.priority, func.count(MaintenanceRequest.id))
+                            .filter(MaintenanceRequest.tenant_id == tenant_id,
+                                    MaintenanceRequest.status.in_(OPEN_STATUSES))
+                            .group_by(MaintenanceRequest.priority)):
+        deltas[f"open:{priority}"] = -count
+    apply_deltas(owner_id, deltas)
+
+def percentile_hours(buckets, fraction):
+    """Estimate a percentile from histogram counts by bucket name, interpolating inside the bucket"""
+    total = sum(buckets.values())
+    if not total:
+        return None
+    target = total * fraction
+    seen, lower = 0.0, 0.0
+    for upper in CLOSE_HOUR_BUCKETS:
+        count = buckets.get(f"close_le:{upper}", 0.0)
+        if count and seen + count >= target:
+            return round(lower + (upper - lower) * (target - seen) / count, 2)
+        seen, lower = seen + count, upper
+    # Beyond the last bucket there is no upper bound to interpolate to
+    return float(CLOSE_HOUR_BUCKETS[-1])
+
+def owner_stats(owner_id):
+    """Maintenance SLA metrics of an owner, read from the counters with one indexed query"""
+    counters = dict(db.session.query(MaintenanceCounter.name, MaintenanceCounter.value)
+                    .filter(MaintenanceCounter.owner_id == owner_id))
+    open_by_priority = {name[5:]: int(value) for name, value in counters.items()
+                        if name.startswith('open:') and value}
+    closed = int(counters.get('closed', 0))
+    reopened = int(counters.get('reopened', 0))
+    return {
+        'open': open_by_priority,
+        'open_total': sum(open_by_priority.values()),
+        'closed': closed,
+        'reopened': reopened,
+        'reopen_rate': round(reopened / closed, 4) if closed else None,
+        'avg_hours_to_close': round(counters.get('close_seconds', 0.0) / closed / 3600, 2) if closed else None,
+        'p90_hours_to_close': percentile_hours({name: value for name, value in counters.items()
+                                                if name.startswith('close_le:')}, 0.9),
+    }
+
+def expected_counters():
+    """Recompute every owner's counters: open requests from the table, closing history from the log"""
+    expected = {}
+    def add(owner_id, deltas):
+        totals = expected.setdefault(owner_id, {})
+        for name, delta in deltas.items():
+            totals[name] = totals.get(name, 0.0) + delta
+
+    for owner_id, priority, count in (db.session.query(User.owner_id, MaintenanceRequest.priority,
+                                                       func.count(MaintenanceRequest.id))
+                                      .join(User, User.id == MaintenanceRequest.tenant_id)
+                                      .filter(MaintenanceRequest.status.in_(OPEN_STATUSES), User.owner_id.isnot(None))
+                                      .group_by(User.owner_id, MaintenanceRequest.priority)):
+        add(owner_id, {f"open:{priority}": count})
+
+    requests = MaintenanceRequest.__table__
+    # Requests of deleted tenants keep counting towards the closing history
+    created = union_all(
+        select(requests.c.id, requests.c.priority, requests.c.created_at),
+        select(archived_maintenance_request.c.id, archived_maintenance_request.c.priority,
+               archived_maintenance_request.c.created_at)
+    ).subquery()
+    log = MaintenanceTransition.__table__
+    for owner_id, old_status, new_status, changed_at, priority, created_at in db.session.execute(
+            select(log.c.owner_id, log.c.from_status, log.c.to_status, log.c.created_at,
+                   created.c.priority, created.c.created_at)
+            .join(created, created.c.id == log.c.request_id)
+            .where(log.c.from_status.in_(OPEN_STATUSES + DONE_STATUSES))):
+        add(owner_id, {name: delta for name, delta in
+                       transition_deltas(priority, old_status, new_status, created_at, changed_at).items()
+                       if not name.startswith('open:')})
+    return expected
+
+def verify_counters():
+    """Bring the counters in line with a full recomputation, returns (owner_id, name, stored, expected) that drifted.
+
+    The first run also backfills the open counts of requests created before the log existed.
+    """
+    expected = expected_counters()
+    stored = {}
+    for owner_id, name, value in db.session.query(MaintenanceCounter.owner_id, MaintenanceCounter.name,
+                                                  MaintenanceCounter.value):
+        stored.setdefault(owner_id, {})[name] = value
+    drift = []
+    for owner_id in set(expected) | set(stored):
+        want, have = expected.get(owner_id, {}), stored.get(owner_id, {})
+        deltas = {}
+        for name in set(want) | set(have):
+            if abs(want.get(name, 0.0) - have.get(name, 0.0)) > 0.5:
+                deltas[name] = want.get(name, 0.0) - have.get(name, 0.0)
+                drift.append((owner_id, name, have.get(name, 0.0), want.get(name, 0.0)))
+        apply_deltas(owner_id, deltas)
+    db.session.commit()
+    return drift
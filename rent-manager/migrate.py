@@ -0,0 +1,107 @@
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import DateTime, func, inspect, literal, select
+from api import app
+from models import db, User, MeterReading, Payment, WaterBill, Invoice
+from sharding import sharding_enabled, shard_engine, global_tables, shard_tables, create_schema, across_shards
+from ledger import verify_balances
+
+def databases():
+    """(name, engine, tables) for every database, split the way create_schema splits them"""
+    if not sharding_enabled():
+        return [('main', db.engine, db.metadata.sorted_tables)]
+    return [('main', db.engine, global_tables())] + [
+        (name, shard_engine(name), shard_tables()) for name in current_app.config['SHARDS']
+    ]
+
+def add_column_sql(column, dialect):
+    """ALTER TABLE ... ADD COLUMN for a model column, with its scalar default applied to existing rows"""
+    preparer = dialect.identifier_preparer
+    sql = (f"ALTER TABLE {preparer.format_table(column.table)} "
+           f"ADD COLUMN {preparer.format_column(column)} {column.type.compile(dialect=dialect)}")
+    default = column.default
+    if default is not None and default.is_scalar:
+        value = literal(default.arg, column.type).compile(dialect=dialect, compile_kwargs={'literal_binds': True})
+        sql += f" DEFAULT {value}"
+        if not column.nullable:
+            sql += " NOT NULL"
+    for foreign_key in column.foreign_keys:
+        target = foreign_key.column
+        sql += f" REFERENCES {preparer.format_table(target.table)} ({preparer.format_column(target)})"
+    return sql
+
+def backfill_invoice_readings(connection):
+    """Earlier invoices were billed up to the latest reading recorded when they were created"""
+    invoices, readings = Invoice.__table__, MeterReading.__table__
+    for meter_type, column in (('electricity', 'electricity_reading'), ('water', 'water_reading')):
+        latest = (select(readings.c.reading_value)
+                  .where(readings.c.user_id == invoices.c.user_id, readings.c.meter_type == meter_type,
+                         readings.c.created_at <= invoices.c.created_at)
+                  .order_by(readings.c.reading_date.desc(), readings.c.id.desc())
+                  .limit(1)
+                  .scalar_subquery())
+        connection.execute(invoices.update().values({column: latest}))
+
+def backfill_water_bill_owners(connection):
+    """Earlier water bills belong to the only owner; with several owners they cannot be told apart and stay unassigned"""
+    users, bills = User.__table__, WaterBill.__table__
+    owners = connection.execute(select(users.c.id).where(users.c.is_owner == True).limit(2)).scalars().all()
+    if len(owners) == 1:
+        connection.execute(bills.update().where(bills.c.owner_id.is_(None)).values(owner_id=owners[0]))
+
+def backfill_updated_at(model):
+    """Rows from before updated_at count as last changed when they were created"""
+    def backfill(connection):
+        table = model.__table__
+        connection.execute(table.update().where(table.c.updated_at.is_(None))
+                           .values(updated_at=func.coalesce(table.c.created_at, literal(datetime.utcnow(), DateTime))))
+    return backfill
+
+# Run in one transaction with the ALTER TABLE that added the column, in this order
+BACKFILLS = [
+    (('invoice', 'electricity_reading'), backfill_invoice_readings),
+    (('water_bill', 'owner_id'), backfill_water_bill_owners),
+    (('user', 'updated_at'), backfill_updated_at(User)),
+    (('meter_reading', 'updated_at'), backfill_updated_at(MeterReading)),
+    (('payment', 'updated_at'), backfill_updated_at(Payment)),
+]
+
+def upgrade_database(engine, tables):
+    """Add the model columns and indexes missing from existing tables, returns the (table, column) pairs added"""
+    inspector = inspect(engine)
+    existing = set(inspector.get_table_names())
+    added = []
+    with engine.begin() as connection:
+        for table in tables:
+            if table.name not in existing:
+                continue
+            present = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in present:
+                    connection.exec_driver_sql(add_column_sql(column, engine.dialect))
+                    added.append((table.name, column.name))
+            indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(connection)
+        for key, backfill in BACKFILLS:
+            if key in added:
+                backfill(connection)
+    return added
+
+def migrate(log=print):
+    """Create missing tables, then bring the existing ones up to the models. Safe to run again."""
+    with app.app_context():
+        create_schema()
+        added = []
+        for name, engine, tables in databases():
+            database_added = upgrade_database(engine, tables)
+            added.extend(database_added)
+            log(f"{name}: " + (', '.join(f"{table}.{column}" for table, column in database_added) or 'up to date'))
+        if ('user', 'balance') in added:
+            # New balances start at 0, adjustment entries bring them to invoices minus paid payments
+            repaired = sum(len(drift) for drift in across_shards(lambda: verify_balances(repair=True)))
+            log(f"Backfilled {repaired} tenant balances")
+
+if __name__ == '__main__':
+    migrate()
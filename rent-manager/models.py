@@ -1,11 +1,11 @@
-from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 import random
 import string
+from routing import RoutingSQLAlchemy
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 def generate_tenant_id():
     # Generate a random 6-digit tenant ID
@@ -20,14 +20,14 @@ class User(UserMixin, db.Model):
     is_owner = db.Column(db.Boolean, default=False)
     rent_amount = db.Column(db.Float, nullable=False, default=0.0)
     deposit = db.Column(db.Float, nullable=True, default=0.0)
-    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)  # For tenants, this links to their owner
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True, index=True)  # For tenants, this links to their owner
     must_change_password = db.Column(db.Boolean, default=True)  # True if using default password
+    billing_day = db.Column(db.Integer, nullable=False, default=1)  # For owners, day of month invoices are generated
+    balance = db.Column(db.Float, nullable=False, default=0.0)  # For tenants, amount owed; kept in step with balance_entry
     meter_readings = db.relationship('MeterReading', backref='user', lazy=True)
     payments = db.relationship('Payment', backref='user', lazy=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    # Password reset fields
-    reset_password_otp = db.Column(db.String(6), nullable=True)
-    reset_password_expires = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     # Relationship for owner to access their tenants
     tenants = db.relationship('User', backref=db.backref('owner', remote_side=[id]), lazy=True)
 
@@ -75,17 +75,18 @@ class User(UserMixin, db.Model):
 
 class MeterReading(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     reading_value = db.Column(db.Float, nullable=True)
     reading_date = db.Column(db.DateTime, nullable=False)
     image_path = db.Column(db.String(200), nullable=False)
     is_processed = db.Column(db.Boolean, default=False)
     meter_type = db.Column(db.String(20), nullable=False)  # 'electricity' or 'water'
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
 class Payment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     amount = db.Column(db.Float, nullable=False)
     rent_component = db.Column(db.Float, default=0.0)
     electricity_component = db.Column(db.Float, default=0.0)
@@ -93,9 +94,10 @@ class Payment(db.Model):
     payment_date = db.Column(db.DateTime, nullable=False)
     payment_method = db.Column(db.String(20), nullable=False)
     status = db.Column(db.String(20), default='pending')
-    stripe_payment_id = db.Column(db.String(100))
+    stripe_payment_id = db.Column(db.String(100), index=True)
     transaction_reference = db.Column(db.String(100))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
 class ElectricityRate(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -114,6 +116,7 @@ class OwnerElectricityRate(db.Model):
 
 class WaterBill(db.Model):
     id = db.Column(db.Integer, primary_key=True)
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True, index=True)
     total_amount = db.Column(db.Float, nullable=False)
     billing_date = db.Column(db.DateTime, nullable=False)
     total_tenants = db.Column(db.Integer, nullable=False)
@@ -122,13 +125,201 @@ class WaterBill(db.Model):
 
 class MaintenanceRequest(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    tenant_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    tenant_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     title = db.Column(db.String(255), nullable=False)
     description = db.Column(db.Text, nullable=False)
     priority = db.Column(db.String(20), nullable=False)
     status = db.Column(db.String(20), default='pending')
     owner_notes = db.Column(db.Text, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=db.func.now(), onupdate=db.func.now())
+    # Python side timestamps keep sub-second resolution for change detection
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
-    tenant = db.relationship('User', backref='maintenance_requests') 
\ No newline at end of file
+    tenant = db.relationship('User', backref='maintenance_requests')
+
+# Append-only log of maintenance request status changes
+class MaintenanceTransition(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    request_id = db.Column(db.Integer, nullable=False, index=True)
+    owner_id = db.Column(db.Integer, nullable=False, index=True)
+    from_status = db.Column(db.String(20), nullable=True)  # Null for the creation of the request
+    to_status = db.Column(db.String(20), nullable=False)
+    changed_by = db.Column(db.Integer, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Running per-owner maintenance totals, named as in maintenance_stats.py
+class MaintenanceCounter(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    owner_id = db.Column(db.Integer, nullable=False)
+    name = db.Column(db.String(40), nullable=False)
+    value = db.Column(db.Float, nullable=False, default=0.0)
+
+    __table_args__ = (db.UniqueConstraint('owner_id', 'name', name='uq_maintenance_counter_owner_name'),)
+
+class IdempotencyKey(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    key = db.Column(db.String(255), nullable=False)
+    request_hash = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer, nullable=True)  # Null while the first request is still running
+    content_type = db.Column(db.String(100), nullable=True)
+    response_body = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    __table_args__ = (db.UniqueConstraint('user_id', 'key', name='uq_idempotency_user_key'),)
+
+class PasswordResetCode(db.Model):
+    # At most one live code per user, see otp.py
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False, unique=True)
+    code_hash = db.Column(db.String(64), nullable=False)  # HMAC of the code, never the code itself
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    verified_at = db.Column(db.DateTime, nullable=True)  # Set by verify-otp, which also extends expires_at
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+class StripeEvent(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    event_id = db.Column(db.String(100), unique=True, nullable=False)
+    event_type = db.Column(db.String(100), nullable=False)
+    payment_intent_id = db.Column(db.String(100), nullable=True)
+    intent_status = db.Column(db.String(50), nullable=True)
+    payload = db.Column(db.Text, nullable=False)
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+    processed_at = db.Column(db.DateTime, nullable=True, index=True)
+
+class Invoice(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    period = db.Column(db.String(7), nullable=False)  # YYYY-MM
+    rent_amount = db.Column(db.Float, nullable=False, default=0.0)
+    electricity_units = db.Column(db.Float, nullable=True)
+    electricity_amount = db.Column(db.Float, nullable=False, default=0.0)
+    water_units = db.Column(db.Float, nullable=True)
+    water_amount = db.Column(db.Float, nullable=False, default=0.0)
+    rate_per_unit = db.Column(db.Float, nullable=True)
+    total_amount = db.Column(db.Float, nullable=False)
+    # Meter values billed up to, the next invoice charges consumption from here
+    electricity_reading = db.Column(db.Float, nullable=True)
+    water_reading = db.Column(db.Float, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'period', name='uq_invoice_user_period'),
+        db.Index('ix_invoice_owner_period', 'owner_id', 'period'),
+    )
+
+class BillingRun(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    period = db.Column(db.String(7), nullable=False)
+    invoices_created = db.Column(db.Integer, nullable=False, default=0)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    completed_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (db.UniqueConstraint('owner_id', 'period', name='uq_billing_run_owner_period'),)
+
+class Notification(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    subject = db.Column(db.String(255), nullable=False)
+    message = db.Column(db.Text, nullable=False)  # Template with {{variable}} placeholders
+    status = db.Column(db.String(20), nullable=False, default='queued')  # 'queued', 'sending', 'sent' or 'failed'
+    total = db.Column(db.Integer, nullable=False, default=0)
+    sent_count = db.Column(db.Integer, nullable=False, default=0)
+    failed_count = db.Column(db.Integer, nullable=False, default=0)
+    attempts = db.Column(db.Integer, nullable=False, default=0)  # Failed calls in a row
+    last_error = db.Column(db.Text, nullable=True)
+    claimed_until = db.Column(db.DateTime, nullable=True)  # A worker is sending until then
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    completed_at = db.Column(db.DateTime, nullable=True)
+
+class NotificationRecipient(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    notification_id = db.Column(db.Integer, db.ForeignKey('notification.id'), nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    email = db.Column(db.String(120), nullable=False)
+    variables = db.Column(db.Text, nullable=False)  # JSON of the tenant's values when the notification was created
+    status = db.Column(db.String(20), nullable=False, default='pending')  # 'pending', 'sent' or 'failed'
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (db.Index('ix_notification_recipient_notification_status', 'notification_id', 'status'),)
+
+# Rows deleted from the lists /api/sync serves, kept for SYNC_TOMBSTONE_DAYS
+class Tombstone(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(30), nullable=False)  # Key of the list in the sync response
+    row_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False, index=True)  # Tenant the row belonged to
+    owner_id = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    __table_args__ = (db.Index('ix_tombstone_owner_deleted', 'owner_id', 'deleted_at'),)
+
+class ShardDirectory(db.Model):
+    owner_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    shard = db.Column(db.String(50), nullable=False, index=True)
+    state = db.Column(db.String(20), nullable=False, default='active')  # 'active' or 'moving'
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class ShardJob(db.Model):
+    # A background job working on a shard, move_owner waits for these before copying rows
+    id = db.Column(db.Integer, primary_key=True)
+    shard = db.Column(db.String(50), nullable=False)
+    started_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)  # A job killed before removing its row stops counting here
+
+class UserDirectory(db.Model):
+    # Allocates user ids across all shards and keeps tenant ids and emails unique
+    id = db.Column(db.Integer, primary_key=True)
+    tenant_id = db.Column(db.String(6), unique=True, nullable=True)
+    email = db.Column(db.String(120), unique=True, nullable=True)
+    owner_id = db.Column(db.Integer, nullable=True, index=True)  # None for owners
+
+class RefreshToken(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    session_id = db.Column(db.String(32), nullable=False, index=True)  # Shared by every token of one login, also the access tokens' sid
+    token_hash = db.Column(db.String(64), unique=True, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    used_at = db.Column(db.DateTime, nullable=True)  # Set when rotated, presenting it again revokes the session
+    revoked_at = db.Column(db.DateTime, nullable=True)
+
+class TokenRevocation(db.Model):
+    # The id is the revocation version, workers poll for ids above the last one they applied
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    session_id = db.Column(db.String(32), nullable=True)  # None revokes every token of the user issued until created_at
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    # Old rows are deleted, SQLite must not hand their ids out again
+    __table_args__ = {'sqlite_autoincrement': True}
+
+class ReplicationHeartbeat(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    beat_at = db.Column(db.DateTime, nullable=False)  # Written on the primary, read back from the replica to measure lag
+
+class BalanceEntry(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    amount = db.Column(db.Float, nullable=False)  # Positive increases what the tenant owes
+    reason = db.Column(db.String(20), nullable=False)  # 'invoice', 'payment', 'reversal' or 'adjustment'
+    invoice_id = db.Column(db.Integer, nullable=True)
+    payment_id = db.Column(db.Integer, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+def archive_table(model, *indexed):
+    """Constraint-free copy of a model's table, for rows moved out of the hot tables"""
+    columns = [db.Column(c.name, c.type, primary_key=c.primary_key, autoincrement=False, index=c.name in indexed)
+               for c in model.__table__.columns]
+    return db.Table(f"archived_{model.__tablename__}", *columns, db.Column('archived_at', db.DateTime, nullable=False))
+
+archived_user = archive_table(User, 'owner_id')
+archived_meter_reading = archive_table(MeterReading, 'user_id')
+archived_payment = archive_table(Payment, 'user_id')
+archived_maintenance_request = archive_table(MaintenanceRequest, 'tenant_id')
+archived_invoice = archive_table(Invoice, 'user_id', 'owner_id')
+archived_balance_entry = archive_table(BalanceEntry, 'user_id')
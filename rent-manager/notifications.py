@@ -0,0 +1,199 @@
+import html
+import json
+import re
+from datetime import datetime, timedelta
+from sqlalchemy import func, or_
+from models import db, User, Notification, NotificationRecipient
+
+# SendGrid accepts at most this many personalizations in one mail/send call
+MAX_BATCH_SIZE = 1000
+PLACEHOLDER = re.compile(r'\{\{\s*(\w+)\s*\}\}')
+
+# Values a template can use, taken from each tenant when the notification is created
+VARIABLES = {
+    'name': lambda tenant: tenant.name,
+    'tenant_id': lambda tenant: tenant.tenant_id or '',
+    'rent_amount': lambda tenant: f"{tenant.rent_amount or 0.0:.2f}",
+    'balance': lambda tenant: f"{tenant.balance or 0.0:.2f}",
+}
+
+def unknown_variables(*templates):
+    return sorted({name for template in templates for name in PLACEHOLDER.findall(template)} - set(VARIABLES))
+
+def compile_template(template):
+    """Render a template once into text and HTML bodies whose placeholders are SendGrid substitution keys.
+
+    The text body uses {{name}} and the HTML body {{name:html}}, which is
+    given the HTML-escaped value.
+    """
+    text = PLACEHOLDER.sub(lambda m: f"{{{{{m.group(1)}}}}}", template)
+    pieces, last = [], 0
+    for match in PLACEHOLDER.finditer(template):
+        pieces.append(html.escape(template[last:match.start()]))
+        pieces.append(f"{{{{{match.group(1)}:html}}}}")
+        last = match.end()
+    pieces.append(html.escape(template[last:]))
+    body = ''.join(pieces).replace('\n', '<br>\n')
+    return text, f"<html>\n<body>\n<p>{body}</p>\n</body>\n</html>"
+
+def substitutions(variables):
+    values = {}
+    for name, value in variables.items():
+        values[f"{{{{{name}}}}}"] = value
+        values[f"{{{{{name}:html}}}}"] = html.escape(value)
+    return values
+
+def build_payload(notification, recipients, from_email, subject, text, html_body):
+    """One mail/send body for a batch of recipients, each with its own substitutions"""
+    personalizations = []
+    for recipient in recipients:
+        variables = json.loads(recipient.variables)
+        personalizations.append({
+            'to': [{'email': recipient.email, 'name': variables.get('name', '')}],
+            'substitutions': substitutions(variables),
+        })
+    return {
+        'personalizations': personalizations,
+        'from': {'email': from_email},
+        'subject': subject,
+        'content': [{'type': 'text/plain', 'value': text}, {'type': 'text/html', 'value': html_body}],
+        'custom_args': {'notification_id': str(notification.id)},
+    }
+
+def create_notification(owner_id, subject, message, tenant_ids=None):
+    """Queue a notification to the owner's tenants, or to tenant_ids among them.
+
+    Returns the notification and the ids of tenants skipped for having no email address.
+    """
+    tenants = User.query.filter(User.owner_id == owner_id, User.is_owner == False)
+    if tenant_ids is not None:
+        tenants = tenants.filter(User.id.in_(tenant_ids))
+    tenants = tenants.order_by(User.id).all()
+    recipients = [tenant for tenant in tenants if tenant.email]
+
+    notification = Notification(owner_id=owner_id, subject=subject, message=message, total=len(recipients))
+    db.session.add(notification)
+    db.session.flush()
+    if recipients:
+        db.session.execute(NotificationRecipient.__table__.insert(), [{
+            'notification_id': notification.id,
+            'user_id': tenant.id,
+            'email': tenant.email,
+            'variables': json.dumps({name: value(tenant) for name, value in VARIABLES.items()}),
+            'status': 'pending',
+        } for tenant in recipients])
+    db.session.commit()
+    return notification, [tenant.id for tenant in tenants if not tenant.email]
+
+def remove_recipient(user_id):
+    """Take a deleted tenant off every notification, mail not sent yet no longer counts towards the total"""
+    pending = (db.session.query(NotificationRecipient.notification_id, func.count())
+               .filter(NotificationRecipient.user_id == user_id, NotificationRecipient.status == 'pending')
+               .group_by(NotificationRecipient.notification_id)
+               .all())
+    for notification_id, count in pending:
+        (Notification.query.filter(Notification.id == notification_id)
+         .update({Notification.total: Notification.total - count}, synchronize_session=False))
+    NotificationRecipient.query.filter(NotificationRecipient.user_id == user_id).delete(synchronize_session=False)
+
+def claim(notification_id, lease_seconds):
+    """Take a notification for this worker, False if another worker holds it or it is waiting to retry"""
+    now = datetime.utcnow()
+    claimed = (Notification.query
+               .filter(Notification.id == notification_id, Notification.status.in_(('queued', 'sending')),
+                       or_(Notification.claimed_until.is_(None), Notification.claimed_until < now))
+               .update({Notification.status: 'sending', Notification.claimed_until: now + timedelta(seconds=lease_seconds)},
+                       synchronize_session=False))
+    db.session.commit()
+    return bool(claimed)
+
+def send_notification(notification, transport, from_email, batch_size, lease_seconds, max_attempts,
+                      retry_seconds, on_progress):
+    """Send the pending recipients of a claimed notification, one committed API call per batch.
+
+    A failed call is retried with backoff; after max_attempts failures in a row the
+    remaining recipients are marked failed. A worker that dies between a call and
+    its commit leaves that batch pending, so it can be sent twice.
+    """
+    subject, _ = compile_template(notification.subject)
+    text, html_body = compile_template(notification.message)
+    while True:
+        batch = (NotificationRecipient.query
+                 .filter(NotificationRecipient.notification_id == notification.id,
+                         NotificationRecipient.status == 'pending')
+                 .order_by(NotificationRecipient.id)
+                 .limit(batch_size)
+                 .all())
+        now = datetime.utcnow()
+        if not batch:
+            notification.status = 'sent'
+            notification.completed_at = now
+            notification.claimed_until = None
+            db.session.commit()
+            on_progress(notification)
+            return
+
+        try:
+            status_code = transport.send(build_payload(notification, batch, from_email, subject, text, html_body))
+            if status_code >= 300:
+                raise RuntimeError(f"Mail API returned {status_code}")
+        except Exception as e:
+            notification.attempts += 1
+            notification.last_error = str(e)[:1000]
+            if notification.attempts >= max_attempts:
+                failed = (NotificationRecipient.query
+                          .filter(NotificationRecipient.notification_id == notification.id,
+                                  NotificationRecipient.status == 'pending')
+                          .update({NotificationRecipient.status: 'failed'}, synchronize_session=False))
+                notification.failed_count += failed
+                notification.status = 'failed'
+                notification.completed_at = now
+                notification.claimed_until = None
+            else:
+                notification.claimed_until = now + timedelta(seconds=retry_seconds * 2 ** (notification.attempts - 1))
+            db.session.commit()
+            on_progress(notification)
+            return
+
+        (NotificationRecipient.query
+         .filter(NotificationRecipient.id.in_([recipient.id for recipient in batch]))
+         .update({NotificationRecipient.status: 'sent', NotificationRecipient.sent_at: now},
+                 synchronize_session=False))
+        notification.sent_count += len(batch)
+        notification.attempts = 0
+        notification.last_error = None
+        notification.claimed_until = now + timedelta(seconds=lease_seconds)
+        db.session.commit()
+        on_progress(notification)
+
+def send_pending(transport, from_email, batch_size=MAX_BATCH_SIZE, lease_seconds=300, max_attempts=5,
+                 retry_seconds=30, on_progress=lambda notification: None):
+    """Send every queued notification that no other worker holds, returns the ids that were worked on"""
+    batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+    now = datetime.utcnow()
+    due = [notification_id for notification_id, in (
+        db.session.query(Notification.id)
+        .filter(Notification.status.in_(('queued', 'sending')),
+                or_(Notification.claimed_until.is_(None), Notification.claimed_until < now))
+        .order_by(Notification.id))]
+    worked = []
+    for notification_id in due:
+        if not claim(notification_id, lease_seconds):
+            continue
+        send_notification(Notification.query.get(notification_id), transport, from_email, batch_size,
+                          lease_seconds, max_attempts, retry_seconds, on_progress)
+        worked.append(notification_id)
+    return worked
+
+def notification_progress(notification):
+    return {
+        'id': notification.id,
+        'subject': notification.subject,
+        'status': notification.status,
+        'total': notification.total,
+        'sent': notification.sent_count,
+        'failed': notification.failed_count,
+        'last_error': notification.last_error,
+        'created_at': notification.created_at.isoformat(),
+        'completed_at': notification.completed_at.isoformat() if notification.completed_at else None,
+    }
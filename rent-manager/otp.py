@@ -0,0 +1,102 @@
+import hashlib
+import heapq
+import hmac
+import secrets
+import threading
+from datetime import datetime, timedelta
+from flask import current_app, g
+from models import db, User, PasswordResetCode
+from sharding import across_shards, using_shard
+
+def hash_code(user_id, code):
+    """Codes only have a million values, keying the hash with SECRET_KEY keeps a leaked table useless"""
+    key = current_app.config['SECRET_KEY'].encode()
+    return hmac.new(key, f"{user_id}:{code}".encode(), hashlib.sha256).hexdigest()
+
+class ExpiryHeap:
+    """Expiry times of password reset codes, earliest first, so purging never scans the table"""
+
+    def __init__(self):
+        self.heap = []
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def push(self, expires_at, user_id, shard=None):
+        with self.lock:
+            heapq.heappush(self.heap, (expires_at, user_id, shard or ''))
+
+    def pop_due(self, now):
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                due.append(heapq.heappop(self.heap))
+        return due
+
+expiry_heap = ExpiryHeap()
+
+def issue_code(user, ttl_minutes):
+    """Replace the user's code with a new one, returns the plain code for the email"""
+    code = f"{secrets.randbelow(10 ** 6):06d}"
+    expires_at = datetime.utcnow() + timedelta(minutes=ttl_minutes)
+    PasswordResetCode.query.filter_by(user_id=user.id).delete(synchronize_session=False)
+    db.session.add(PasswordResetCode(user_id=user.id, code_hash=hash_code(user.id, code), expires_at=expires_at))
+    db.session.commit()
+    expiry_heap.push(expires_at, user.id, g.get('shard'))
+    return code
+
+def find_code(email):
+    """The unexpired code of the user with this email, one query through the email and user_id indexes"""
+    return (PasswordResetCode.query
+            .join(User, User.id == PasswordResetCode.user_id)
+            .filter(User.email == email, PasswordResetCode.expires_at > datetime.utcnow())
+            .first())
+
+def check_code(record, code, max_attempts):
+    """Count an attempt and compare the code, False once the attempts are used up.
+
+    The attempt is counted with a conditional UPDATE before comparing, so
+    concurrent guesses cannot get past max_attempts.
+    """
+    counted = (PasswordResetCode.query
+               .filter(PasswordResetCode.id == record.id, PasswordResetCode.attempts < max_attempts)
+               .update({PasswordResetCode.attempts: PasswordResetCode.attempts + 1}, synchronize_session=False))
+    db.session.commit()
+    if not counted or not code:
+        return False
+    return hmac.compare_digest(record.code_hash, hash_code(record.user_id, str(code)))
+
+def mark_verified(record, window_minutes):
+    """Keep an accepted code alive while the user chooses a password, reset-password still checks it"""
+    now = datetime.utcnow()
+    record.verified_at = now
+    record.expires_at = now + timedelta(minutes=window_minutes)
+    db.session.commit()
+    expiry_heap.push(record.expires_at, record.user_id, g.get('shard'))
+
+def load_pending():
+    """Fill the heap from the table, picks up codes issued before this process started"""
+    def load():
+        for user_id, expires_at in (db.session.query(PasswordResetCode.user_id, PasswordResetCode.expires_at)
+                                    .order_by(PasswordResetCode.expires_at)):
+            expiry_heap.push(expires_at, user_id, g.get('shard'))
+    across_shards(load)
+    expiry_heap.loaded = True
+
+def purge_expired(batch_size=500):
+    """Delete the codes whose expiry has passed by user_id, returns how many heap entries were due"""
+    if not expiry_heap.loaded:
+        load_pending()
+    now = datetime.utcnow()
+    due = expiry_heap.pop_due(now)
+    by_shard = {}
+    for _, user_id, shard in due:
+        by_shard.setdefault(shard, []).append(user_id)
+    for shard, user_ids in by_shard.items():
+        with using_shard(shard or None):
+            for i in range(0, len(user_ids), batch_size):
+                # A code renewed since the entry was pushed has a later expiry and stays
+                (PasswordResetCode.query
+                 .filter(PasswordResetCode.user_id.in_(user_ids[i:i + batch_size]), PasswordResetCode.expires_at <= now)
+                 .delete(synchronize_session=False))
+            db.session.commit()
+    return len(due)
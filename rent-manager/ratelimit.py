@@ -0,0 +1,151 @@
+import math
+import sqlite3
+import threading
+import time
+from functools import wraps
+import jwt
+from flask import current_app, jsonify, request
+
+def parse_limit(spec):
+    """'10/60' means a burst of 10 requests, refilled at 10 per 60 seconds"""
+    count, seconds = spec.split('/')
+    capacity = float(count)
+    return capacity, capacity / float(seconds)
+
+def refill(state, capacity, rate, now):
+    """Tokens in a bucket at now, a bucket that was never used is full"""
+    if state is None:
+        return capacity
+    tokens, updated_at = state
+    return min(capacity, tokens + (now - updated_at) * rate)
+
+def take_from(states, buckets, now):
+    """Take one token from every bucket, or none of them.
+
+    buckets are (key, capacity, rate) and states the stored (tokens, updated_at)
+    per key. Returns (seconds to wait, new states to store); the wait is 0 when allowed.
+    """
+    levels = [refill(states.get(key), capacity, rate, now) for key, capacity, rate in buckets]
+    wait = max(((1 - tokens) / rate for tokens, (_, _, rate) in zip(levels, buckets) if tokens < 1), default=0.0)
+    if wait > 0:
+        return wait, {}
+    # full_at lets idle buckets be dropped, a missing bucket is the same as a full one
+    return 0.0, {key: (tokens - 1, now, now + (capacity - tokens + 1) / rate)
+                 for tokens, (key, capacity, rate) in zip(levels, buckets)}
+
+class MemoryBuckets:
+    """Buckets in this process only, each worker then enforces the limits on its own"""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def take(self, buckets):
+        now = time.monotonic()
+        with self.lock:
+            wait, updates = take_from({key: self.buckets[key][:2] for key, _, _ in buckets if key in self.buckets},
+                                      buckets, now)
+            self.buckets.update(updates)
+            if len(self.buckets) > self.max_keys:
+                self.buckets = {key: state for key, state in self.buckets.items() if state[2] > now}
+        return wait
+
+class SQLiteBuckets:
+    """Buckets in a small SQLite file shared by all workers on the host.
+
+    It is separate from the application database so throttled requests never
+    touch it, and durability does not matter: a lost update only refunds tokens.
+    """
+
+    def __init__(self, path, prune_seconds=60):
+        self.path = path
+        self.prune_seconds = prune_seconds
+        self.pruned_at = 0.0
+        self.local = threading.local()
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=OFF')
+            connection.execute('CREATE TABLE IF NOT EXISTS rate_bucket '
+                               '(key TEXT PRIMARY KEY, tokens REAL, updated_at REAL, full_at REAL) WITHOUT ROWID')
+            self.local.connection = connection
+        return connection
+
+    def take(self, buckets):
+        # Wall clock time, monotonic clocks are not comparable between processes
+        now = time.time()
+        connection = self.connection()
+        keys = [key for key, _, _ in buckets]
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            states = {key: (tokens, updated_at) for key, tokens, updated_at in connection.execute(
+                f"SELECT key, tokens, updated_at FROM rate_bucket WHERE key IN ({','.join('?' * len(keys))})", keys)}
+            wait, updates = take_from(states, buckets, now)
+            connection.executemany('INSERT OR REPLACE INTO rate_bucket VALUES (?, ?, ?, ?)',
+                                   [(key, *state) for key, state in updates.items()])
+            if now - self.pruned_at > self.prune_seconds:
+                connection.execute('DELETE FROM rate_bucket WHERE full_at < ?', (now,))
+                self.pruned_at = now
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return wait
+
+def json_field(name):
+    """Account key taken from a field of the JSON body"""
+    def account():
+        data = request.get_json(silent=True)
+        value = data.get(name) if isinstance(data, dict) else None
+        return str(value).strip().lower() if value else None
+    return account
+
+def token_user():
+    """Account key taken from a valid bearer token, checked without a database lookup"""
+    auth_header = request.headers.get('Authorization', '')
+    if not auth_header.startswith('Bearer '):
+        return None
+    try:
+        return jwt.decode(auth_header[7:], current_app.config['SECRET_KEY'], algorithms=['HS256'])['user_id']
+    except Exception:
+        return None
+
+class RateLimiter:
+    """Token buckets per client IP, per account and for everyone together.
+
+    Limits come from app.config['RATE_LIMITS'][group], a dict with optional
+    'ip', 'account' and 'global' specs for parse_limit.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        if app.config['RATE_LIMIT_BACKEND'] == 'sqlite':
+            self.backend = SQLiteBuckets(app.config['RATE_LIMIT_SQLITE_PATH'])
+        else:
+            self.backend = MemoryBuckets()
+
+    def buckets(self, group, account):
+        limits = self.app.config['RATE_LIMITS'][group]
+        keys = {'ip': request.remote_addr, 'account': account() if account else None, 'global': ''}
+        return [(f"{group}:{scope}:{keys[scope]}", *parse_limit(spec))
+                for scope, spec in limits.items() if spec and keys[scope] is not None]
+
+    def limit(self, group, account=None):
+        """Answer 429 once a bucket is empty, goes directly under @app.route so nothing else runs first"""
+        def decorator(f):
+            @wraps(f)
+            def decorated(*args, **kwargs):
+                if self.app.config['RATE_LIMIT_ENABLED']:
+                    buckets = self.buckets(group, account)
+                    wait = self.backend.take(buckets) if buckets else 0.0
+                    if wait > 0:
+                        response = jsonify({'error': 'Too many requests'})
+                        response.headers['Retry-After'] = str(math.ceil(wait))
+                        return response, 429
+                return f(*args, **kwargs)
+            return decorated
+        return decorator
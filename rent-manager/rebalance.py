@@ -0,0 +1,22 @@
+import sys
+from api import app
+from models import db, ShardDirectory
+from sharding import move_owner
+
+def shard_sizes():
+    return dict(db.session.query(ShardDirectory.shard, db.func.count()).group_by(ShardDirectory.shard))
+
+def rebalance(owner_id, target_shard):
+    with app.app_context():
+        if not app.config['SHARDS']:
+            print("Sharding is not configured, set SHARD_URIS")
+            return
+        move_owner(owner_id, target_shard, batch_size=app.config['ARCHIVE_BATCH_SIZE'])
+        for shard in app.config['SHARDS']:
+            print(f"{shard}: {shard_sizes().get(shard, 0)} owners")
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("Usage: python rebalance.py <owner_id> <target_shard>")
+        sys.exit(1)
+    rebalance(int(sys.argv[1]), sys.argv[2])
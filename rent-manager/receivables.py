@@ -0,0 +1,129 @@
+import threading
+from collections import OrderedDict
+from sqlalchemy import func, select, union_all
+from models import db, User, Payment, Invoice, archived_payment
+
+# Payment statuses that count as money received
+COLLECTED_STATUSES = ('completed', 'confirmed')
+
+def month_of(column):
+    """YYYY-MM for a datetime column, computed by the database"""
+    if db.engine.dialect.name == 'postgresql':
+        return func.to_char(column, 'YYYY-MM')
+    return func.strftime('%Y-%m', column)
+
+def empty_totals():
+    return {'amount': 0.0, 'rent': 0.0, 'electricity': 0.0, 'water': 0.0, 'count': 0}
+
+def add_totals(totals, amount, rent, electricity, water, count):
+    totals['amount'] += amount or 0.0
+    totals['rent'] += rent or 0.0
+    totals['electricity'] += electricity or 0.0
+    totals['water'] += water or 0.0
+    totals['count'] += count
+
+def all_payments(user_ids):
+    """Live and archived payments of the users, archived ones were still collected"""
+    columns = ('id', 'user_id', 'payment_date', 'status', 'amount', 'rent_component', 'electricity_component',
+               'water_component')
+    return union_all(*(
+        select(*(table.c[name] for name in columns)).where(table.c.user_id.in_(user_ids))
+        for table in (Payment.__table__, archived_payment)
+    )).subquery('payments')
+
+def payment_sums(payments, *group_by):
+    return db.session.query(
+        *group_by,
+        payments.c.status,
+        func.sum(payments.c.amount),
+        func.sum(payments.c.rent_component),
+        func.sum(payments.c.electricity_component),
+        func.sum(payments.c.water_component),
+        func.count(payments.c.id)
+    )
+
+def invoice_sums(*group_by):
+    return db.session.query(
+        *group_by,
+        func.sum(Invoice.total_amount),
+        func.sum(Invoice.rent_amount),
+        func.sum(Invoice.electricity_amount),
+        func.sum(Invoice.water_amount),
+        func.count(Invoice.id)
+    )
+
+def summarize(groups):
+    rows = []
+    for group in groups.values():
+        for name in ('expected', 'collected', 'pending'):
+            totals = group[name]
+            for field in ('amount', 'rent', 'electricity', 'water'):
+                totals[field] = round(totals[field], 2)
+        group['outstanding'] = round(group['expected']['amount'] - group['collected']['amount'], 2)
+        rows.append(group)
+    return rows
+
+def owner_receivables(owner_id):
+    """Expected, collected and pending amounts per month and per tenant, aggregated in SQL"""
+    tenant_ids = select(User.id).where(User.owner_id == owner_id)
+    payments = all_payments(tenant_ids)
+    payment_month = month_of(payments.c.payment_date)
+
+    def group(groups, key, **fields):
+        if key not in groups:
+            groups[key] = dict(fields, expected=empty_totals(), collected=empty_totals(), pending=empty_totals())
+        return groups[key]
+
+    months = {}
+    for period, *totals in invoice_sums(Invoice.period).filter(Invoice.owner_id == owner_id).group_by(Invoice.period):
+        add_totals(group(months, period, month=period)['expected'], *totals)
+    for month, status, *totals in payment_sums(payments, payment_month).group_by(payment_month, payments.c.status):
+        if status in COLLECTED_STATUSES:
+            add_totals(group(months, month, month=month)['collected'], *totals)
+        elif status == 'pending':
+            add_totals(group(months, month, month=month)['pending'], *totals)
+
+    tenants = {}
+    for user_id, name, code in db.session.query(User.id, User.name, User.tenant_id).filter(User.owner_id == owner_id):
+        group(tenants, user_id, id=user_id, name=name, tenant_id=code)
+    for user_id, *totals in invoice_sums(Invoice.user_id).filter(Invoice.owner_id == owner_id).group_by(Invoice.user_id):
+        if user_id in tenants:
+            add_totals(tenants[user_id]['expected'], *totals)
+    for user_id, status, *totals in (payment_sums(payments, payments.c.user_id)
+                                     .group_by(payments.c.user_id, payments.c.status)):
+        if status in COLLECTED_STATUSES:
+            add_totals(tenants[user_id]['collected'], *totals)
+        elif status == 'pending':
+            add_totals(tenants[user_id]['pending'], *totals)
+
+    return {
+        'months': sorted(summarize(months), key=lambda m: m['month'], reverse=True),
+        'tenants': sorted(summarize(tenants), key=lambda t: t['name']),
+    }
+
+class VersionedCache:
+    """Small LRU of per-owner results, an entry is only used while its version matches"""
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, version, value):
+        with self.lock:
+            self.entries[key] = (version, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
@@ -0,0 +1,124 @@
+import calendar
+from datetime import datetime, timedelta
+import stripe
+from sqlalchemy.exc import IntegrityError
+from models import db, User, Payment, StripeEvent
+from ledger import post_entries, payment_entries
+from sharding import across_shards
+
+# Terminal PaymentIntent statuses and the Payment status they map to.
+# Other statuses (requires_payment_method after a failed attempt, processing, ...)
+# leave the payment pending because the tenant can still complete it.
+PAYMENT_STATUS_FOR_INTENT = {
+    'succeeded': 'completed',
+    'canceled': 'failed',
+}
+
+def record_event(event, payload):
+    """Store a verified webhook event in the inbox, returns False for duplicates"""
+    obj = event['data']['object']
+    is_intent = obj.get('object') == 'payment_intent'
+    db.session.add(StripeEvent(
+        event_id=event['id'],
+        event_type=event['type'],
+        payment_intent_id=obj.get('id') if is_intent else None,
+        intent_status=obj.get('status') if is_intent else None,
+        payload=payload
+    ))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Stripe retries deliveries, the event is already in the inbox
+        db.session.rollback()
+        return False
+    return True
+
+def apply_intent_statuses(intent_statuses):
+    """Move pending card payments to the status of their intents.
+
+    The pending payments are found with one query per status. Each one is then
+    updated only while it is still pending, so a payment an owner accepted or
+    rejected in the meantime keeps that status and its ledger entry is not posted
+    twice. Returns (payment_id, user_id, owner_id, status) for every payment that changed.
+    """
+    targets = {}
+    for intent_id, intent_status in intent_statuses.items():
+        status = PAYMENT_STATUS_FOR_INTENT.get(intent_status)
+        if status:
+            targets.setdefault(status, []).append(intent_id)
+
+    changed = []
+    for status, intent_ids in targets.items():
+        rows = (db.session.query(Payment.id, Payment.user_id, User.owner_id, Payment.amount)
+                .join(User, Payment.user_id == User.id)
+                .filter(Payment.stripe_payment_id.in_(intent_ids), Payment.status == 'pending')
+                .all())
+        now = datetime.utcnow()
+        updated = [row for row in rows
+                   if Payment.query.filter(Payment.id == row[0], Payment.status == 'pending').update(
+                       {Payment.status: status, Payment.updated_at: now}, synchronize_session=False)]
+        post_entries(payment_entries([(payment_id, user_id, amount, 'pending')
+                                      for payment_id, user_id, _, amount in updated], status))
+        changed.extend((payment_id, user_id, owner_id, status) for payment_id, user_id, owner_id, _ in updated)
+    return changed
+
+def process_inbox(batch_size=500, retention_days=30):
+    """Apply a batch of unprocessed webhook events in one transaction"""
+    events = (StripeEvent.query
+              .filter(StripeEvent.processed_at.is_(None))
+              .order_by(StripeEvent.id)
+              .limit(batch_size)
+              .all())
+    if not events:
+        return []
+
+    event_ids = [event.id for event in events]
+    # Later events win when one intent appears more than once in the batch
+    intent_statuses = {}
+    for event in events:
+        if event.payment_intent_id and event.intent_status:
+            intent_statuses[event.payment_intent_id] = event.intent_status
+
+    # Payments live in the shards while the inbox stays in the main database
+    changed = [change for result in across_shards(lambda: apply_intent_statuses(intent_statuses)) for change in result]
+    now = datetime.utcnow()
+    StripeEvent.query.filter(StripeEvent.id.in_(event_ids)).update(
+        {StripeEvent.processed_at: now}, synchronize_session=False
+    )
+    StripeEvent.query.filter(StripeEvent.processed_at < now - timedelta(days=retention_days)).delete(synchronize_session=False)
+    db.session.commit()
+    return changed
+
+def sweep_open_intents(min_age_minutes=15, page_size=100):
+    """Catch up on intents whose webhooks never arrived.
+
+    Lists intents created since the oldest pending card payment, page by page,
+    instead of retrieving each payment's intent separately.
+    """
+    cutoff = datetime.utcnow() - timedelta(minutes=min_age_minutes)
+    pending = (db.session.query(Payment.stripe_payment_id, Payment.created_at)
+               .filter(Payment.payment_method == 'card',
+                       Payment.status == 'pending',
+                       Payment.stripe_payment_id.isnot(None),
+                       Payment.created_at < cutoff)
+               .all())
+    if not pending:
+        return []
+
+    remaining = {intent_id for intent_id, _ in pending}
+    oldest = min(created_at for _, created_at in pending)
+    # Allow for clock skew between us and Stripe
+    created_after = calendar.timegm(oldest.utctimetuple()) - 3600
+
+    intent_statuses = {}
+    intents = stripe.PaymentIntent.list(created={'gte': created_after}, limit=page_size)
+    for intent in intents.auto_paging_iter():
+        if intent.id in remaining:
+            remaining.discard(intent.id)
+            intent_statuses[intent.id] = intent.status
+            if not remaining:
+                break
+
+    changed = apply_intent_statuses(intent_statuses)
+    db.session.commit()
+    return changed
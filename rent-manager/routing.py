@@ -0,0 +1,151 @@
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from flask import g, has_app_context, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import event, orm, select
+from sqlalchemy.sql.util import find_tables
+
+REPLICA_BIND = 'replica'
+READ_METHODS = ('GET', 'HEAD')
+
+SHARD_BIND_PREFIX = 'shard:'
+# Tables that stay in the main database when sharding is enabled, everything else lives in the shards
+GLOBAL_TABLES = {'shard_directory', 'shard_job', 'user_directory', 'stripe_event', 'replication_heartbeat',
+                 'refresh_token', 'token_revocation'}
+
+class ReplicaState:
+    """Replica health as last measured by check_replica_lag, plus recent writes per owner account"""
+
+    def __init__(self):
+        # Unknown until the first lag check, reads stay on the primary until then
+        self.healthy = False
+        self.lag_seconds = None
+        self.read_your_writes_seconds = 5
+        self.recent_writes = {}
+        self.lock = threading.Lock()
+
+    def mark_write(self, scope):
+        now = time.monotonic()
+        with self.lock:
+            self.recent_writes[scope] = now
+            if len(self.recent_writes) > 10000:
+                cutoff = now - self.read_your_writes_seconds
+                self.recent_writes = {k: t for k, t in self.recent_writes.items() if t > cutoff}
+
+    def wrote_recently(self, scope):
+        written = self.recent_writes.get(scope)
+        return written is not None and time.monotonic() - written < self.read_your_writes_seconds
+
+replica_state = ReplicaState()
+
+def use_primary(f):
+    """Keep a read handler on the primary, place it directly under @app.route"""
+    f.db_route = 'primary'
+    return f
+
+def read_only(f):
+    """Let a handler that is not a GET read from the replica"""
+    f.db_route = REPLICA_BIND
+    return f
+
+@contextmanager
+def on_primary():
+    """Read from the primary for the duration of the block"""
+    previous = g.get('db_route')
+    g.db_route = 'primary'
+    try:
+        yield
+    finally:
+        g.db_route = previous
+
+def reads_from_replica():
+    if not has_request_context() or g.get('db_route') != REPLICA_BIND:
+        return False
+    if not replica_state.healthy:
+        return False
+    # Right after a write the owner account reads its own data from the primary
+    return not replica_state.wrote_recently(g.get('owner_scope'))
+
+def statement_tables(mapper, clause):
+    if mapper is not None:
+        return {mapper.persist_selectable.name}
+    if clause is not None:
+        return {table.name for table in find_tables(clause, include_crud=True)}
+    return set()
+
+class RoutingSession(SignallingSession):
+    """Sends reads of read-only requests to the replica bind, everything else to the primary.
+
+    With SHARDS configured, statements on shard tables go to the shard selected
+    for the request (g.shard) instead.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        # scoped_session.get_bind passes SQLAlchemy's extra keywords, SignallingSession takes none
+        if self.app.config.get('SHARDS'):
+            return self.shard_bind(mapper, clause)
+        is_write = self._flushing or (clause is not None and getattr(clause, 'is_dml', False))
+        if not is_write and reads_from_replica():
+            return get_state(self.app).db.get_engine(self.app, bind=REPLICA_BIND)
+        return super().get_bind(mapper, clause)
+
+    def shard_bind(self, mapper, clause):
+        tables = statement_tables(mapper, clause)
+        if tables and tables <= GLOBAL_TABLES:
+            return super().get_bind(mapper, clause)
+        shard = g.get('shard') if has_app_context() else None
+        if shard is None:
+            raise RuntimeError(f"No shard selected for a query on {', '.join(sorted(tables)) or 'a connection'}")
+        return get_state(self.app).db.get_engine(self.app, bind=SHARD_BIND_PREFIX + shard)
+
+@event.listens_for(RoutingSession, 'after_flush')
+def remember_write(session, flush_context):
+    if has_request_context() and g.get('owner_scope') is not None:
+        replica_state.mark_write(g.owner_scope)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+def init_routing(app):
+    """Route read-only requests to the replica when SQLALCHEMY_BINDS has one"""
+    replica_state.read_your_writes_seconds = app.config['READ_YOUR_WRITES_SECONDS']
+    if REPLICA_BIND not in (app.config.get('SQLALCHEMY_BINDS') or {}):
+        return
+
+    @app.before_request
+    def choose_database():
+        view = app.view_functions.get(request.endpoint)
+        default = REPLICA_BIND if request.method in READ_METHODS else 'primary'
+        g.db_route = getattr(view, 'db_route', default)
+
+def check_replica_lag(db, heartbeat, max_lag_seconds):
+    """Compare the heartbeat on both sides, then write a new one on the primary.
+
+    The lag is how far the replica's copy trails the primary's last heartbeat,
+    so a replica that has caught up reports 0 regardless of the check interval.
+    """
+    primary = db.get_engine()
+    try:
+        with db.get_engine(bind=REPLICA_BIND).connect() as connection:
+            replica_beat = connection.execute(select(heartbeat.c.beat_at).where(heartbeat.c.id == 1)).scalar()
+    except Exception:
+        replica_beat = None
+
+    with primary.begin() as connection:
+        primary_beat = connection.execute(select(heartbeat.c.beat_at).where(heartbeat.c.id == 1)).scalar()
+        now = datetime.utcnow()
+        if primary_beat is None:
+            connection.execute(heartbeat.insert().values(id=1, beat_at=now))
+        else:
+            connection.execute(heartbeat.update().where(heartbeat.c.id == 1).values(beat_at=now))
+
+    if replica_beat is None or primary_beat is None:
+        replica_state.lag_seconds = None
+        replica_state.healthy = False
+    else:
+        replica_state.lag_seconds = max((primary_beat - replica_beat).total_seconds(), 0.0)
+        replica_state.healthy = replica_state.lag_seconds <= max_lag_seconds
+    return replica_state.lag_seconds
@@ -0,0 +1,43 @@
+from contextlib import contextmanager
+from flask import g, has_app_context
+from sqlalchemy import event, or_, select
+from sqlalchemy.orm import with_loader_criteria
+from models import User, MeterReading, Payment, MaintenanceRequest
+
+# Plain table columns, so the tenant subquery is not itself rewritten by the criteria below
+users = User.__table__
+
+def tenant_ids_of(owner_id):
+    return select(users.c.id).where(users.c.owner_id == owner_id).scalar_subquery()
+
+def scope_criteria(owner_id):
+    """Loader criteria limiting each model to one owner's account"""
+    tenants = tenant_ids_of(owner_id)
+    return [
+        with_loader_criteria(User, or_(User.id == owner_id, User.owner_id == owner_id), include_aliases=True),
+        with_loader_criteria(MeterReading, MeterReading.user_id.in_(tenants), include_aliases=True),
+        with_loader_criteria(Payment, Payment.user_id.in_(tenants), include_aliases=True),
+        with_loader_criteria(MaintenanceRequest, MaintenanceRequest.tenant_id.in_(tenants), include_aliases=True),
+    ]
+
+def set_owner_scope(user):
+    """Constrain the rest of the request to the account of this owner, or of this tenant's owner"""
+    g.owner_scope = user.id if user.is_owner else user.owner_id
+
+@contextmanager
+def unscoped():
+    """Run queries that must see every owner, such as global uniqueness checks"""
+    previous = g.pop('owner_scope', None)
+    try:
+        yield
+    finally:
+        if previous is not None:
+            g.owner_scope = previous
+
+def init_scoping(session):
+    @event.listens_for(session, 'do_orm_execute')
+    def apply_owner_scope(state):
+        if not has_app_context() or g.get('owner_scope') is None:
+            return
+        if state.is_select or state.is_update or state.is_delete:
+            state.statement = state.statement.options(*scope_criteria(g.owner_scope))
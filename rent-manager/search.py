@@ -0,0 +1,108 @@
+import re
+from sqlalchemy import column, event, false, func, literal_column, table, text
+from models import db, MaintenanceRequest
+
+FTS_TABLE = 'maintenance_request_fts'
+fts_table = table(FTS_TABLE, column('rowid'))
+
+# SQLite: an FTS5 table with its own copy of the text, kept in sync by triggers.
+# owner_key holds "o<owner_id>" so one owner's matches come straight from the index.
+SQLITE_SCHEMA = [
+    f"""CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(
+        title, description, owner_notes, owner_key, tokenize='unicode61', prefix='2 3')""",
+    f"""CREATE TRIGGER maintenance_request_fts_insert AFTER INSERT ON maintenance_request BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, title, description, owner_notes, owner_key)
+        VALUES (NEW.id, NEW.title, NEW.description, NEW.owner_notes,
+                'o' || (SELECT owner_id FROM user WHERE id = NEW.tenant_id));
+    END""",
+    f"""CREATE TRIGGER maintenance_request_fts_update AFTER UPDATE OF title, description, owner_notes, tenant_id
+        ON maintenance_request BEGIN
+        DELETE FROM {FTS_TABLE} WHERE rowid = OLD.id;
+        INSERT INTO {FTS_TABLE}(rowid, title, description, owner_notes, owner_key)
+        VALUES (NEW.id, NEW.title, NEW.description, NEW.owner_notes,
+                'o' || (SELECT owner_id FROM user WHERE id = NEW.tenant_id));
+    END""",
+    f"""CREATE TRIGGER maintenance_request_fts_delete AFTER DELETE ON maintenance_request BEGIN
+        DELETE FROM {FTS_TABLE} WHERE rowid = OLD.id;
+    END""",
+    # Requests that existed before the index
+    f"""INSERT INTO {FTS_TABLE}(rowid, title, description, owner_notes, owner_key)
+        SELECT m.id, m.title, m.description, m.owner_notes, 'o' || u.owner_id
+        FROM maintenance_request m JOIN user u ON u.id = m.tenant_id""",
+]
+
+# Postgres: a generated tsvector column, maintained by the database on every write
+POSTGRES_SCHEMA = [
+    """ALTER TABLE maintenance_request ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(description, '')), 'B') ||
+        setweight(to_tsvector('english', coalesce(owner_notes, '')), 'C')) STORED""",
+    """CREATE INDEX IF NOT EXISTS ix_maintenance_request_search_vector
+        ON maintenance_request USING GIN (search_vector)""",
+]
+
+def create_search_index(connection):
+    """Create the full-text index of maintenance requests on this connection if it is missing"""
+    dialect = connection.dialect.name
+    if dialect == 'sqlite':
+        # The triggers go away with maintenance_request, an index left without them is rebuilt
+        exists = connection.execute(text("SELECT 1 FROM sqlite_master WHERE name = :name"),
+                                    {'name': 'maintenance_request_fts_insert'}).first()
+        if not exists:
+            connection.execute(text(f"DROP TABLE IF EXISTS {FTS_TABLE}"))
+            for statement in SQLITE_SCHEMA:
+                connection.execute(text(statement))
+    elif dialect == 'postgresql':
+        for statement in POSTGRES_SCHEMA:
+            connection.execute(text(statement))
+
+def ensure_search_index(engine):
+    """Create the full-text index of maintenance requests if it is missing, for tables that already existed"""
+    with engine.begin() as connection:
+        create_search_index(connection)
+
+@event.listens_for(MaintenanceRequest.__table__, 'after_create')
+def index_new_table(target, connection, **kw):
+    # create_all, including the tests' and init_db's, gets the index with the table
+    create_search_index(connection)
+
+@event.listens_for(MaintenanceRequest.__table__, 'after_drop')
+def drop_index(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.execute(text(f"DROP TABLE IF EXISTS {FTS_TABLE}"))
+
+def search_terms(query):
+    """Words of a search box query, each matched as a prefix so that leak also finds leaking"""
+    return re.findall(r'\w+', query.lower())[:10]
+
+def search_maintenance(base_query, owner_id, query):
+    """Narrow an owner_maintenance_serializer query to matches of query, best first"""
+    terms = search_terms(query)
+    if not terms:
+        return base_query.filter(false())
+    dialect = db.session.get_bind(MaintenanceRequest.__mapper__).dialect.name
+
+    if dialect == 'postgresql':
+        tsquery = func.to_tsquery('english', ' & '.join(f"{term}:*" for term in terms))
+        vector = literal_column('maintenance_request.search_vector')
+        return (base_query
+                .filter(vector.op('@@')(tsquery))
+                .order_by(func.ts_rank(vector, tsquery).desc(), MaintenanceRequest.id.desc()))
+
+    if dialect == 'sqlite':
+        fts = literal_column(FTS_TABLE)
+        words = ' '.join(f'"{term}"*' for term in terms)
+        match = f'owner_key:"o{owner_id}" AND {{title description owner_notes}}: ({words})'
+        return (base_query
+                .join(fts_table, fts_table.c.rowid == MaintenanceRequest.id)
+                .filter(fts.op('MATCH')(match))
+                # Title matches count most, then the description, then the owner's notes
+                .order_by(func.bm25(fts, 10.0, 5.0, 2.0, 0.0), MaintenanceRequest.id.desc()))
+
+    # Other databases have no index, fall back to substring matching
+    for term in terms:
+        pattern = f"%{term}%"
+        base_query = base_query.filter(MaintenanceRequest.title.ilike(pattern)
+                                       | MaintenanceRequest.description.ilike(pattern)
+                                       | MaintenanceRequest.owner_notes.ilike(pattern))
+    return base_query.order_by(MaintenanceRequest.created_at.desc())
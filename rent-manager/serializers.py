@@ -0,0 +1,136 @@
+import json
+from datetime import date
+from flask import current_app
+from sqlalchemy import case, func
+from models import db, User, MeterReading, Payment, MaintenanceRequest, Invoice
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _default(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dumps(data):
+    """Encode to JSON bytes, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, default=_default, separators=(',', ':')).encode()
+
+def json_response(data, status=200):
+    return current_app.response_class(dumps(data), status=status, mimetype='application/json')
+
+class RowSerializer:
+    """Output keys bound to column expressions once, at import time.
+
+    Queries select only the listed columns, so rows come back as plain tuples
+    and each one is turned into a dict with a single zip. Datetimes are left
+    as-is for the JSON encoder to format.
+    """
+
+    def __init__(self, fields):
+        self.keys = tuple(key for key, _ in fields)
+        self.columns = tuple(column for _, column in fields)
+
+    def query(self):
+        return db.session.query(*self.columns)
+
+    def one(self, row):
+        return dict(zip(self.keys, row))
+
+    def all(self, query):
+        keys = self.keys
+        return [dict(zip(keys, row)) for row in query]
+
+# Card payments are identified by their Stripe intent, others by our reference
+payment_reference = case((Payment.payment_method == 'card', Payment.stripe_payment_id), else_=Payment.transaction_reference)
+
+owner_reading_serializer = RowSerializer([
+    ('id', MeterReading.id),
+    ('tenant_id', User.tenant_id),
+    ('tenant_name', User.name),
+    ('meter_type', MeterReading.meter_type),
+    ('reading_value', MeterReading.reading_value),
+    ('reading_date', MeterReading.reading_date),
+    ('image_path', MeterReading.image_path),
+])
+
+owner_payment_serializer = RowSerializer([
+    ('id', Payment.id),
+    ('tenant_id', User.tenant_id),
+    ('tenant_name', User.name),
+    ('amount', Payment.amount),
+    ('date', Payment.payment_date),
+    ('status', Payment.status),
+    ('method', Payment.payment_method),
+    ('reference', payment_reference),
+])
+
+recent_payment_serializer = RowSerializer([
+    ('id', Payment.id),
+    ('tenant', User.name),
+    ('amount', Payment.amount),
+    ('date', Payment.payment_date),
+    ('status', Payment.status),
+    ('method', Payment.payment_method),
+])
+
+tenant_payment_serializer = RowSerializer([
+    ('id', Payment.id),
+    ('date', Payment.payment_date),
+    ('amount', Payment.amount),
+    ('method', Payment.payment_method),
+    ('status', Payment.status),
+    ('reference', func.coalesce(Payment.transaction_reference, Payment.stripe_payment_id)),
+])
+
+tenant_serializer = RowSerializer([
+    ('id', User.id),
+    ('name', User.name),
+    ('tenant_id', User.tenant_id),
+    ('email', User.email),
+    ('rent_amount', User.rent_amount),
+    ('deposit', User.deposit),
+    ('created_at', User.created_at),
+])
+
+owner_maintenance_serializer = RowSerializer([
+    ('id', MaintenanceRequest.id),
+    ('tenantId', MaintenanceRequest.tenant_id),
+    ('tenantName', User.name),
+    ('tenantUniqueId', User.tenant_id),
+    ('title', MaintenanceRequest.title),
+    ('description', MaintenanceRequest.description),
+    ('priority', MaintenanceRequest.priority),
+    ('status', MaintenanceRequest.status),
+    ('ownerNotes', MaintenanceRequest.owner_notes),
+    ('created_at', MaintenanceRequest.created_at),
+])
+
+tenant_maintenance_serializer = RowSerializer([
+    ('id', MaintenanceRequest.id),
+    ('tenantId', MaintenanceRequest.tenant_id),
+    ('title', MaintenanceRequest.title),
+    ('description', MaintenanceRequest.description),
+    ('priority', MaintenanceRequest.priority),
+    ('status', MaintenanceRequest.status),
+    ('created_at', MaintenanceRequest.created_at),
+])
+
+owner_invoice_serializer = RowSerializer([
+    ('id', Invoice.id),
+    ('tenant_id', User.tenant_id),
+    ('tenant_name', User.name),
+    ('period', Invoice.period),
+    ('rent', Invoice.rent_amount),
+    ('electricity_units', Invoice.electricity_units),
+    ('electricity', Invoice.electricity_amount),
+    ('water_units', Invoice.water_units),
+    ('water', Invoice.water_amount),
+    ('rate_per_unit', Invoice.rate_per_unit),
+    ('total', Invoice.total_amount),
+    ('created_at', Invoice.created_at),
+])
@@ -0,0 +1,278 @@
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from flask import current_app, g
+from sqlalchemy import func, or_, select
+from sqlalchemy.exc import IntegrityError
+from models import db, User, ShardDirectory, ShardJob, UserDirectory, archived_user
+from routing import GLOBAL_TABLES, SHARD_BIND_PREFIX
+from search import ensure_search_index
+
+def sharding_enabled():
+    return bool(current_app.config.get('SHARDS'))
+
+def shard_engine(name):
+    return db.get_engine(bind=SHARD_BIND_PREFIX + name)
+
+@contextmanager
+def using_shard(name):
+    previous = g.get('shard')
+    g.shard = name
+    try:
+        yield
+    finally:
+        g.shard = previous
+
+def route_to_user(user_id=None, tenant_id=None, email=None):
+    """Select the shard of the owner account this user belongs to for the rest of the request.
+
+    Returns the account state ('active' or 'moving'), or None when the user is not
+    in the directory. Without sharding every lookup is 'active' and nothing changes.
+    """
+    if not sharding_enabled():
+        return 'active'
+    query = (db.session.query(ShardDirectory.shard, ShardDirectory.state)
+             .join(UserDirectory, ShardDirectory.owner_id == func.coalesce(UserDirectory.owner_id, UserDirectory.id)))
+    if user_id is not None:
+        query = query.filter(UserDirectory.id == user_id)
+    elif tenant_id is not None:
+        query = query.filter(UserDirectory.tenant_id == tenant_id)
+    else:
+        query = query.filter(UserDirectory.email == email)
+    row = query.first()
+    if row is None:
+        return None
+    g.shard = row.shard
+    return row.state
+
+def place_owner(owner_id):
+    """Put a new owner account on the shard with the fewest owners"""
+    counts = dict(db.session.query(ShardDirectory.shard, func.count()).group_by(ShardDirectory.shard))
+    shard = min(current_app.config['SHARDS'], key=lambda name: counts.get(name, 0))
+    db.session.add(ShardDirectory(owner_id=owner_id, shard=shard, state='active'))
+    g.shard = shard
+
+def assign_user_id(user):
+    """Give a new user a globally unique id from the directory before it is added to its shard.
+
+    A tenant id already taken on another shard is regenerated. Does nothing without sharding.
+    """
+    if not sharding_enabled():
+        return
+    for _ in range(5):
+        entry = UserDirectory(tenant_id=user.tenant_id, email=user.email, owner_id=user.owner_id)
+        db.session.add(entry)
+        try:
+            db.session.flush([entry])
+        except IntegrityError:
+            db.session.rollback()
+            if user.tenant_id is None:
+                raise
+            user.tenant_id = User.generate_unique_tenant_id()
+            continue
+        user.id = entry.id
+        if user.is_owner:
+            place_owner(user.id)
+        return
+    raise RuntimeError('Could not allocate a unique tenant id')
+
+def moves_in_progress():
+    return db.session.query(ShardDirectory.owner_id).filter(ShardDirectory.state == 'moving').first() is not None
+
+def start_shard_job(shard):
+    """Register a background job on a shard, returns its id, or None while an owner account is being moved.
+
+    The move is checked after the row is committed, so either move_owner sees the
+    job and waits for it, or the job sees the move and does not start.
+    """
+    job = ShardJob(shard=shard,
+                   expires_at=datetime.utcnow() + timedelta(seconds=current_app.config['SHARD_JOB_LEASE_SECONDS']))
+    db.session.add(job)
+    db.session.commit()
+    if moves_in_progress():
+        finish_shard_job(job.id)
+        return None
+    return job.id
+
+def finish_shard_job(job_id):
+    ShardJob.query.filter_by(id=job_id).delete(synchronize_session=False)
+    db.session.commit()
+
+def running_shard_jobs():
+    return ShardJob.query.filter(ShardJob.expires_at > datetime.utcnow()).count()
+
+def across_shards(func):
+    """Run func once per shard, committing after each; runs it once as is without sharding.
+
+    Shards are skipped while an owner account is being moved, the rows written there
+    would be deleted with the account's source copy. Skipped shards add no result.
+    """
+    if not sharding_enabled():
+        return [func()]
+    results = []
+    for name in current_app.config['SHARDS']:
+        job_id = start_shard_job(name)
+        if job_id is None:
+            current_app.logger.info(f"Skipped shard {name} while an owner account is being moved")
+            continue
+        with using_shard(name):
+            try:
+                results.append(func())
+                db.session.commit()
+            finally:
+                db.session.remove()
+                finish_shard_job(job_id)
+    return results
+
+def global_tables():
+    return [table for name, table in db.metadata.tables.items() if name in GLOBAL_TABLES]
+
+def shard_tables():
+    """Tables that live in the shards, referenced tables before the tables referencing them"""
+    return [table for table in db.metadata.sorted_tables if table.name not in GLOBAL_TABLES]
+
+def create_schema():
+    """create_all for the main database and, with sharding, every shard"""
+    if not sharding_enabled():
+        db.create_all()
+        ensure_search_index(db.engine)
+        return
+    db.metadata.create_all(db.engine, tables=global_tables())
+    for name in current_app.config['SHARDS']:
+        db.metadata.create_all(shard_engine(name), tables=shard_tables())
+        ensure_search_index(shard_engine(name))
+
+# How to find one owner account's rows in each shard table, given the owner id and
+# the ids of the account's live and archived users. New shard tables must be listed
+# here or in UNOWNED_TABLES, otherwise moving an owner refuses to run.
+OWNER_ROWS = {
+    'user': lambda t, owner_id, user_ids: or_(t.c.id == owner_id, t.c.owner_id == owner_id),
+    'archived_user': lambda t, owner_id, user_ids: t.c.owner_id == owner_id,
+    'owner_electricity_rate': lambda t, owner_id, user_ids: t.c.owner_id == owner_id,
+    'water_bill': lambda t, owner_id, user_ids: t.c.owner_id == owner_id,
+    'invoice': lambda t, owner_id, user_ids: t.c.owner_id == owner_id,
+    'archived_invoice': lambda t, owner_id, user_ids: t.c.owner_id == owner_id,
+    'billing_run': lambda t, owner_id, user_ids: t.c.owner_id == owner_id,
+    'meter_reading': lambda t, owner_id, user_ids: t.c.user_id.in_(user_ids),
+    'archived_meter_reading': lambda t, owner_id, user_ids: t.c.user_id.in_(user_ids),
+    'payment': lambda t, owner_id, user_ids: t.c.user_id.in_(user_ids),
+    'archived_payment': lambda t, owner_id, user_ids: t.c.user_id.in_(user_ids),
+    'balance_entry': lambda t, owner_id, user_ids: t.c.user_id.in_(user_ids),
+    'archived_balance_entry': lambda t, owner_id, user_ids: t.c.user_id.in_(user_ids),
+    'idempotency_key': lambda t, owner_id, user_ids: t.c.user_id.in_(user_ids),
+    'password_reset_code': lambda t, owner_id, user_ids: t.c.user_id.in_(user_ids),
+    'maintenance_request': lambda t, owner_id, user_ids: t.c.tenant_id.in_(user_ids),
+    'archived_maintenance_request': lambda t, owner_id, user_ids: t.c.tenant_id.in_(user_ids),
+    'maintenance_transition': lambda t, owner_id, user_ids: t.c.owner_id == owner_id,
+    'maintenance_counter': lambda t, owner_id, user_ids: t.c.owner_id == owner_id,
+    'notification': lambda t, owner_id, user_ids: t.c.owner_id == owner_id,
+    'notification_recipient': lambda t, owner_id, user_ids: t.c.user_id.in_(user_ids),
+    'tombstone': lambda t, owner_id, user_ids: t.c.owner_id == owner_id,
+}
+# Rows that belong to no owner account and stay where they are
+UNOWNED_TABLES = {'electricity_rate'}
+# Columns that point at ids of other moved tables, rewritten when those ids change
+ROW_REFERENCES = {
+    'balance_entry': {'payment_id': 'payment', 'invoice_id': 'invoice'},
+    'archived_balance_entry': {'payment_id': 'archived_payment', 'invoice_id': 'archived_invoice'},
+    'maintenance_transition': {'request_id': 'maintenance_request'},
+    'notification_recipient': {'notification_id': 'notification'},
+}
+# Tables whose ids are global (allocated by user_directory) and never change
+GLOBAL_ID_TABLES = {'user', 'archived_user'}
+
+def copy_owner_rows(source, target, table, condition, id_maps, batch_size):
+    """Copy one table's rows of an owner account, renumbering them if their ids are taken in the target"""
+    references = ROW_REFERENCES.get(table.name, {})
+    rows = [dict(row._mapping) for row in source.execute(select(table).where(condition).order_by(table.c.id))]
+    if not rows:
+        return 0
+
+    ids = [row['id'] for row in rows]
+    taken = any(target.execute(select(table.c.id).where(table.c.id.in_(ids[i:i + batch_size]))).first()
+                for i in range(0, len(ids), batch_size))
+    if taken and table.name not in GLOBAL_ID_TABLES:
+        next_id = (target.execute(select(func.max(table.c.id))).scalar() or 0) + 1
+        id_maps[table.name] = {old_id: next_id + i for i, old_id in enumerate(ids)}
+    elif taken:
+        raise RuntimeError(f"{table.name} ids of this owner already exist in the target shard")
+
+    id_map = id_maps.get(table.name, {})
+    for row in rows:
+        row['id'] = id_map.get(row['id'], row['id'])
+        for column, referenced in references.items():
+            if row[column] is not None:
+                row[column] = id_maps.get(referenced, {}).get(row[column], row[column])
+    for i in range(0, len(rows), batch_size):
+        target.execute(table.insert(), rows[i:i + batch_size])
+    return len(rows)
+
+def wait_for_shard_jobs(poll_seconds, log):
+    """Wait until no background job holds a shard, they stop starting once a move is in progress"""
+    waiting = running_shard_jobs()
+    if waiting:
+        log(f"waiting for {waiting} background jobs")
+    while waiting:
+        time.sleep(poll_seconds)
+        waiting = running_shard_jobs()
+
+def move_owner(owner_id, target_shard, batch_size=1000, grace_seconds=2.0, poll_seconds=0.5, log=print):
+    """Move an owner account to another shard while it stays readable.
+
+    Writes get 503 while the account is 'moving' (token_required checks the state)
+    and background jobs leave every shard alone (across_shards checks it). Rows are
+    copied in one transaction on the target, the directory then points at the target,
+    and only after the rows are deleted from the source does the account become 'active'.
+    """
+    entry = ShardDirectory.query.get(owner_id)
+    if entry is None:
+        raise ValueError(f"Owner {owner_id} is not in the shard directory")
+    if entry.shard == target_shard:
+        return 0
+    if target_shard not in current_app.config['SHARDS']:
+        raise ValueError(f"Unknown shard {target_shard}")
+    unknown = {t.name for t in shard_tables()} - set(OWNER_ROWS) - UNOWNED_TABLES
+    if unknown:
+        raise RuntimeError(f"No owner mapping for tables: {', '.join(sorted(unknown))}")
+
+    source_shard = entry.shard
+    entry.state = 'moving'
+    db.session.commit()
+    # Let writes that passed the state check before the flip finish
+    time.sleep(grace_seconds)
+    wait_for_shard_jobs(poll_seconds, log)
+
+    moved = 0
+    try:
+        users = User.__table__
+        with shard_engine(source_shard).connect() as source, shard_engine(target_shard).begin() as target:
+            user_ids = [user_id for user_id, in source.execute(
+                select(users.c.id).where(or_(users.c.id == owner_id, users.c.owner_id == owner_id))
+                .union(select(archived_user.c.id).where(archived_user.c.owner_id == owner_id)))]
+            id_maps = {}
+            # Referenced tables come first so their new ids are known when the references are copied
+            ordered = sorted((t for t in shard_tables() if t.name in OWNER_ROWS),
+                             key=lambda t: t.name in ROW_REFERENCES)
+            for table in ordered:
+                count = copy_owner_rows(source, target, table, OWNER_ROWS[table.name](table, owner_id, user_ids),
+                                        id_maps, batch_size)
+                moved += count
+                if count:
+                    log(f"copied {count} rows of {table.name}")
+    except Exception:
+        entry.state = 'active'
+        db.session.commit()
+        raise
+
+    # Reads go to the target from here on, jobs stay off the source until its copy is gone
+    entry.shard = target_shard
+    db.session.commit()
+
+    with shard_engine(source_shard).begin() as source:
+        for table in reversed(shard_tables()):
+            if table.name in OWNER_ROWS:
+                source.execute(table.delete().where(OWNER_ROWS[table.name](table, owner_id, user_ids)))
+    entry.state = 'active'
+    db.session.commit()
+    log(f"moved owner {owner_id} from {source_shard} to {target_shard}")
+    return moved
@@ -0,0 +1,211 @@
+import csv
+import glob
+import hashlib
+import hmac
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from sqlalchemy import select, union_all
+from models import db, User, Payment, Invoice, archived_payment
+from receivables import COLLECTED_STATUSES
+
+# Bump when the layout changes so cached documents are rendered again
+FORMAT_VERSION = 1
+FONT_PATHS = ('DejaVuSans.ttf', '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf')
+INVOICE_FIELDS = ('rent_amount', 'electricity_units', 'electricity_amount', 'rate_per_unit',
+                  'water_units', 'water_amount', 'total_amount')
+
+def month_range(period):
+    year, month = (int(part) for part in period.split('-'))
+    return datetime(year, month, 1), datetime(year + month // 12, month % 12 + 1, 1)
+
+def statement_data(owner_id, period, user_ids=None):
+    """Everything the statements of a billing period show, as plain values, with three queries.
+
+    Tenants get a statement once they have an invoice for the period.
+    """
+    owner_name = db.session.query(User.name).filter(User.id == owner_id).scalar()
+    invoices = (db.session.query(User.id, User.name, User.tenant_id,
+                                 *(getattr(Invoice, field) for field in INVOICE_FIELDS))
+                .join(User, User.id == Invoice.user_id)
+                .filter(Invoice.owner_id == owner_id, Invoice.period == period))
+    if user_ids is not None:
+        invoices = invoices.filter(Invoice.user_id.in_(user_ids))
+    statements = {}
+    for user_id, name, tenant_code, *values in invoices.order_by(User.name):
+        statements[user_id] = {
+            'period': period,
+            'owner': owner_name,
+            'tenant': {'id': user_id, 'name': name, 'tenant_id': tenant_code},
+            'invoice': dict(zip(INVOICE_FIELDS, values)),
+            'payments': [],
+        }
+    if not statements:
+        return []
+
+    start, end = month_range(period)
+    payments = Payment.__table__
+    columns = ('id', 'user_id', 'payment_date', 'payment_method', 'status', 'amount')
+    # Payments moved to the archive still belong on the statement of their month
+    rows = union_all(*(
+        select(*(table.c[name] for name in columns))
+        .where(table.c.user_id.in_(list(statements)), table.c.payment_date >= start, table.c.payment_date < end)
+        for table in (payments, archived_payment)
+    )).subquery()
+    for payment_id, user_id, paid_at, method, status, amount in db.session.execute(
+            select(rows).order_by(rows.c.payment_date, rows.c.id)):
+        statements[user_id]['payments'].append({
+            'id': payment_id, 'date': paid_at.isoformat(), 'method': method, 'status': status, 'amount': amount
+        })
+
+    for statement in statements.values():
+        paid = sum(p['amount'] for p in statement['payments'] if p['status'] in COLLECTED_STATUSES)
+        statement['paid'] = round(paid, 2)
+        statement['due'] = round(statement['invoice']['total_amount'] - paid, 2)
+    return list(statements.values())
+
+def data_version(statement, secret):
+    """Keyed hash of the statement's data, part of the file names so they cannot be guessed"""
+    payload = json.dumps([FORMAT_VERSION, statement], sort_keys=True).encode()
+    return hmac.new(secret.encode(), payload, hashlib.sha256).hexdigest()[:24]
+
+def money(value):
+    return f"{value or 0.0:.2f}"
+
+def units(value):
+    return '-' if value is None else f"{value:g}"
+
+def charge_rows(statement):
+    invoice = statement['invoice']
+    return [
+        ('Rent', '', '', money(invoice['rent_amount'])),
+        ('Electricity', units(invoice['electricity_units']), money(invoice['rate_per_unit']),
+         money(invoice['electricity_amount'])),
+        ('Water share', units(invoice['water_units']), money(invoice['rate_per_unit']), money(invoice['water_amount'])),
+    ]
+
+def write_csv(statement, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Statement', statement['period']])
+        writer.writerow(['Owner', statement['owner']])
+        writer.writerow(['Tenant', statement['tenant']['name'], statement['tenant']['tenant_id']])
+        writer.writerow([])
+        writer.writerow(['Charge', 'Units', 'Rate', 'Amount'])
+        writer.writerows(charge_rows(statement))
+        writer.writerow(['Total', '', '', money(statement['invoice']['total_amount'])])
+        writer.writerow([])
+        writer.writerow(['Payment', 'Date', 'Method', 'Status', 'Amount'])
+        for p in statement['payments']:
+            writer.writerow([p['id'], p['date'][:10], p['method'], p['status'], money(p['amount'])])
+        writer.writerow(['Paid', '', '', '', money(statement['paid'])])
+        writer.writerow(['Due', '', '', '', money(statement['due'])])
+
+def load_font(size):
+    from PIL import ImageFont
+    for path in FONT_PATHS:
+        try:
+            return ImageFont.truetype(path, size)
+        except OSError:
+            continue
+    return ImageFont.load_default()
+
+def write_pdf(statement, path):
+    """One A4 page drawn with Pillow at 150 dpi"""
+    from PIL import Image, ImageDraw
+    page = Image.new('L', (1240, 1754), 255)
+    draw = ImageDraw.Draw(page)
+    title, heading, body = load_font(44), load_font(28), load_font(24)
+    columns = (100, 520, 760, 1000)
+    y = 100
+
+    def line(values, font=body, height=40):
+        nonlocal y
+        for x, value in zip(columns, values):
+            draw.text((x, y), str(value), font=font, fill=0)
+        y += height
+
+    line([f"Statement {statement['period']}"], title, 80)
+    line([statement['owner'] or ''], heading, 50)
+    line([f"{statement['tenant']['name']} ({statement['tenant']['tenant_id']})"], heading, 80)
+    line(['Charge', 'Units', 'Rate', 'Amount'], heading, 50)
+    for row in charge_rows(statement):
+        line(row)
+    line(['Total', '', '', money(statement['invoice']['total_amount'])], heading, 90)
+
+    line(['Payments'], heading, 50)
+    payments = statement['payments']
+    for p in payments[:25]:
+        line([p['date'][:10], p['method'], p['status'], money(p['amount'])])
+    if len(payments) > 25:
+        line([f"and {len(payments) - 25} more, see the CSV"])
+    y += 40
+    line(['Paid', '', '', money(statement['paid'])], heading, 50)
+    line(['Due', '', '', money(statement['due'])], heading, 50)
+    page.save(path, 'PDF', resolution=150.0)
+
+def render_statement(job):
+    """Write one tenant's PDF and CSV, runs in a pool process; each file appears whole or not at all"""
+    statement, pdf_path, csv_path = job
+    for write, path in ((write_pdf, pdf_path), (write_csv, csv_path)):
+        partial = f"{path}.{os.getpid()}.tmp"
+        write(statement, partial)
+        os.replace(partial, path)
+    return statement['tenant']['id']
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def statement_pool(workers):
+    """The process pool shared by all requests of this worker.
+
+    Pool processes are spawned rather than forked, a fork of this multi-threaded
+    process could inherit held locks and open database connections.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+def generate_statements(owner_id, period, folder, secret, workers=None, user_ids=None):
+    """Render the period's statements that are missing for their current data version.
+
+    Returns one entry per tenant with the file paths and whether they were cached.
+    """
+    statements = statement_data(owner_id, period, user_ids)
+    directory = os.path.join(folder, str(owner_id), period)
+    os.makedirs(directory, exist_ok=True)
+
+    results, jobs = [], []
+    for statement in statements:
+        user_id = statement['tenant']['id']
+        version = data_version(statement, secret)
+        pdf_path = os.path.join(directory, f"{user_id}-{version}.pdf")
+        csv_path = os.path.join(directory, f"{user_id}-{version}.csv")
+        cached = os.path.exists(pdf_path) and os.path.exists(csv_path)
+        if not cached:
+            jobs.append((statement, pdf_path, csv_path))
+        results.append({**statement['tenant'], 'version': version, 'pdf': pdf_path, 'csv': csv_path,
+                        'cached': cached})
+
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and len(jobs) > 1:
+        list(statement_pool(workers).map(render_statement, jobs, chunksize=max(1, len(jobs) // (workers * 4))))
+    else:
+        for job in jobs:
+            render_statement(job)
+
+    # Documents of older data versions are replaced by the ones just rendered
+    current = {path for result in results for path in (result['pdf'], result['csv'])}
+    for statement, _, _ in jobs:
+        for path in glob.glob(os.path.join(directory, f"{statement['tenant']['id']}-*")):
+            if path not in current and not path.endswith('.tmp'):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass  # Removed by a concurrent run
+    return results
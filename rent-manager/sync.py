@@ -0,0 +1,121 @@
+from datetime import datetime, timedelta
+from sqlalchemy import DateTime, literal, select
+from models import db, User, MeterReading, Payment, MaintenanceRequest, Tombstone
+from serializers import (owner_reading_serializer, owner_payment_serializer, tenant_payment_serializer,
+                         tenant_serializer, owner_maintenance_serializer, tenant_maintenance_serializer)
+
+EPOCH = datetime(1970, 1, 1)
+# Tables whose deleted rows are tombstoned: list key in the sync response and the tenant column
+TRACKED_TABLES = {
+    'user': ('tenants', 'id'),
+    'meter_reading': ('meter_readings', 'user_id'),
+    'payment': ('payments', 'user_id'),
+    'maintenance_request': ('maintenance_requests', 'tenant_id'),
+}
+
+def to_watermark(moment):
+    """Microseconds since the epoch, the change version clients send back as since"""
+    return (moment - EPOCH) // timedelta(microseconds=1)
+
+def from_watermark(value):
+    return EPOCH + timedelta(microseconds=value)
+
+def record_deletions(table, ids):
+    """Tombstone rows of a synced table that are about to be deleted, in the caller's transaction"""
+    tracked = TRACKED_TABLES.get(table.name)
+    if not tracked or not ids:
+        return
+    entity, tenant_column = tracked
+    tenants = User.__table__.alias('tenant')
+    db.session.execute(Tombstone.__table__.insert().from_select(
+        ['entity', 'row_id', 'user_id', 'owner_id', 'deleted_at'],
+        select(literal(entity), table.c.id, table.c[tenant_column], tenants.c.owner_id,
+               literal(datetime.utcnow(), DateTime))
+        .join(tenants, tenants.c.id == table.c[tenant_column])
+        .where(table.c.id.in_(ids), tenants.c.owner_id.isnot(None))
+    ))
+
+def changed_rows(user, cutoff):
+    """The lists the user's screens show, in the shapes of their endpoints, limited to rows changed after cutoff"""
+    def since(serializer, query, column):
+        return serializer.all(query if cutoff is None else query.filter(column > cutoff))
+
+    if not user.is_owner:
+        return {
+            'meter_readings': since(owner_reading_serializer,
+                                    owner_reading_serializer.query()
+                                    .join(User, MeterReading.user_id == User.id)
+                                    .filter(MeterReading.user_id == user.id),
+                                    MeterReading.updated_at),
+            'payments': since(tenant_payment_serializer,
+                              tenant_payment_serializer.query().filter(Payment.user_id == user.id),
+                              Payment.updated_at),
+            'maintenance_requests': since(tenant_maintenance_serializer,
+                                          tenant_maintenance_serializer.query()
+                                          .filter(MaintenanceRequest.tenant_id == user.id),
+                                          MaintenanceRequest.updated_at),
+        }
+    return {
+        'tenants': since(tenant_serializer, tenant_serializer.query().filter(User.owner_id == user.id),
+                         User.updated_at),
+        'meter_readings': since(owner_reading_serializer,
+                                owner_reading_serializer.query()
+                                .join(User, MeterReading.user_id == User.id)
+                                .filter(User.owner_id == user.id),
+                                MeterReading.updated_at),
+        'payments': since(owner_payment_serializer,
+                          owner_payment_serializer.query()
+                          .join(User, Payment.user_id == User.id)
+                          .filter(User.owner_id == user.id),
+                          Payment.updated_at),
+        'maintenance_requests': since(owner_maintenance_serializer,
+                                      owner_maintenance_serializer.query()
+                                      .join(User, MaintenanceRequest.tenant_id == User.id)
+                                      .filter(User.owner_id == user.id),
+                                      MaintenanceRequest.updated_at),
+    }
+
+def deleted_rows(user, cutoff, entities):
+    tombstones = db.session.query(Tombstone.entity, Tombstone.row_id).filter(Tombstone.deleted_at > cutoff)
+    if user.is_owner:
+        tombstones = tombstones.filter(Tombstone.owner_id == user.id)
+    else:
+        tombstones = tombstones.filter(Tombstone.user_id == user.id)
+    deleted = {entity: set() for entity in entities}
+    for entity, row_id in tombstones:
+        if entity in deleted:
+            deleted[entity].add(row_id)
+    return deleted
+
+def sync_changes(user, since, overlap_seconds, retention_days):
+    """Rows changed and ids deleted since a watermark, or everything when there is none.
+
+    updated_at is set when a row is flushed but only visible once its transaction
+    commits, so each sync looks back overlap_seconds before since; clients apply
+    rows by id and receive the few repeated ones harmlessly. A watermark older than
+    the tombstones kept gets a full snapshot instead.
+    """
+    now = datetime.utcnow()
+    full = since is None or from_watermark(since) < now - timedelta(days=retention_days)
+    cutoff = None if full else from_watermark(since) - timedelta(seconds=overlap_seconds)
+    changes = changed_rows(user, cutoff)
+    deleted = {}
+    if not full:
+        for entity, ids in deleted_rows(user, cutoff, changes).items():
+            # A row listed as changed exists now, its id was reused after the tombstone
+            ids -= {row['id'] for row in changes[entity]}
+            deleted[entity] = sorted(ids)
+    return {'watermark': to_watermark(now), 'full': full, 'changes': changes, 'deleted': deleted}
+
+def purge_tombstones(retention_days, batch_size=1000):
+    """Delete tombstones older than any watermark that still gets incremental changes"""
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    purged = 0
+    while True:
+        ids = [row_id for row_id, in db.session.query(Tombstone.id)
+               .filter(Tombstone.deleted_at < cutoff).limit(batch_size)]
+        if not ids:
+            return purged
+        Tombstone.query.filter(Tombstone.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        purged += len(ids)
@@ -0,0 +1,67 @@
+import os
+import sys
+import tempfile
+import pytest
+
+# api.py reads its settings when it is imported, so they are set first
+WORK_DIR = tempfile.mkdtemp(prefix='rent-manager-tests-')
+os.environ.update({
+    'DATABASE_URL': 'sqlite:///' + os.path.join(WORK_DIR, 'test.db'),
+    'RATE_LIMIT_ENABLED': 'false',
+    'EMAIL_TRANSPORT': 'local',
+    'STRIPE_WEBHOOK_SECRET': 'whsec_test',
+    'STATEMENT_WORKERS': '1',
+    'COLUMNAR_DATA_DIR': os.path.join(WORK_DIR, 'columnar'),
+})
+# Uploads and other relative paths land in the scratch directory
+os.chdir(WORK_DIR)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db_config
+# Enforce foreign keys as Postgres does, configure_database keeps this pragma
+db_config.sqlite_pragmas['foreign_keys'] = 'ON'
+
+import api as api_module
+from models import db
+
+@pytest.fixture
+def api():
+    """The api module with an empty database"""
+    with api_module.app.app_context():
+        db.drop_all()
+        db.create_all()
+    api_module.revocations.sessions.clear()
+    api_module.revocations.user_cutoffs.clear()
+    # token_revocation ids start again with the new tables
+    api_module.revocations.version = 0
+    api_module.mail_transport.outbox.clear()
+    yield api_module
+    with api_module.app.app_context():
+        db.session.remove()
+
+@pytest.fixture
+def client(api):
+    return api.app.test_client()
+
+def auth(token):
+    return {'Authorization': f"Bearer {token}"}
+
+@pytest.fixture
+def owner(client):
+    """Headers of a freshly registered owner"""
+    client.post('/api/register_owner', json={'name': 'Owner', 'email': 'owner@example.com', 'password': 'secret'})
+    response = client.post('/api/login', json={'tenant_id': 'owner@example.com', 'password': 'secret'})
+    return auth(response.json['token'])
+
+@pytest.fixture
+def add_tenant(client, owner):
+    """Register a tenant of the owner, returns (headers, tenant) where tenant has the id and tenant_id"""
+    def add(name='Tenant', rent_amount=1000, **fields):
+        tenant = client.post('/api/register_tenant', headers=owner, json={
+            'name': name, 'rent_amount': rent_amount, 'deposit': 0,
+            'initial_electricity_reading': 100, 'initial_water_reading': 50, **fields
+        }).json['tenant']
+        token = client.post('/api/login', json={'tenant_id': tenant['tenant_id'],
+                                                'password': tenant['password']}).json['token']
+        return auth(token), tenant
+    return add
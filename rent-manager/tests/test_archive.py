@@ -0,0 +1,83 @@
+from datetime import datetime
+from sqlalchemy import func, select
+from models import (db, User, MeterReading, Payment, Invoice, BalanceEntry, IdempotencyKey, Notification,
+                    NotificationRecipient, RefreshToken, archived_user, archived_payment, archived_invoice,
+                    archived_balance_entry)
+from archive import archive_tenant, archive_cold_history
+from billing import run_billing
+
+def count(table):
+    return db.session.execute(select(func.count()).select_from(table)).scalar()
+
+def test_invoiced_tenant_is_archived_with_foreign_keys_enforced(api, client, owner, add_tenant):
+    tenant_headers, tenant = add_tenant()
+    client.post('/api/create_payment', headers=tenant_headers, json={'payment_method': 'cash'})
+    with api.app.app_context():
+        run_billing([db.session.get(User, tenant['id']).owner_id], '2026-09')
+
+    response = client.delete(f"/api/owner/tenants/{tenant['id']}", headers=owner)
+    assert response.status_code == 200
+    with api.app.app_context():
+        assert db.session.get(User, tenant['id']) is None
+        assert Invoice.query.count() == 0 and Payment.query.count() == 0 and MeterReading.query.count() == 0
+        assert BalanceEntry.query.count() == 0
+        assert (count(archived_user), count(archived_invoice), count(archived_payment)) == (1, 1, 1)
+        assert count(archived_balance_entry) == 1
+
+def test_deleted_tenant_keeps_its_journal_and_leaves_nothing_behind(api, client, owner, add_tenant):
+    tenant_headers, tenant = add_tenant(email='tenant@example.com')
+    _, other = add_tenant(name='Other', email='other@example.com')
+    client.post('/api/create_payment', headers={**tenant_headers, 'Idempotency-Key': 'pay-1'},
+                json={'payment_method': 'cash'})
+    with api.app.app_context():
+        run_billing([db.session.get(User, tenant['id']).owner_id], '2026-09')
+        payment_id = Payment.query.filter_by(user_id=tenant['id']).one().id
+    client.post(f"/api/owner/payments/{payment_id}/accept", headers=owner)
+    response = client.post('/api/owner/notifications', headers=owner, json={'subject': 'Water', 'message': 'Off today'})
+    notification_id = response.json['id']
+    with api.app.app_context():
+        journal = sorted((entry.reason, entry.amount) for entry in BalanceEntry.query.filter_by(user_id=tenant['id']))
+        assert [reason for reason, _ in journal] == ['invoice', 'payment']
+        assert RefreshToken.query.filter_by(user_id=tenant['id']).count() == 1
+        assert IdempotencyKey.query.filter_by(user_id=tenant['id']).count() == 1
+        assert NotificationRecipient.query.count() == 2
+
+    assert client.delete(f"/api/owner/tenants/{tenant['id']}", headers=owner).status_code == 200
+    with api.app.app_context():
+        archived = db.session.execute(select(archived_balance_entry.c.reason, archived_balance_entry.c.amount)
+                                      .where(archived_balance_entry.c.user_id == tenant['id'])).all()
+        assert sorted(tuple(row) for row in archived) == journal
+        assert BalanceEntry.query.filter_by(user_id=tenant['id']).count() == 0
+        assert RefreshToken.query.filter_by(user_id=tenant['id']).count() == 0
+        assert IdempotencyKey.query.filter_by(user_id=tenant['id']).count() == 0
+        assert [r.user_id for r in NotificationRecipient.query] == [other['id']]
+        assert db.session.get(Notification, notification_id).total == 1
+
+def test_interrupted_archive_can_be_run_again(api, add_tenant):
+    _, tenant = add_tenant()
+    with api.app.app_context():
+        run_billing([db.session.get(User, tenant['id']).owner_id], '2026-09')
+        # As if a previous run stopped after moving the readings
+        archive_tenant(tenant['id'])
+        archive_tenant(tenant['id'])
+        assert db.session.get(User, tenant['id']) is None
+        assert (count(archived_user), count(archived_invoice)) == (1, 1)
+
+def test_archived_payments_still_count_as_collected(api, client, owner, add_tenant):
+    _, tenant = add_tenant()
+    with api.app.app_context():
+        run_billing([db.session.get(User, tenant['id']).owner_id], '2023-01')
+        db.session.add(Payment(user_id=tenant['id'], amount=1000, payment_date=datetime(2023, 1, 15),
+                               payment_method='cash', status='completed'))
+        db.session.commit()
+
+    before = client.get('/api/owner/receivables', headers=owner).json
+    with api.app.app_context():
+        assert archive_cold_history(retention_days=730) == (0, 1)
+    after = client.get('/api/owner/receivables', headers=owner).json
+
+    assert after == before
+    month = next(month for month in after['months'] if month['month'] == '2023-01')
+    assert month['collected']['amount'] == 1000
+    assert month['outstanding'] == 0
+    assert after['tenants'][0]['outstanding'] == 0
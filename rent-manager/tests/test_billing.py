@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta
+import pytest
+from models import db, User, MeterReading, Invoice, BillingRun, BalanceEntry
+from billing import run_billing, run_due_billing
+
+def add_reading(user_id, value, meter_type='electricity', days_later=1):
+    db.session.add(MeterReading(user_id=user_id, reading_value=value, meter_type=meter_type,
+                                reading_date=datetime.now() + timedelta(days=days_later), image_path='test.jpg'))
+    db.session.commit()
+
+@pytest.fixture
+def billed_tenant(api, client, owner, add_tenant):
+    """A tenant paying 1000 rent with electricity read at 100 then 200, at 10 per unit"""
+    client.post('/api/owner/electricity_rate', headers=owner, json={'rate': 10})
+    _, tenant = add_tenant()
+    with api.app.app_context():
+        add_reading(tenant['id'], 200)
+        return db.session.get(User, tenant['id']).owner_id, tenant['id']
+
+def invoice(user_id, period):
+    return Invoice.query.filter_by(user_id=user_id, period=period).one()
+
+def test_repeated_run_creates_no_second_invoice(api, billed_tenant):
+    owner_id, tenant_id = billed_tenant
+    with api.app.app_context():
+        assert len(run_billing([owner_id], '2026-09')) == 1
+        assert run_billing([owner_id], '2026-09') == []
+        assert Invoice.query.count() == 1
+        assert BalanceEntry.query.count() == 1
+        assert db.session.get(User, tenant_id).balance == 2000
+        assert BillingRun.query.one().invoices_created == 1
+
+def test_consumption_is_billed_once(api, billed_tenant):
+    owner_id, tenant_id = billed_tenant
+    with api.app.app_context():
+        run_billing([owner_id], '2026-09')
+        first = invoice(tenant_id, '2026-09')
+        assert (first.electricity_units, first.electricity_amount, first.electricity_reading) == (100, 1000, 200)
+
+        # No new reading during the month, only the rent is charged
+        run_billing([owner_id], '2026-10')
+        second = invoice(tenant_id, '2026-10')
+        assert (second.electricity_units, second.electricity_amount, second.total_amount) == (0, 0, 1000)
+
+        add_reading(tenant_id, 250, days_later=2)
+        run_billing([owner_id], '2026-11')
+        third = invoice(tenant_id, '2026-11')
+        assert (third.electricity_units, third.electricity_amount, third.electricity_reading) == (50, 500, 250)
+        assert db.session.get(User, tenant_id).balance == 2000 + 1000 + 1500
+
+def test_water_is_billed_from_the_last_invoice(api, billed_tenant):
+    owner_id, tenant_id = billed_tenant
+    with api.app.app_context():
+        add_reading(tenant_id, 80, meter_type='water')
+        run_billing([owner_id], '2026-09')
+        run_billing([owner_id], '2026-10')
+        # One tenant shares the water with the owner
+        assert invoice(tenant_id, '2026-09').water_amount == 150
+        assert invoice(tenant_id, '2026-10').water_units == 0
+
+def test_due_billing_waits_for_the_billing_day(api, client, owner, billed_tenant):
+    owner_id, _ = billed_tenant
+    client.post('/api/owner/billing_day', headers=owner, json={'billing_day': 15})
+    with api.app.app_context():
+        assert run_due_billing(datetime(2026, 9, 14).date()) == []
+        assert len(run_due_billing(datetime(2026, 9, 15).date())) == 1
+        assert run_due_billing(datetime(2026, 9, 16).date()) == []
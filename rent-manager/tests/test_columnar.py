@@ -0,0 +1,19 @@
+from datetime import datetime
+import pytest
+from models import db, MeterReading
+
+pytest.importorskip('pyarrow')
+from columnar import export_closed_periods
+
+def test_unchanged_partitions_are_not_rewritten(api, add_tenant, tmp_path):
+    _, tenant = add_tenant()
+    with api.app.app_context():
+        for value in (120, None):
+            db.session.add(MeterReading(user_id=tenant['id'], reading_value=value, meter_type='electricity',
+                                        reading_date=datetime(2026, 8, 10), image_path='test.jpg'))
+        db.session.commit()
+
+        today = datetime(2026, 10, 1)
+        assert export_closed_periods(str(tmp_path), today) != []
+        # A reading without a value is not exported and must not make the partition look stale
+        assert export_closed_periods(str(tmp_path), today) == []
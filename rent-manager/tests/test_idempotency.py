@@ -0,0 +1,43 @@
+from models import Payment, IdempotencyKey
+
+def test_repeated_key_replays_the_first_response(api, client, add_tenant):
+    headers, _ = add_tenant()
+    headers = {**headers, 'Idempotency-Key': 'pay-1'}
+    first = client.post('/api/create_payment', headers=headers, json={'payment_method': 'cash'})
+    second = client.post('/api/create_payment', headers=headers, json={'payment_method': 'cash'})
+
+    assert first.status_code == 200
+    assert second.status_code == 200
+    assert second.headers['Idempotent-Replayed'] == 'true'
+    assert second.json == first.json
+    with api.app.app_context():
+        assert Payment.query.count() == 1
+
+def test_key_reused_for_another_request_is_rejected(api, client, add_tenant):
+    headers, _ = add_tenant()
+    headers = {**headers, 'Idempotency-Key': 'pay-1'}
+    client.post('/api/create_payment', headers=headers, json={'payment_method': 'cash'})
+    response = client.post('/api/create_payment', headers=headers, json={'payment_method': 'bank_transfer'})
+
+    assert response.status_code == 422
+    with api.app.app_context():
+        assert Payment.query.count() == 1
+
+def test_failed_request_does_not_keep_the_key(api, client, add_tenant):
+    headers, _ = add_tenant()
+    headers = {**headers, 'Idempotency-Key': 'pay-1'}
+    assert client.post('/api/create_payment', headers=headers, json={'payment_method': 'cheque'}).status_code == 400
+    with api.app.app_context():
+        assert IdempotencyKey.query.count() == 0
+    # The client can retry the same key with a corrected request
+    assert client.post('/api/create_payment', headers=headers, json={'payment_method': 'cash'}).status_code == 200
+
+def test_keys_are_per_user(api, client, add_tenant):
+    first, _ = add_tenant('First')
+    second, _ = add_tenant('Second')
+    for headers in (first, second):
+        response = client.post('/api/create_payment', headers={**headers, 'Idempotency-Key': 'same'},
+                               json={'payment_method': 'cash'})
+        assert 'Idempotent-Replayed' not in response.headers
+    with api.app.app_context():
+        assert Payment.query.count() == 2
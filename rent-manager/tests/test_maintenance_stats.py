@@ -0,0 +1,29 @@
+from werkzeug.security import generate_password_hash
+from models import db, User, MaintenanceTransition
+from maintenance_stats import verify_counters
+
+REQUEST = {'title': 'Leak', 'description': 'Kitchen tap', 'priority': 'high'}
+
+def test_requests_are_logged_and_counted(client, owner, add_tenant):
+    tenant_headers, _ = add_tenant()
+    created = client.post('/api/maintenance-requests', headers=tenant_headers, json=REQUEST)
+    assert created.status_code == 201
+    request_id = created.json['id']
+    client.patch(f"/api/maintenance-requests/{request_id}", headers=owner, json={'status': 'completed'})
+
+    stats = client.get('/api/maintenance-requests/owner/stats', headers=owner).json
+    assert (stats['open_total'], stats['closed']) == (0, 1)
+    history = client.get(f"/api/maintenance-requests/{request_id}/history", headers=owner).json
+    assert [entry['to'] for entry in history] == ['pending', 'completed']
+
+def test_tenant_without_owner_can_still_create_requests(api, client):
+    with api.app.app_context():
+        db.session.add(User(name='Orphan', tenant_id='654321', password_hash=generate_password_hash('pw')))
+        db.session.commit()
+    token = client.post('/api/login', json={'tenant_id': '654321', 'password': 'pw'}).json['token']
+
+    response = client.post('/api/maintenance-requests', headers={'Authorization': f"Bearer {token}"}, json=REQUEST)
+    assert response.status_code == 201
+    with api.app.app_context():
+        assert MaintenanceTransition.query.count() == 0
+        assert verify_counters() == []
@@ -0,0 +1,97 @@
+from datetime import datetime, timedelta
+from sqlalchemy import Column, MetaData, Table, inspect
+from models import db, User, Invoice, WaterBill
+from billing import run_billing
+from migrate import upgrade_database, migrate
+
+# Columns that tables created by earlier versions do not have
+ADDED_COLUMNS = {
+    'user': {'billing_day', 'balance', 'updated_at'},
+    'meter_reading': {'updated_at'},
+    'payment': {'updated_at'},
+    'invoice': {'electricity_reading', 'water_reading'},
+    'water_bill': {'owner_id'},
+}
+
+def create_earlier_schema():
+    metadata = MetaData()
+    for table in db.metadata.sorted_tables:
+        Table(table.name, metadata, *(Column(column.name, column.type, primary_key=column.primary_key)
+                                      for column in table.columns
+                                      if column.name not in ADDED_COLUMNS.get(table.name, ())))
+    db.drop_all()
+    metadata.create_all(db.engine)
+    return metadata.tables
+
+def insert(table, **values):
+    return db.session.execute(table.insert().values(**values)).inserted_primary_key[0]
+
+def test_upgrade_adds_missing_columns_once(api):
+    with api.app.app_context():
+        create_earlier_schema()
+        added = upgrade_database(db.engine, db.metadata.sorted_tables)
+        assert {pair for pair in added if pair[0] in ADDED_COLUMNS} == {
+            (table, column) for table, columns in ADDED_COLUMNS.items() for column in columns
+        }
+        for table, columns in ADDED_COLUMNS.items():
+            assert columns <= {column['name'] for column in inspect(db.engine).get_columns(table)}
+        assert upgrade_database(db.engine, db.metadata.sorted_tables) == []
+
+def test_upgraded_invoices_are_not_billed_again(api):
+    with api.app.app_context():
+        tables = create_earlier_schema()
+        users, readings, invoices = tables['user'], tables['meter_reading'], tables['invoice']
+        owner_id = insert(users, name='Owner', password_hash='x', is_owner=True, rent_amount=0)
+        tenant_id = insert(users, name='Tenant', password_hash='x', is_owner=False, rent_amount=1000, owner_id=owner_id)
+        start = datetime.utcnow() - timedelta(days=40)
+        for days, value in ((0, 100), (20, 200)):
+            insert(readings, user_id=tenant_id, reading_value=value, meter_type='electricity', image_path='x',
+                   reading_date=start + timedelta(days=days), created_at=start + timedelta(days=days))
+        insert(invoices, owner_id=owner_id, user_id=tenant_id, period='2026-09', rent_amount=1000,
+               electricity_units=100, electricity_amount=0, water_amount=0, total_amount=1000,
+               created_at=start + timedelta(days=30))
+        db.session.commit()
+
+        upgrade_database(db.engine, db.metadata.sorted_tables)
+        assert db.session.get(User, owner_id).billing_day == 1
+        assert db.session.get(Invoice, 1).electricity_reading == 200
+        run_billing([owner_id], '2026-10')
+        assert Invoice.query.filter_by(period='2026-10').one().electricity_units == 0
+
+def test_migration_backfills_balances(api):
+    with api.app.app_context():
+        tables = create_earlier_schema()
+        users, payments, invoices = tables['user'], tables['payment'], tables['invoice']
+        owner_id = insert(users, name='Owner', password_hash='x', is_owner=True, rent_amount=0)
+        tenant_id = insert(users, name='Tenant', password_hash='x', is_owner=False, rent_amount=1000, owner_id=owner_id)
+        insert(invoices, owner_id=owner_id, user_id=tenant_id, period='2026-09', rent_amount=1000,
+               electricity_amount=0, water_amount=0, total_amount=1000)
+        for amount, status in ((400, 'completed'), (100, 'pending')):
+            insert(payments, user_id=tenant_id, amount=amount, payment_date=datetime.now(), payment_method='cash',
+                   status=status)
+        db.session.commit()
+
+        migrate(log=lambda line: None)
+        db.session.expire_all()
+        assert db.session.get(User, tenant_id).balance == 600
+
+def test_water_bills_go_to_the_only_owner(api):
+    with api.app.app_context():
+        tables = create_earlier_schema()
+        owner_id = insert(tables['user'], name='Owner', password_hash='x', is_owner=True, rent_amount=0)
+        insert(tables['water_bill'], total_amount=100, billing_date=datetime.now(), total_tenants=1, amount_per_tenant=50)
+        db.session.commit()
+
+        upgrade_database(db.engine, db.metadata.sorted_tables)
+        assert WaterBill.query.one().owner_id == owner_id
+
+def test_existing_rows_get_updated_at(api):
+    with api.app.app_context():
+        tables = create_earlier_schema()
+        created_at = datetime(2025, 5, 1)
+        owner_id = insert(tables['user'], name='Owner', password_hash='x', is_owner=True, rent_amount=0,
+                          created_at=created_at)
+        db.session.commit()
+
+        upgrade_database(db.engine, db.metadata.sorted_tables)
+        assert db.session.get(User, owner_id).updated_at == created_at
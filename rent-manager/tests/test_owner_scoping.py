@@ -0,0 +1,43 @@
+import pytest
+from models import db, Payment, BalanceEntry
+from conftest import auth
+
+@pytest.fixture
+def other_owner(client, owner):
+    """Headers of a second owner, registered after the first"""
+    client.post('/api/register_owner', json={'name': 'Other', 'email': 'other@example.com', 'password': 'secret'})
+    response = client.post('/api/login', json={'tenant_id': 'other@example.com', 'password': 'secret'})
+    return auth(response.json['token'])
+
+@pytest.fixture
+def payment_id(api, client, add_tenant):
+    """A pending cash payment of a tenant of the first owner"""
+    headers, tenant = add_tenant()
+    client.post('/api/create_payment', headers=headers, json={'payment_method': 'cash'})
+    with api.app.app_context():
+        return Payment.query.filter_by(user_id=tenant['id']).one().id
+
+def assert_untouched(api, payment_id):
+    with api.app.app_context():
+        assert db.session.get(Payment, payment_id).status == 'pending'
+        assert BalanceEntry.query.filter_by(payment_id=payment_id).count() == 0
+
+@pytest.mark.parametrize('action', ['accept', 'reject'])
+def test_other_owner_cannot_settle_a_payment(api, client, other_owner, payment_id, action):
+    response = client.post(f"/api/owner/payments/{payment_id}/{action}", headers=other_owner)
+    assert response.status_code == 404
+    assert_untouched(api, payment_id)
+
+def test_other_owner_cannot_bulk_update_a_payment(api, client, other_owner, payment_id):
+    response = client.post('/api/owner/payments/bulk', headers=other_owner,
+                           json={'status': 'completed', 'payment_ids': [payment_id]})
+    assert response.status_code == 200
+    assert response.json['updated'] == 0
+    assert response.json['results'] == [{'id': payment_id, 'outcome': 'not_found'}]
+    assert_untouched(api, payment_id)
+
+def test_owner_can_settle_their_own_payment(api, client, owner, other_owner, payment_id):
+    response = client.post(f"/api/owner/payments/{payment_id}/accept", headers=owner)
+    assert response.status_code == 200
+    with api.app.app_context():
+        assert db.session.get(Payment, payment_id).status == 'completed'
@@ -0,0 +1,69 @@
+import re
+from datetime import datetime, timedelta
+import pytest
+from models import db, PasswordResetCode
+
+EMAIL = 'owner@example.com'
+
+def request_code(api, client):
+    """Ask for a reset code and read it from the email, the response never carries it"""
+    response = client.post('/api/auth/forgot-password', json={'email': EMAIL})
+    assert response.status_code == 200
+    assert 'otp' not in response.json
+    message = api.mail_transport.outbox[-1]
+    assert message['personalizations'][0]['to'][0]['email'] == EMAIL
+    text = next(part['value'] for part in message['content'] if part['type'] == 'text/plain')
+    return re.search(r"Your OTP is: (\d{6})", text).group(1)
+
+@pytest.fixture
+def code(api, client, owner):
+    """A fresh reset code for the owner"""
+    return request_code(api, client)
+
+def wrong(code):
+    return f"{(int(code) + 1) % 10 ** 6:06d}"
+
+def reset(client, otp=None, password='new-secret'):
+    body = {'email': EMAIL, 'newPassword': password}
+    if otp is not None:
+        body['otp'] = otp
+    return client.post('/api/auth/reset-password', json=body)
+
+def test_reset_with_code_changes_the_password_once(api, client, code):
+    assert client.post('/api/auth/verify-otp', json={'email': EMAIL, 'otp': code}).status_code == 200
+    assert reset(client, code).status_code == 200
+    assert client.post('/api/login', json={'tenant_id': EMAIL, 'password': 'new-secret'}).status_code == 200
+    # The code was consumed
+    assert reset(client, code, password='other').status_code == 400
+    with api.app.app_context():
+        assert PasswordResetCode.query.count() == 0
+
+def test_verified_code_is_still_needed_to_reset(client, code):
+    assert client.post('/api/auth/verify-otp', json={'email': EMAIL, 'otp': code}).status_code == 200
+    assert reset(client).status_code == 400
+    assert reset(client, wrong(code)).status_code == 400
+    assert client.post('/api/login', json={'tenant_id': EMAIL, 'password': 'secret'}).status_code == 200
+
+def test_code_stops_working_after_max_attempts(api, client, code):
+    for _ in range(api.app.config['OTP_MAX_ATTEMPTS']):
+        assert client.post('/api/auth/verify-otp', json={'email': EMAIL, 'otp': wrong(code)}).status_code == 400
+    assert client.post('/api/auth/verify-otp', json={'email': EMAIL, 'otp': code}).status_code == 400
+    assert reset(client, code).status_code == 400
+
+def test_expired_code_is_rejected(api, client, code):
+    with api.app.app_context():
+        PasswordResetCode.query.update({PasswordResetCode.expires_at: datetime.utcnow() - timedelta(seconds=1)})
+        db.session.commit()
+    assert client.post('/api/auth/verify-otp', json={'email': EMAIL, 'otp': code}).status_code == 400
+    assert reset(client, code).status_code == 400
+
+def test_new_code_replaces_the_previous_one(api, client, code):
+    newer = request_code(api, client)
+    if newer != code:
+        assert reset(client, code).status_code == 400
+    assert reset(client, newer).status_code == 200
+
+def test_reset_signs_out_existing_sessions(client, owner, code):
+    assert client.get('/api/owner/tenants', headers=owner).status_code == 200
+    assert reset(client, code).status_code == 200
+    assert client.get('/api/owner/tenants', headers=owner).status_code == 401
@@ -0,0 +1,52 @@
+import pytest
+from ratelimit import MemoryBuckets, SQLiteBuckets
+
+LOOSE = '1000/60'
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def limits(request, api, monkeypatch, tmp_path):
+    """Turn the limiter on with empty buckets; returns a function setting the login limits"""
+    monkeypatch.setitem(api.app.config, 'RATE_LIMIT_ENABLED', True)
+    backend = MemoryBuckets() if request.param == 'memory' else SQLiteBuckets(str(tmp_path / 'ratelimit.db'))
+    monkeypatch.setattr(api.rate_limiter, 'backend', backend)
+
+    def set_login(ip=LOOSE, account=LOOSE, global_=LOOSE):
+        monkeypatch.setitem(api.app.config['RATE_LIMITS'], 'login', {'ip': ip, 'account': account, 'global': global_})
+    return set_login
+
+def login(client, username, ip):
+    return client.post('/api/login', json={'tenant_id': username, 'password': 'wrong'},
+                       environ_base={'REMOTE_ADDR': ip})
+
+def assert_throttled(response, max_wait):
+    assert response.status_code == 429
+    assert 1 <= int(response.headers['Retry-After']) <= max_wait
+
+def test_account_bucket(client, limits):
+    limits(account='2/60')
+    assert login(client, 'a@example.com', '10.0.0.1').status_code == 200
+    assert login(client, 'a@example.com', '10.0.0.2').status_code == 200
+    # A new IP does not help, refilling one token takes 30 seconds
+    assert_throttled(login(client, 'a@example.com', '10.0.0.3'), 30)
+    assert login(client, 'b@example.com', '10.0.0.3').status_code == 200
+
+def test_ip_bucket(client, limits):
+    limits(ip='2/60')
+    assert login(client, 'a@example.com', '10.0.0.1').status_code == 200
+    assert login(client, 'b@example.com', '10.0.0.1').status_code == 200
+    assert_throttled(login(client, 'c@example.com', '10.0.0.1'), 30)
+    assert login(client, 'c@example.com', '10.0.0.2').status_code == 200
+
+def test_global_bucket(client, limits):
+    limits(global_='3/60')
+    for i in range(3):
+        assert login(client, f"user{i}@example.com", f"10.0.0.{i}").status_code == 200
+    assert_throttled(login(client, 'other@example.com', '10.0.1.1'), 20)
+
+def test_throttled_request_takes_no_token_from_other_buckets(client, limits):
+    limits(ip='1/60', account='2/60')
+    assert login(client, 'a@example.com', '10.0.0.1').status_code == 200
+    assert_throttled(login(client, 'a@example.com', '10.0.0.1'), 60)
+    # The refused attempt left the account's second token in place
+    assert login(client, 'a@example.com', '10.0.0.2').status_code == 200
+    assert_throttled(login(client, 'a@example.com', '10.0.0.3'), 30)
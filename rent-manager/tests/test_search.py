@@ -0,0 +1,44 @@
+import pytest
+from sqlalchemy import text
+from models import db, User, MaintenanceRequest
+from search import search_maintenance
+from conftest import auth
+
+@pytest.fixture
+def other_owner(client, owner):
+    """Headers of a second owner with one tenant, returns (owner headers, tenant headers)"""
+    client.post('/api/register_owner', json={'name': 'Other', 'email': 'other@example.com', 'password': 'secret'})
+    headers = auth(client.post('/api/login', json={'tenant_id': 'other@example.com', 'password': 'secret'}).json['token'])
+    tenant = client.post('/api/register_tenant', headers=headers, json={
+        'name': 'Other tenant', 'rent_amount': 1000, 'deposit': 0,
+        'initial_electricity_reading': 100, 'initial_water_reading': 50}).json['tenant']
+    token = client.post('/api/login', json={'tenant_id': tenant['tenant_id'], 'password': tenant['password']}).json['token']
+    return headers, auth(token)
+
+def report(client, headers, title):
+    response = client.post('/api/maintenance-requests', headers=headers,
+                           json={'title': title, 'description': 'Water on the floor', 'priority': 'high'})
+    return response.json['id']
+
+def test_create_all_builds_the_search_index(api):
+    with api.app.app_context():
+        names = {name for name, in db.session.execute(text("SELECT name FROM sqlite_master"))}
+    assert {'maintenance_request_fts', 'maintenance_request_fts_insert', 'maintenance_request_fts_update',
+            'maintenance_request_fts_delete'} <= names
+
+def test_search_only_finds_the_owners_requests(api, client, owner, add_tenant, other_owner):
+    other_headers, other_tenant = other_owner
+    tenant_headers, _ = add_tenant()
+    own = report(client, tenant_headers, 'Kitchen leak')
+    other = report(client, other_tenant, 'Bathroom leak')
+
+    for headers, expected in ((owner, [own]), (other_headers, [other])):
+        response = client.get('/api/maintenance-requests/owner/search', headers=headers, query_string={'q': 'leak'})
+        assert response.status_code == 200
+        assert [row['id'] for row in response.json] == expected
+
+    with api.app.app_context():
+        owner_id = User.query.filter_by(email='owner@example.com').one().id
+        # Without the endpoint's owner filter the index's owner_key alone keeps the other owner out
+        found = search_maintenance(db.session.query(MaintenanceRequest.id), owner_id, 'leak').all()
+        assert [row_id for row_id, in found] == [own]
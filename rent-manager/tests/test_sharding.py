@@ -0,0 +1,82 @@
+import threading
+import time
+from datetime import datetime
+import pytest
+from models import db, User, Payment, ShardDirectory
+from sharding import across_shards, move_owner, start_shard_job, finish_shard_job, shard_engine
+
+@pytest.fixture(autouse=True)
+def shards(api, tmp_path):
+    """Two SQLite shards for the duration of the test"""
+    config = api.app.config
+    binds = dict(config.get('SQLALCHEMY_BINDS') or {})
+    config['SHARDS'] = ['a', 'b']
+    config['SQLALCHEMY_BINDS'] = {**binds, **{f"shard:{name}": f"sqlite:///{tmp_path / name}.db" for name in 'ab'}}
+    with api.app.app_context():
+        api.create_schema()
+    yield config['SHARDS']
+    with api.app.app_context():
+        for name in config['SHARDS']:
+            shard_engine(name).dispose()
+    config['SHARDS'] = []
+    config['SQLALCHEMY_BINDS'] = binds
+
+def placement(api):
+    with api.app.app_context():
+        entry = ShardDirectory.query.one()
+        return entry.owner_id, entry.shard, entry.state
+
+def payment_count(shard, user_id):
+    with shard_engine(shard).connect() as connection:
+        return connection.execute(db.select(db.func.count()).select_from(Payment.__table__)
+                                  .where(Payment.__table__.c.user_id == user_id)).scalar()
+
+def test_background_jobs_skip_shards_during_a_move(api, add_tenant):
+    _, tenant = add_tenant()
+    owner_id, source, _ = placement(api)
+    target = 'b' if source == 'a' else 'a'
+    ran = []
+
+    def job():
+        # What a billing run or Stripe sweep would do, on whichever shard it visits
+        ran.append(True)
+        if User.query.get(tenant['id']) is not None:
+            db.session.add(Payment(user_id=tenant['id'], amount=100, payment_date=datetime.utcnow(),
+                                   payment_method='cash', status='paid'))
+
+    def during_copy(message):
+        if not ran and message.startswith('copied'):
+            assert across_shards(job) == []
+
+    with api.app.app_context():
+        move_owner(owner_id, target, grace_seconds=0, log=during_copy)
+        assert ran == []
+        assert placement(api)[1:] == (target, 'active')
+        # Once the move is done jobs run again and their writes land with the account
+        assert len(across_shards(job)) == 2
+        assert payment_count(source, tenant['id']) == 0
+        assert payment_count(target, tenant['id']) == 1
+
+def test_move_waits_for_running_jobs(api, add_tenant):
+    add_tenant()
+    owner_id, source, _ = placement(api)
+    target = 'b' if source == 'a' else 'a'
+    with api.app.app_context():
+        job_id = start_shard_job(source)
+
+    def move():
+        with api.app.app_context():
+            move_owner(owner_id, target, grace_seconds=0, poll_seconds=0.02, log=lambda message: None)
+    mover = threading.Thread(target=move, daemon=True)
+    mover.start()
+    try:
+        time.sleep(0.3)
+        assert placement(api)[1:] == (source, 'moving')
+        with api.app.app_context():
+            # No new job starts while the move waits
+            assert start_shard_job(target) is None
+    finally:
+        with api.app.app_context():
+            finish_shard_job(job_id)
+    mover.join(5)
+    assert placement(api)[1:] == (target, 'active')
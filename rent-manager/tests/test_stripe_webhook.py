@@ -0,0 +1,90 @@
+import hashlib
+import hmac
+import json
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import event
+from models import db, User, Payment, BalanceEntry, StripeEvent
+from reconciler import process_inbox, apply_intent_statuses
+
+def signed(payload, secret='whsec_test'):
+    """Stripe-Signature header for a payload, as Stripe computes it"""
+    timestamp = int(time.time())
+    signature = hmac.new(secret.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+    return {'Stripe-Signature': f"t={timestamp},v1={signature}", 'Content-Type': 'application/json'}
+
+def intent_event(event_id, intent_id, status):
+    return json.dumps({
+        'id': event_id,
+        'object': 'event',
+        'type': f"payment_intent.{status}",
+        'data': {'object': {'id': intent_id, 'object': 'payment_intent', 'status': status}},
+    })
+
+def card_payment(user_id, intent_id, amount=1000):
+    payment = Payment(user_id=user_id, amount=amount, payment_date=datetime.now(), payment_method='card',
+                      status='pending', stripe_payment_id=intent_id)
+    db.session.add(payment)
+    db.session.commit()
+    return payment.id
+
+def test_redelivered_event_is_stored_once(api, client):
+    payload = intent_event('evt_1', 'pi_1', 'succeeded')
+    for _ in range(3):
+        response = client.post('/api/stripe/webhook', data=payload, headers=signed(payload))
+        assert response.status_code == 200
+    with api.app.app_context():
+        assert StripeEvent.query.count() == 1
+
+def test_bad_signature_is_rejected(api, client):
+    payload = intent_event('evt_1', 'pi_1', 'succeeded')
+    response = client.post('/api/stripe/webhook', data=payload, headers=signed(payload, secret='whsec_other'))
+    assert response.status_code == 400
+    with api.app.app_context():
+        assert StripeEvent.query.count() == 0
+
+def test_succeeded_intent_completes_the_payment_once(api, client, add_tenant):
+    _, tenant = add_tenant()
+    with api.app.app_context():
+        payment_id = card_payment(tenant['id'], 'pi_1')
+    for event_id in ('evt_1', 'evt_1', 'evt_2'):
+        payload = intent_event(event_id, 'pi_1', 'succeeded')
+        client.post('/api/stripe/webhook', data=payload, headers=signed(payload))
+
+    with api.app.app_context():
+        changed = process_inbox()
+        assert [change[0] for change in changed] == [payment_id]
+        assert db.session.get(Payment, payment_id).status == 'completed'
+        assert db.session.get(User, tenant['id']).balance == -1000
+        assert StripeEvent.query.filter(StripeEvent.processed_at.is_(None)).count() == 0
+        # Nothing left to apply, the balance is not credited again
+        assert process_inbox() == []
+        assert db.session.get(User, tenant['id']).balance == -1000
+
+def test_payment_accepted_during_reconciliation_is_posted_once(api, client, owner, add_tenant):
+    _, tenant = add_tenant()
+    with api.app.app_context():
+        payment_id = card_payment(tenant['id'], 'pi_1')
+        accepted = []
+        reconciler_thread = threading.current_thread()
+
+        def accept_first(state):
+            # The owner accepts the payment after the reconciler found it pending
+            if state.is_update and not accepted and threading.current_thread() is reconciler_thread:
+                accept = threading.Thread(target=lambda: accepted.append(
+                    client.post(f"/api/owner/payments/{payment_id}/accept", headers=owner).status_code))
+                accept.start()
+                accept.join()
+
+        event.listen(db.session, 'do_orm_execute', accept_first)
+        try:
+            assert apply_intent_statuses({'pi_1': 'succeeded'}) == []
+            db.session.commit()
+        finally:
+            event.remove(db.session, 'do_orm_execute', accept_first)
+
+        assert accepted == [200]
+        assert db.session.get(Payment, payment_id).status == 'completed'
+        assert BalanceEntry.query.filter_by(payment_id=payment_id).count() == 1
+        assert db.session.get(User, tenant['id']).balance == -1000
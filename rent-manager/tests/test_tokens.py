@@ -0,0 +1,46 @@
+from conftest import auth
+from tokens import sync_revocations
+
+def login(client, username, password):
+    return client.post('/api/login', json={'tenant_id': username, 'password': password}).json
+
+def refresh(client, refresh_token):
+    return client.post('/api/auth/refresh', json={'refresh_token': refresh_token})
+
+def test_reused_refresh_token_revokes_its_session(client, owner):
+    first = login(client, 'owner@example.com', 'secret')
+    other_session = login(client, 'owner@example.com', 'secret')
+    rotated = refresh(client, first['refresh_token'])
+    assert rotated.status_code == 200
+    assert client.get('/api/owner/tenants', headers=auth(rotated.json['token'])).status_code == 200
+
+    # The first token was already rotated, presenting it again looks like a stolen copy
+    assert refresh(client, first['refresh_token']).status_code == 401
+    assert refresh(client, rotated.json['refresh_token']).status_code == 401
+    for token in (first['token'], rotated.json['token']):
+        assert client.get('/api/owner/tenants', headers=auth(token)).status_code == 401
+    # Other logins of the same user keep working
+    assert client.get('/api/owner/tenants', headers=auth(other_session['token'])).status_code == 200
+    assert refresh(client, other_session['refresh_token']).status_code == 200
+
+def test_deleted_tenant_tokens_are_rejected(api, client, owner, add_tenant):
+    tenant_headers, tenant = add_tenant()
+    tokens = login(client, tenant['tenant_id'], tenant['password'])
+    assert client.get('/api/tenant/dashboard', headers=tenant_headers).status_code == 200
+
+    assert client.delete(f"/api/owner/tenants/{tenant['id']}", headers=owner).status_code == 200
+    # Turned away by the revocation before the missing user is even looked up
+    response = client.get('/api/tenant/dashboard', headers=tenant_headers)
+    assert response.status_code == 401
+    assert response.json['error'] == 'Token has been revoked'
+    assert refresh(client, tokens['refresh_token']).status_code == 401
+
+    # A worker that did not handle the deletion learns about it from token_revocation
+    api.revocations.sessions.clear()
+    api.revocations.user_cutoffs.clear()
+    api.revocations.version = 0
+    with api.app.app_context():
+        assert sync_revocations() >= 1
+    response = client.get('/api/tenant/dashboard', headers=auth(tokens['token']))
+    assert response.status_code == 401
+    assert response.json['error'] == 'Token has been revoked'
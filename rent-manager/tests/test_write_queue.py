@@ -0,0 +1,50 @@
+import threading
+from datetime import datetime
+import pytest
+from models import MeterReading
+from write_queue import ReadingWriteQueue
+
+def reading(user_id, value):
+    return {'user_id': user_id, 'reading_value': value, 'reading_date': datetime.utcnow(),
+            'image_path': 'reading.jpg', 'meter_type': 'electricity', 'is_processed': False}
+
+def saved_values(api, user_id):
+    with api.app.app_context():
+        return sorted(value for value, in MeterReading.query.filter_by(user_id=user_id, meter_type='electricity')
+                      .with_entities(MeterReading.reading_value))
+
+def test_timed_out_reading_is_withdrawn(api, add_tenant):
+    _, tenant = add_tenant()
+    writes = ReadingWriteQueue(api.app)
+    start = writes.start
+    # The writer thread is not running yet, the first row waits in the queue
+    writes.start = lambda: None
+    with pytest.raises(TimeoutError):
+        writes.submit(reading(tenant['id'], 150), timeout=0.05)
+    writes.start = start
+    writes.submit(reading(tenant['id'], 160))
+    assert saved_values(api, tenant['id']) == [100, 160]
+
+def test_reading_taken_by_the_writer_waits_for_its_commit(api, add_tenant):
+    _, tenant = add_tenant()
+    writes = ReadingWriteQueue(api.app)
+    flushing, release = threading.Event(), threading.Event()
+    flush = writes.flush
+
+    def slow_flush(batch):
+        flushing.set()
+        release.wait(5)
+        flush(batch)
+    writes.flush = slow_flush
+
+    outcome = []
+    submit = threading.Thread(target=lambda: outcome.append(writes.submit(reading(tenant['id'], 150), timeout=0.05)))
+    submit.start()
+    assert flushing.wait(5)
+    submit.join(0.2)
+    # Past its timeout but already in a batch, the caller is still waiting
+    assert submit.is_alive()
+    release.set()
+    submit.join(5)
+    assert outcome == [None]
+    assert saved_values(api, tenant['id']) == [100, 150]
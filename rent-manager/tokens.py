@@ -0,0 +1,147 @@
+import hashlib
+import secrets
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+import jwt
+from flask import current_app
+from models import db, RefreshToken, TokenRevocation
+
+EPOCH = datetime(1970, 1, 1)
+
+def epoch_seconds(moment):
+    return (moment - EPOCH).total_seconds()
+
+def hash_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+class RevocationSet:
+    """Revoked sessions and per-user cutoffs, kept in step with token_revocation by version.
+
+    Checking a token is two dict lookups. Entries only matter while access tokens
+    issued before them can still be valid, so they are dropped after that.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.sessions = {}
+        self.user_cutoffs = {}
+        self.lock = threading.Lock()
+
+    def add(self, user_id, session_id, revoked_at):
+        at = epoch_seconds(revoked_at)
+        with self.lock:
+            if session_id:
+                self.sessions[session_id] = at
+            else:
+                self.user_cutoffs[user_id] = max(at, self.user_cutoffs.get(user_id, 0.0))
+
+    def is_revoked(self, claims):
+        session_id = claims.get('sid')
+        if session_id is not None and session_id in self.sessions:
+            return True
+        cutoff = self.user_cutoffs.get(claims.get('user_id'))
+        # Tokens from before refresh tokens have no iat and are covered by any cutoff
+        return cutoff is not None and claims.get('iat', 0.0) <= cutoff
+
+    def prune(self, before):
+        cutoff = epoch_seconds(before)
+        with self.lock:
+            self.sessions = {k: at for k, at in self.sessions.items() if at >= cutoff}
+            self.user_cutoffs = {k: at for k, at in self.user_cutoffs.items() if at >= cutoff}
+
+revocations = RevocationSet()
+
+def access_token(user_id, is_owner, session_id):
+    now = time.time()
+    return jwt.encode({
+        'user_id': user_id,
+        'is_owner': is_owner,
+        'sid': session_id,
+        'iat': now,
+        'exp': int(now + current_app.config['ACCESS_TOKEN_MINUTES'] * 60),
+    }, current_app.config['SECRET_KEY'], algorithm='HS256')
+
+def issue_tokens(user, session_id=None):
+    """A new access token and refresh token for the user, a new session unless one is given.
+
+    The refresh token is added to the session, the caller commits.
+    """
+    session_id = session_id or uuid.uuid4().hex
+    refresh_token = secrets.token_urlsafe(32)
+    db.session.add(RefreshToken(
+        user_id=user.id,
+        session_id=session_id,
+        token_hash=hash_token(refresh_token),
+        expires_at=datetime.utcnow() + timedelta(days=current_app.config['REFRESH_TOKEN_DAYS'])
+    ))
+    return {
+        'token': access_token(user.id, user.is_owner, session_id),
+        'refresh_token': refresh_token,
+        'expires_in': current_app.config['ACCESS_TOKEN_MINUTES'] * 60,
+    }
+
+def use_refresh_token(refresh_token):
+    """Mark a refresh token as used, returns (user_id, session_id) or None if it cannot be used.
+
+    A token that was already rotated means it leaked or was replayed, and the
+    whole session is revoked.
+    """
+    record = RefreshToken.query.filter_by(token_hash=hash_token(refresh_token)).first()
+    if record is None or record.revoked_at is not None or record.expires_at <= datetime.utcnow():
+        return None
+    now = datetime.utcnow()
+    claimed = (RefreshToken.query
+               .filter(RefreshToken.id == record.id, RefreshToken.used_at.is_(None))
+               .update({RefreshToken.used_at: now}, synchronize_session=False))
+    if not claimed:
+        revoke_session(record.user_id, record.session_id)
+        db.session.commit()
+        return None
+    return record.user_id, record.session_id
+
+def revoke_session(user_id, session_id):
+    """Revoke one login's refresh tokens and access tokens, the caller commits"""
+    now = datetime.utcnow()
+    (RefreshToken.query
+     .filter(RefreshToken.session_id == session_id, RefreshToken.revoked_at.is_(None))
+     .update({RefreshToken.revoked_at: now}, synchronize_session=False))
+    db.session.add(TokenRevocation(user_id=user_id, session_id=session_id, created_at=now))
+    revocations.add(user_id, session_id, now)
+
+def revoke_user(user_id, keep_session=None):
+    """Revoke every token of a user, or every session but keep_session; the caller commits"""
+    if keep_session is None:
+        now = datetime.utcnow()
+        (RefreshToken.query
+         .filter(RefreshToken.user_id == user_id, RefreshToken.revoked_at.is_(None))
+         .update({RefreshToken.revoked_at: now}, synchronize_session=False))
+        db.session.add(TokenRevocation(user_id=user_id, created_at=now))
+        revocations.add(user_id, None, now)
+        return
+    sessions = (db.session.query(RefreshToken.session_id)
+                .filter(RefreshToken.user_id == user_id, RefreshToken.revoked_at.is_(None),
+                        RefreshToken.session_id != keep_session)
+                .distinct())
+    for session_id, in sessions.all():
+        revoke_session(user_id, session_id)
+
+def sync_revocations():
+    """Apply revocations written by other workers since the last version, and forget old ones"""
+    lifetime = timedelta(minutes=current_app.config['ACCESS_TOKEN_MINUTES'])
+    rows = (db.session.query(TokenRevocation.id, TokenRevocation.user_id, TokenRevocation.session_id,
+                             TokenRevocation.created_at)
+            .filter(TokenRevocation.id > revocations.version)
+            .order_by(TokenRevocation.id)
+            .all())
+    for version, user_id, session_id, created_at in rows:
+        revocations.add(user_id, session_id, created_at)
+        revocations.version = version
+    # Access tokens issued before these have expired, refresh tokens carry their own revoked_at
+    expired = datetime.utcnow() - lifetime
+    revocations.prune(expired)
+    TokenRevocation.query.filter(TokenRevocation.created_at < expired - lifetime).delete(synchronize_session=False)
+    RefreshToken.query.filter(RefreshToken.expires_at < datetime.utcnow()).delete(synchronize_session=False)
+    db.session.commit()
+    return len(rows)
@@ -0,0 +1,104 @@
+import queue
+import threading
+import time
+from models import db, MeterReading
+
+class PendingWrite:
+    def __init__(self, values):
+        self.values = values
+        self.done = threading.Event()
+        self.error = None
+        self.state = 'queued'  # 'queued', 'taken' by the writer thread, or 'cancelled' by a timed out submit
+
+class ReadingWriteQueue:
+    """Batches meter reading inserts so many requests share one commit.
+
+    Callers block in submit() until the transaction holding their row has
+    committed, so a successful return is still a durable acknowledgement.
+    A submit that times out withdraws its row, unless the writer thread has
+    already taken it, then it waits for that commit instead.
+    """
+
+    def __init__(self, app, max_rows=200, max_wait_ms=5):
+        self.app = app
+        self.max_rows = max_rows
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='reading-writer', daemon=True)
+                self.thread.start()
+
+    def submit(self, values, timeout=30):
+        """Queue a row for insertion and wait until it is committed"""
+        self.start()
+        pending = PendingWrite(values)
+        self.queue.put(pending)
+        if not pending.done.wait(timeout):
+            with self.lock:
+                if pending.state == 'queued':
+                    # Never written, the writer thread skips it and the caller can safely retry
+                    pending.state = 'cancelled'
+                    raise TimeoutError('Timed out waiting for reading to be saved')
+            # Already in a batch, its commit decides the outcome
+            pending.done.wait()
+        if pending.error:
+            raise pending.error
+
+    def take(self, pending):
+        """Claim a queued row for the current batch, False when its submit gave up"""
+        with self.lock:
+            if pending.state == 'cancelled':
+                return False
+            pending.state = 'taken'
+            return True
+
+    def collect(self):
+        # Block for the first row, then gather more until the batch is full or the window closes
+        batch = []
+        while not batch:
+            pending = self.queue.get()
+            if self.take(pending):
+                batch.append(pending)
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_rows:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                pending = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if self.take(pending):
+                batch.append(pending)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            with self.app.app_context():
+                try:
+                    self.flush(batch)
+                finally:
+                    db.session.remove()
+
+    def flush(self, batch):
+        try:
+            db.session.execute(MeterReading.__table__.insert(), [p.values for p in batch])
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            if len(batch) == 1:
+                batch[0].error = e
+            else:
+                # Retry one by one so a single bad row does not fail the whole batch
+                self.app.logger.warning(f"Batched reading insert failed, retrying individually: {str(e)}")
+                for pending in batch:
+                    self.flush([pending])
+                return
+        for pending in batch:
+            pending.done.set()
@@ -44,7 +44,7 @@ type RootStackParamList = {
   TenantRegister: undefined;
   ForgotPassword: undefined;
   OTPVerification: { email: string };
-  ResetPassword: { email: string };
+  ResetPassword: { email: string; otp: string };
   OwnerDashboard: undefined;
   TenantManagement: undefined;
   BillManagement: undefined;
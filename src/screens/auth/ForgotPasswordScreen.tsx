@@ -1,7 +1,6 @@
 import React, { useState } from 'react';
 import { View, Text, TextInput, TouchableOpacity, Alert, StyleSheet, ScrollView, SafeAreaView } from 'react-native';
 import { authService } from '../../services/api';
-import AsyncStorage from '@react-native-async-storage/async-storage';
 
 // Netflix theme colors
 const NETFLIX_BG = '#141414';
@@ -49,34 +48,6 @@ const ForgotPasswordScreen = ({ navigation, route }) => {
       console.log('Forgot password response:', response);
       // addLog(`Forgot password response: ${JSON.stringify(response)}`);
       
-      if (!response.otp) {
-        throw new Error('OTP not received from server');
-      }
-
-      // addLog(`OTP received from API: ${response.otp}`);
-      
-      // Store OTP in AsyncStorage with expiration
-      const otpData = {
-        otp: response.otp,
-        expiresAt: Date.now() + 300000, // 5 minutes from now
-        isOwner: isOwner // Store whether this is for owner or tenant
-      };
-      console.log('Storing OTP data:', otpData);
-      // addLog(`Storing OTP data: ${JSON.stringify(otpData)}`);
-      await AsyncStorage.setItem('resetPasswordOTP', JSON.stringify(otpData));
-      
-      // Verify the stored data
-      const storedData = await AsyncStorage.getItem('resetPasswordOTP');
-      if (storedData) {
-        console.log('Verified stored OTP data:', JSON.parse(storedData));
-      }
-      
-      // Set up auto-deletion after 5 minutes
-      setTimeout(async () => {
-        await AsyncStorage.removeItem('resetPasswordOTP');
-        console.log('OTP data auto-deleted after 5 minutes');
-      }, 300000);
-
       navigation.navigate('OTPVerification', { email, isOwner });
     } catch (error) {
       console.error('Forgot password error:', error);
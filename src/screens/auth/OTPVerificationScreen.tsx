@@ -1,6 +1,5 @@
 import React, { useState, useEffect } from 'react';
 import { View, Text, TextInput, TouchableOpacity, Alert, StyleSheet, ScrollView, SafeAreaView } from 'react-native';
-import AsyncStorage from '@react-native-async-storage/async-storage';
 import { authService } from '../../services/api';
 
 // Netflix theme colors
@@ -49,33 +48,19 @@ const OTPVerificationScreen = ({ navigation, route }) => {
     try {
       setLoading(true);
       
-      // Get stored OTP data
-      const storedOTPData = await AsyncStorage.getItem('resetPasswordOTP');
-      
-      if (!storedOTPData) {
-        Alert.alert('Error', 'OTP has expired. Please request a new one.');
-        return;
-      }
-
-      const { otp: storedOTP, expiresAt } = JSON.parse(storedOTPData);
-      
-      // Check if OTP has expired
-      if (Date.now() > expiresAt) {
-        await AsyncStorage.removeItem('resetPasswordOTP');
-        Alert.alert('Error', 'OTP has expired. Please request a new one.');
-        return;
-      }
-
-      // Verify OTP
-      if (otp === storedOTP) {
-        // Clear the OTP from storage
-        await AsyncStorage.removeItem('resetPasswordOTP');
-        navigation.navigate('ResetPassword', { email });
+      // The server checks the code and keeps it valid while the new password is chosen
+      const response = await authService.verifyOTP(email, otp);
+      if (response.verified) {
+        navigation.navigate('ResetPassword', { email, otp, isOwner });
       } else {
         Alert.alert('Error', 'Invalid OTP. Please try again.');
       }
     } catch (error) {
-      Alert.alert('Error', 'Something went wrong. Please try again.');
+      if (error.response?.status === 400) {
+        Alert.alert('Error', 'Invalid or expired OTP. Please try again or request a new one.');
+      } else {
+        Alert.alert('Error', 'Something went wrong. Please try again.');
+      }
     } finally {
       setLoading(false);
     }
@@ -84,20 +69,7 @@ const OTPVerificationScreen = ({ navigation, route }) => {
   const handleResendOTP = async () => {
     try {
       setLoading(true);
-      const response = await authService.forgotPassword(email, isOwner);
-      
-      // Store new OTP in AsyncStorage with expiration
-      const otpData = {
-        otp: response.otp,
-        expiresAt: Date.now() + 300000, // 5 minutes from now
-        isOwner: isOwner // Store whether this is for owner or tenant
-      };
-      await AsyncStorage.setItem('resetPasswordOTP', JSON.stringify(otpData));
-      
-      // Set up auto-deletion after 5 minutes
-      setTimeout(async () => {
-        await AsyncStorage.removeItem('resetPasswordOTP');
-      }, 300000);
+      await authService.forgotPassword(email, isOwner);
 
       setTimer(300); // Reset timer
       Alert.alert('Success', 'New OTP has been sent to your email');
@@ -22,7 +22,7 @@ const ResetPasswordScreen = ({ navigation, route }) => {
   const [password, setPassword] = useState('');
   const [confirmPassword, setConfirmPassword] = useState('');
   const [loading, setLoading] = useState(false);
-  const { email, isOwner = true } = route.params;
+  const { email, otp, isOwner = true } = route.params;
 
   const handleSubmit = async () => {
     if (password !== confirmPassword) {
@@ -39,6 +39,7 @@ const ResetPasswordScreen = ({ navigation, route }) => {
       setLoading(true);
       const response = await axios.post(`${API_BASE_URL}/auth/reset-password`, {
         email,
+        otp,
         newPassword: password,
         is_owner: isOwner
       });
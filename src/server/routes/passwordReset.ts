@@ -49,7 +49,7 @@ router.post('/forgot-password', async (req: Request, res: Response) => {
 
     await sgMail.send(msg);
 
-    res.status(200).json({ message: 'OTP sent to your email', otp: otp });
+    res.status(200).json({ message: 'OTP sent to your email' });
   } catch (error) {
     console.error(error);
     res.status(500).json({ message: 'Server error' });
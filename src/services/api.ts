@@ -25,6 +25,44 @@ api.interceptors.request.use(
   }
 );
 
+// Access tokens are short-lived: on a 401, swap the refresh token for a new pair and retry once.
+// Concurrent 401s share one refresh, a refresh token can only be used once.
+let refreshing: Promise<string | null> | null = null;
+
+const refreshAccessToken = async (): Promise<string | null> => {
+  const refreshToken = await AsyncStorage.getItem('refresh_token');
+  if (!refreshToken) {
+    return null;
+  }
+  try {
+    const response = await axios.post(`${API_BASE_URL}/auth/refresh`, { refresh_token: refreshToken });
+    await AsyncStorage.setItem('token', response.data.token);
+    await AsyncStorage.setItem('refresh_token', response.data.refresh_token);
+    return response.data.token;
+  } catch (error) {
+    await AsyncStorage.multiRemove(['token', 'refresh_token']);
+    return null;
+  }
+};
+
+api.interceptors.response.use(
+  (response) => response,
+  async (error) => {
+    const original = error.config;
+    if (error.response?.status !== 401 || !original || original._retried) {
+      return Promise.reject(error);
+    }
+    original._retried = true;
+    refreshing = refreshing || refreshAccessToken().finally(() => { refreshing = null; });
+    const token = await refreshing;
+    if (!token) {
+      return Promise.reject(error);
+    }
+    original.headers.Authorization = `Bearer ${token}`;
+    return api(original);
+  }
+);
+
 // Auth Services
 export const authService = {
   login: async (tenantId: string, password: string) => {
@@ -36,6 +74,9 @@ export const authService = {
       }
       if (response.data.token) {
         await AsyncStorage.setItem('token', response.data.token);
+        if (response.data.refresh_token) {
+          await AsyncStorage.setItem('refresh_token', response.data.refresh_token);
+        }
         await AsyncStorage.setItem('user', JSON.stringify(response.data.user));
         // Debug log to confirm token is saved
         const savedToken = await AsyncStorage.getItem('token');
@@ -67,8 +108,13 @@ export const authService = {
 
   logout: async () => {
     try {
+      // Revoke the session on the server, signing out locally does not depend on it
+      await api.post('/auth/logout').catch(() => undefined);
       await AsyncStorage.removeItem('token');
+      await AsyncStorage.removeItem('refresh_token');
       await AsyncStorage.removeItem('user');
+      // Lists cached by syncService belong to this account
+      await AsyncStorage.removeItem('sync_state');
     } catch (error) {
       throw error;
     }
@@ -82,15 +128,10 @@ export const authService = {
         is_owner: isOwner 
       });
       // console.log('Server response:', response.data);
-      
-      // Ensure we have the OTP in the response
-      if (!response.data.otp) {
-        throw new Error('OTP not received from server');
-      }
 
+      // The OTP is only sent by email, verifyOTP checks it on the server
       return {
-        message: response.data.message || 'OTP sent successfully',
-        otp: response.data.otp
+        message: response.data.message || 'OTP sent successfully'
       };
     } catch (error) {
       // console.error('Forgot password API error:', error);
@@ -0,0 +1,58 @@
+import AsyncStorage from '@react-native-async-storage/async-storage';
+import api from './api';
+
+type Row = { id: number; [key: string]: any };
+type Lists = { [entity: string]: Row[] };
+
+interface SyncResponse {
+  watermark: number;
+  full: boolean;
+  changes: Lists;
+  deleted: { [entity: string]: number[] };
+}
+
+// Also cleared by authService.logout
+const STORAGE_KEY = 'sync_state';
+
+// Apply a sync response to the cached lists: rows replace the ones with the same id, deleted ids go away
+const merge = (lists: Lists, response: SyncResponse): Lists => {
+  if (response.full) {
+    return response.changes;
+  }
+  const merged: Lists = {};
+  for (const entity of Object.keys(response.changes)) {
+    const rows = new Map<number, Row>((lists[entity] || []).map((row) => [row.id, row]));
+    for (const id of response.deleted[entity] || []) {
+      rows.delete(id);
+    }
+    for (const row of response.changes[entity]) {
+      rows.set(row.id, row);
+    }
+    merged[entity] = Array.from(rows.values());
+  }
+  return merged;
+};
+
+export const syncService = {
+  // Fetch what changed since the last sync and return the up to date lists
+  sync: async (): Promise<Lists> => {
+    try {
+      const stored = await AsyncStorage.getItem(STORAGE_KEY);
+      const state: { watermark?: number; lists: Lists } = stored ? JSON.parse(stored) : { lists: {} };
+      const response = await api.get<SyncResponse>('/sync', {
+        params: state.watermark ? { since: state.watermark } : {},
+      });
+      const lists = merge(state.lists, response.data);
+      await AsyncStorage.setItem(STORAGE_KEY, JSON.stringify({ watermark: response.data.watermark, lists }));
+      return lists;
+    } catch (error: any) {
+      console.error('Sync error:', error);
+      throw error;
+    }
+  },
+
+  // Forget the cached lists, for logout or switching accounts
+  reset: async (): Promise<void> => {
+    await AsyncStorage.removeItem(STORAGE_KEY);
+  },
+};